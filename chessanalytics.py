@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+'''Per-square analytics over the whole history of a game, with NumPy: how
+often each square is answered correctly and how long it takes, the same for
+every start and end pair of the knight game, and trends over time. Prints
+them as text heatmaps or exports them as CSV or JSON.
+
+    python3 chessanalytics.py knight
+    python3 chessanalytics.py color-square --days 30 --export color-square.csv
+'''
+import argparse
+import csv
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import chesstrainer as ct
+
+# A record of a `chesstrainer.TrialLog`, see `TrialLog.record`
+RECORD_DTYPE = np.dtype({
+    'names': ['number', 'correct', 'total_time', 'start', 'end', 'timestamp', 'answer_offset', 'answer_length'],
+    'formats': ['<u4', 'u1', '<f8', '<i8', '<i8', '<f8', '<u8', '<u4'],
+    'offsets': [0, 4, 8, 16, 24, 32, 40, 48],
+    'itemsize': ct.TrialLog.record.size})
+
+SECONDS_PER_DAY = 86400
+# Boards with at most this many start and end pairs count them all densely
+DENSE_PAIRS = 2 ** 16
+EPOCH = datetime(1970, 1, 1)
+
+class History:
+    '''The rounds of a game as parallel arrays, so that every report is a
+    handful of vectorized passes. Each row is a tally of `rounds` rounds of
+    one position on one day: 1 for a round in the log, any number for a day
+    of the log's archive (see `chesstrainer.TrialArchive`).
+
+    `start` and `end` are square ids (see `chesstrainer.get_square_id`),
+    `end` is -1 for one square positions. The rest are floats, which is what
+    `np.bincount` weights are: `correct` counts the right answers,
+    `total_time` is the sum of the answer times in seconds and `seconds` is
+    when the rounds were played, in seconds since 1970 by the player's
+    clock.'''
+
+    def __init__(self, start, end, rounds, correct, total_time, seconds, size=8):
+        self.start = start
+        self.end = end
+        self.rounds = rounds
+        self.correct = correct
+        self.total_time = total_time
+        self.seconds = seconds
+        self.size = size
+
+    def __len__(self):
+        return int(self.rounds.sum())
+
+    @classmethod
+    def empty(cls, size=8):
+        return cls(np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0), np.empty(0),
+                   np.empty(0), np.empty(0), size)
+
+    @classmethod
+    def load(cls, trial_log, since=None, file=None, last=None):
+        '''Loads a `TrialLog` or `SqliteTrialLog` and its archive. The
+        filters are the ones of `TrialLog.summary`.'''
+        if not trial_log.exists():
+            return cls.empty(trial_log.size)
+        # Not isinstance, since the log may come from chesstrainer run as __main__.
+        if hasattr(trial_log, 'record'):
+            history, archive = trial_log.read_with_archive(lambda: cls._from_records(trial_log))
+        else:
+            history, archive = cls._from_rounds(trial_log), trial_log.archive()
+        if last is not None:
+            history = history._select(slice(max(len(history.rounds) - last, 0), None))
+        logged = len(history.rounds)
+        if last is None and archive.days:
+            history = history.concatenate(cls._from_archive(archive, trial_log.size))
+        if since is not None:
+            day = (datetime.fromisoformat(since[:10]) - EPOCH).total_seconds()
+            earliest = (datetime.fromisoformat(since) - EPOCH).total_seconds()
+            # Archived rounds are filtered by day, like `TrialArchive.summary`.
+            archived = np.arange(len(history.rounds)) >= logged
+            history = history._select(np.where(archived, history.seconds >= day, history.seconds >= earliest))
+        if file is not None:
+            history = history._select(history.start % history.size == ct.get_file_number(file) - 1)
+        return history
+
+    @classmethod
+    def _from_records(cls, trial_log):
+        with open(trial_log.path, 'rb') as f:
+            magic, version, generation, size = trial_log.header.unpack(f.read(trial_log.header.size))
+            if magic != trial_log.magic or version != trial_log.version:
+                raise ValueError('{} is not a version {} trial log'.format(trial_log.path, trial_log.version))
+            # len() leaves out a partially written record at the end.
+            records = np.fromfile(f, dtype=RECORD_DTYPE, count=len(trial_log))
+        # Contiguous copies of the fields are much faster to work with than
+        # views that stride over whole records.
+        return cls(records['start'].copy(), records['end'].copy(), np.ones(len(records)),
+                   records['correct'].astype(np.float64), records['total_time'].copy(),
+                   _local_seconds(records['timestamp'].copy()), trial_log.size), generation
+
+    @classmethod
+    def _from_rounds(cls, trial_log):
+        with trial_log.view() as rounds:
+            columns = list(zip(*((round.position, round.correct, round.total_time, str(round.utc_datetime))
+                                 for round in rounds)))
+        if not columns:
+            return cls.empty(trial_log.size)
+        positions, correct, total_time, dates = columns
+        # Every position is converted once, however often it was played.
+        unique, inverse = np.unique(np.array(positions), return_inverse=True)
+        ids = np.array([_square_ids(position, trial_log.size) for position in unique], np.int64)
+        seconds = np.array(dates, dtype='datetime64[us]').astype(np.int64) / 1e6
+        return cls(ids[inverse, 0], ids[inverse, 1], np.ones(len(positions)),
+                   np.array(correct, np.float64), np.array(total_time, np.float64), seconds, trial_log.size)
+
+    @classmethod
+    def _from_archive(cls, archive, size):
+        rows = []
+        for day, positions in archive.days.items():
+            seconds = (datetime.fromisoformat(day) - EPOCH).total_seconds()
+            for position, tally in positions.items():
+                rows.append(_square_ids(position, size) + (tally[0], tally[1], tally[2], seconds))
+        if not rows:
+            return cls.empty(size)
+        start, end, rounds, correct, total_time, seconds = (np.array(column) for column in zip(*rows))
+        return cls(start.astype(np.int64), end.astype(np.int64), rounds.astype(np.float64),
+                   correct.astype(np.float64), total_time.astype(np.float64), seconds.astype(np.float64), size)
+
+    def _select(self, rows):
+        return History(self.start[rows], self.end[rows], self.rounds[rows], self.correct[rows],
+                       self.total_time[rows], self.seconds[rows], self.size)
+
+    def concatenate(self, other):
+        return History(*(np.concatenate((getattr(self, name), getattr(other, name)))
+                         for name in ('start', 'end', 'rounds', 'correct', 'total_time', 'seconds')),
+                       size=self.size)
+
+    def has_pairs(self):
+        return bool((self.end >= 0).any())
+
+    def _group(self, keys, groups):
+        '''Sums the tallies of each of `groups` keys, leaving out keys of
+        `groups` or more. Returns the rounds, the fraction correct and the
+        average time of each, NaN if never played.'''
+        rounds = np.bincount(keys, weights=self.rounds, minlength=groups)[:groups]
+        correct = np.bincount(keys, weights=self.correct, minlength=groups)[:groups]
+        total_time = np.bincount(keys, weights=self.total_time, minlength=groups)[:groups]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return rounds.astype(np.int64), correct / rounds, total_time / rounds
+
+    def squares(self):
+        '''Returns the rounds, fraction correct and average answer time of
+        every (first) square, as `size` x `size` grids indexed by [rank - 1,
+        file - 1].'''
+        shape = (self.size, self.size)
+        return tuple(grid.reshape(shape) for grid in self._group(self.start, self.size * self.size))
+
+    def played_pairs(self):
+        '''Returns the start and end square ids of every pair that was
+        played, sorted, and the rounds, fraction correct and average answer
+        time of each. There are (size x size)^2 pairs, so only the played
+        ones are grouped.'''
+        two_squares = self._select(self.end >= 0)
+        squares = self.size * self.size
+        if squares * squares <= DENSE_PAIRS:
+            tallies = two_squares._group(two_squares.start * squares + two_squares.end, squares * squares)
+            played = np.flatnonzero(tallies[0])
+            return (played // squares, played % squares) + tuple(tally[played] for tally in tallies)
+        # Sorted by start then end; ids of N x N boards do not fit in one int64 key.
+        order = np.lexsort((two_squares.end, two_squares.start))
+        start, end = two_squares.start[order], two_squares.end[order]
+        new = np.ones(len(order), bool)
+        new[1:] = (start[1:] != start[:-1]) | (end[1:] != end[:-1])
+        inverse = np.empty(len(order), np.int64)
+        inverse[order] = np.cumsum(new) - 1
+        return (start[new], end[new]) + two_squares._group(inverse, int(new.sum()))
+
+    def pairs(self):
+        '''Returns the rounds, fraction correct and average answer time of
+        every start and end pair, as square id x square id matrices. Only
+        for 8x8 boards; see `played_pairs` for the others.'''
+        if self.size != 8:
+            raise ValueError('Pair matrices are only built for 8x8 boards')
+        squares = self.size * self.size
+        starts, ends, *tallies = self.played_pairs()
+        grids = []
+        for tally, never_played in zip(tallies, (0, np.nan, np.nan)):
+            grid = np.full((squares, squares), never_played, dtype=tally.dtype)
+            grid[starts, ends] = tally
+            grids.append(grid)
+        return tuple(grids)
+
+    def trend(self, days=1):
+        '''Returns the first day of every `days` long period that was played
+        in, and the rounds, fraction correct and average answer time of
+        each.'''
+        if not len(self.rounds):
+            return np.empty(0, 'datetime64[D]'), np.empty(0, np.int64), np.empty(0), np.empty(0)
+        periods = self.seconds.astype(np.int64) // (SECONDS_PER_DAY * days)
+        first = periods.min()
+        rounds, correct, avg_time = self._group(periods - first, periods.max() - first + 1)
+        played = np.flatnonzero(rounds)
+        starts = ((played + first) * days).astype('datetime64[D]')
+        return starts, rounds[played], correct[played], avg_time[played]
+
+def _square_ids(position, size):
+    squares = position.split()
+    start = ct.get_square_id(squares[0], size)
+    end = ct.get_square_id(squares[1], size) if len(squares) > 1 else -1
+    return start, end
+
+def _local_seconds(timestamps):
+    # `TrialLog` keeps epoch timestamps of the player's local time, so add
+    # the UTC offset of each hour in the history to get the dates back. The
+    # offset is looked up once a day, and every hour of the days it changes.
+    if not len(timestamps):
+        return timestamps
+    hours = timestamps.astype(np.int64) // 3600
+    first = int(hours.min()) // 24 * 24
+    days = (int(hours.max()) - first) // 24 + 2
+    daily = np.array([time.localtime((first + day * 24) * 3600).tm_gmtoff for day in range(days)], np.float64)
+    offsets = np.repeat(daily[:-1], 24)
+    for day in np.flatnonzero(daily[:-1] != daily[1:]):
+        for hour in range(day * 24, day * 24 + 24):
+            offsets[hour] = time.localtime((first + hour) * 3600).tm_gmtoff
+    return timestamps + offsets[hours - first]
+
+def _file_letters(size):
+    return [ct.get_chess_notation(x, 1).split(':')[0] for x in range(1, size + 1)]
+
+def format_heatmap(grid, cell='{:.0f}', width=5):
+    '''Draws a `size` x `size` grid indexed by [rank - 1, file - 1] like a
+    board seen by white, with `cell` formatting each value and "." for
+    squares that were never played.'''
+    size = len(grid)
+    lines = []
+    for rank in range(size, 0, -1):
+        cells = ('.' if np.isnan(value) else cell.format(value) for value in grid[rank - 1])
+        lines.append('{:>3} '.format(rank) + ''.join(value.rjust(width) for value in cells))
+    lines.append('    ' + ''.join(letter.rjust(width) for letter in _file_letters(size)))
+    return '\n'.join(lines)
+
+def heatmaps(history, count=10, days=1, periods=14):
+    '''Returns a list of (title, text) for `RandomSquareGame.print_statistics`:
+    heatmaps of accuracy and answer time by square, the `count` slowest
+    start and end pairs if the game has pairs and the last `periods`
+    periods of `days` days.'''
+    rounds, correct, avg_time = history.squares()
+    reports = [('Percent correct by square', format_heatmap(correct * 100)),
+               ('Average answer time by square in seconds', format_heatmap(avg_time, '{:.1f}'))]
+    if history.has_pairs():
+        starts, ends, pair_rounds, pair_correct, pair_time = history.played_pairs()
+        slowest = np.argsort(-pair_time, kind='stable')[:count]
+        lines = ['{} {}: {:.2f} seconds, {} out of {} correct'.format(
+                    ct.get_square_name(starts[pair], history.size), ct.get_square_name(ends[pair], history.size),
+                    pair_time[pair], int(round(pair_correct[pair] * pair_rounds[pair])), pair_rounds[pair])
+                 for pair in slowest]
+        reports.append(('Slowest pairs', '\n'.join(lines)))
+    starts, trend_rounds, trend_correct, trend_time = history.trend(days)
+    lines = ['{}: {} rounds, {:.0%} correct, {:.2f} seconds'.format(start, rounds, correct, avg_time)
+             for start, rounds, correct, avg_time in list(zip(starts, trend_rounds, trend_correct, trend_time))[-periods:]]
+    reports.append(('Trend by {} day{}'.format(days, 's' if days != 1 else ''), '\n'.join(lines)))
+    return reports
+
+def _json_grid(grid):
+    return [[None if np.isnan(value) else round(float(value), 3) for value in row] for row in grid]
+
+def to_dict(history, days=1):
+    '''The analytics as plain lists, NaN as None, for JSON.'''
+    rounds, correct, avg_time = history.squares()
+    report = {'size': history.size, 'rounds': len(history),
+              'squares': {'rounds': rounds.tolist(), 'perc_correct': _json_grid(correct),
+                          'avg_time': _json_grid(avg_time)},
+              'pairs': None}
+    if history.has_pairs():
+        report['pairs'] = [{'position': position, 'rounds': int(count), 'perc_correct': round(float(fraction), 3),
+                            'avg_time': round(float(seconds), 3)}
+                           for position, count, fraction, seconds in _played_pairs(history)]
+    starts, rounds, correct, avg_time = history.trend(days)
+    report['trend'] = [{'start': str(start), 'rounds': int(count), 'perc_correct': round(float(fraction), 3),
+                        'avg_time': round(float(seconds), 3)}
+                       for start, count, fraction, seconds in zip(starts, rounds, correct, avg_time)]
+    return report
+
+def _played_pairs(history):
+    # Yields (position, rounds, fraction correct, average time) of every pair played.
+    starts, ends, rounds, correct, avg_time = history.played_pairs()
+    for pair in range(len(starts)):
+        position = '{} {}'.format(ct.get_square_name(starts[pair], history.size),
+                                  ct.get_square_name(ends[pair], history.size))
+        yield position, rounds[pair], correct[pair], avg_time[pair]
+
+def _csv_rows(history, days=1):
+    rounds, correct, avg_time = (grid.ravel() for grid in history.squares())
+    for square in np.flatnonzero(rounds):
+        yield 'square', ct.get_square_name(square, history.size), rounds[square], correct[square], avg_time[square]
+    if history.has_pairs():
+        for row in _played_pairs(history):
+            yield ('pair',) + row
+    for row in zip(*history.trend(days)):
+        yield ('day' if days == 1 else '{} days'.format(days),) + row
+
+def export(history, path, days=1):
+    '''Writes the analytics to `path`, as JSON if it ends in ".json" and as
+    CSV with a row per square, pair and period otherwise.'''
+    with open(path, 'w', newline='') as f:
+        if path.endswith('.json'):
+            json.dump(to_dict(history, days), f)
+            return
+        writer = csv.writer(f)
+        writer.writerow(['kind', 'key', 'rounds', 'perc_correct', 'avg_time'])
+        for kind, key, rounds, correct, avg_time in _csv_rows(history, days):
+            writer.writerow([kind, key, int(rounds), round(float(correct), 3), round(float(avg_time), 3)])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('game', choices=list(ct.GAME_REGISTRY))
+    parser.add_argument('--size', type=int, default=8)
+    parser.add_argument('--database', help='read the history from this SQLite database')
+    parser.add_argument('--days', type=float, help='only the last DAYS days')
+    parser.add_argument('--file', help='only squares on this file, i.e. "e"')
+    parser.add_argument('--last', type=int, help='only the last LAST rounds')
+    parser.add_argument('--trend-days', type=int, default=1, help='how many days each period of the trend is')
+    parser.add_argument('--export', metavar='FILE', help='write the analytics to FILE, as JSON if it ends in .json')
+    args = parser.parse_args(argv)
+    game = ct.GAME_REGISTRY[args.game].factory(size=args.size, database=args.database)
+    since = str(datetime.now() - timedelta(days=args.days)) if args.days is not None else None
+    history = History.load(game.open_trial_log(), since, args.file, args.last)
+    if args.export:
+        export(history, args.export, args.trend_days)
+        print('Wrote the analytics of {} rounds to {}'.format(len(history), os.path.abspath(args.export)))
+        return
+    game.print_statistics({**game.compute_statistics(game.open_trial_log().summary(since, args.file, args.last)),
+                           'heatmaps': heatmaps(history, days=args.trend_days)})
+
+if __name__ == "__main__":
+    main()
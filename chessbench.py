@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+'''Benchmarks the trainer's hot paths and compares them against a baseline,
+so that performance regressions show up before they are merged. A baseline
+only holds on the machine and Python it was saved with, so save your own
+before comparing against it.
+
+    python3 chessbench.py --output results.json
+    python3 chessbench.py --save-baseline
+    python3 chessbench.py --max-rounds 10000000 --threshold 0.1
+    python3 chessbench.py --repeat 9 --min-time 1
+    python3 chessbench.py --startup-budget 2
+'''
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from random import Random
+
+import chesstrainer as ct
+
+try:
+    import chessanalytics
+except ImportError: # it needs NumPy
+    chessanalytics = None
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chessbench-baseline.json')
+SEED = 1
+# How many rounds are generated and logged at a time for the history benchmarks
+CHUNK_SIZE = 100000
+
+BENCHMARKS = []
+
+def benchmark(sized=False):
+    '''Registers `function(rounds)`, which returns how many operations it
+    did, or that and how many seconds the part that matters took. If
+    `sized`, it is run once per history size and `rounds` is the size.'''
+    def register(function):
+        BENCHMARKS.append((function, sized))
+        return function
+    return register
+
+def _pairs():
+    return [(start, end) for start in ct.SQUARE_NAMES for end in ct.SQUARE_NAMES]
+
+def synthetic_rounds(count, seed=SEED):
+    '''Yields `count` reproducible knight game `Round`s, a minute apart.'''
+    rng = Random(seed)
+    start = datetime(2020, 1, 1)
+    for number in range(count):
+        position = '{} {}'.format(rng.choice(ct.SQUARE_NAMES), rng.choice(ct.SQUARE_NAMES))
+        yield ct.Round(number % 20 + 1, int(rng.random() < 0.8), rng.lognormvariate(1.5, 0.6),
+                position, position, str(start + timedelta(minutes=number)))
+
+def _log_history(game, rounds):
+    history = synthetic_rounds(rounds)
+    for _ in range(0, rounds, CHUNK_SIZE):
+        game.log_trials(round for _, round in zip(range(CHUNK_SIZE), history))
+
+@benchmark()
+def knight_paths(rounds):
+    '''find_shortest_path_for_knight over all 4096 pairs'''
+    for start, end in _pairs():
+        ct.find_shortest_path_for_knight(start, end)
+    return 4096
+
+@benchmark()
+def knight_path_checks(rounds):
+    '''is_a_shortest_path_for_knight over all 4096 pairs'''
+    paths = [ct.find_shortest_path_for_knight(start, end) for start, end in _pairs()]
+    start = time.perf_counter()
+    for path in paths:
+        ct.is_a_shortest_path_for_knight(path, path)
+    return 4096, time.perf_counter() - start
+
+@benchmark()
+def diagonal_squares(rounds):
+    '''get_diagonal_squares for every square, 100 times'''
+    for _ in range(100):
+        for square in ct.SQUARE_NAMES:
+            ct.get_diagonal_squares(square)
+    return 6400
+
+@benchmark()
+def parse_answers(rounds):
+    '''get_answer of 1000 knight routes and 1000 queen answers, 10 times'''
+    knight = ct.KnightSquareGame()
+    queen = ct.QueenSquareGame()
+    pairs = [(start, end) for start, end in _pairs()[::4] if start != end][:1000]
+    routes = [' '.join(ct.find_shortest_path_for_knight(start, end)) for start, end in pairs]
+    attacks = [' '.join(ct.get_attacked_squares('queen', start)).upper() for start, end in pairs]
+    start = time.perf_counter()
+    for _ in range(10):
+        for route, squares in zip(routes, attacks):
+            knight.get_answer(route)
+            queen.get_answer(squares)
+    return 20000, time.perf_counter() - start
+
+@benchmark(sized=True)
+def compute_statistics(rounds):
+    '''compute_statistics of `rounds` rounds'''
+    history = list(synthetic_rounds(rounds))
+    start = time.perf_counter()
+    ct.KnightSquareGame().compute_statistics(history)
+    return rounds, time.perf_counter() - start
+
+@benchmark(sized=True)
+def log_trials(rounds):
+    '''log_trials of `rounds` rounds, CHUNK_SIZE at a time'''
+    with tempfile.TemporaryDirectory() as directory:
+        history = list(synthetic_rounds(min(rounds, CHUNK_SIZE)))
+        game = ct.KnightSquareGame(directory=directory)
+        start = time.perf_counter()
+        for logged in range(0, rounds, CHUNK_SIZE):
+            game.log_trials(history[:rounds - logged])
+        return rounds, time.perf_counter() - start
+
+@benchmark(sized=True)
+def read_trials(rounds):
+    '''read_trials of a `rounds` round history'''
+    with tempfile.TemporaryDirectory() as directory:
+        game = ct.KnightSquareGame(directory=directory)
+        _log_history(game, rounds)
+        start = time.perf_counter()
+        count = sum(1 for _ in game.read_trials())
+        return count, time.perf_counter() - start
+
+# A line of `python -X importtime` output: self and cumulative µs, then the module.
+importtime_regex = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+def startup_time(module='chesstrainer', repeat=3):
+    '''Returns how many milliseconds importing `module` takes in a fresh
+    interpreter, per `-X importtime`, the best of `repeat` runs. Imports it
+    once first, so that its bytecode is cached like on an installed system.'''
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    command = [sys.executable, '-X', 'importtime', '-c', 'import ' + module]
+    directory = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run(command, env=env, cwd=directory, capture_output=True, check=True)
+    best = None
+    for _ in range(repeat):
+        stderr = subprocess.run(command, env=env, cwd=directory, capture_output=True,
+                                check=True, text=True).stderr
+        for line in stderr.splitlines():
+            match = importtime_regex.match(line)
+            if match and match.group(4) == module:
+                milliseconds = int(match.group(2)) / 1000.0
+                best = milliseconds if best is None else min(best, milliseconds)
+    if best is None:
+        raise ValueError('{} was not imported'.format(module))
+    return best
+
+# Importing the trainer may take at most this many times as long as a bare
+# `import cmd`, which it cannot start without. A ratio rather than
+# milliseconds, so that the budget means the same on any machine.
+STARTUP_BUDGET = 2.0
+
+def startup_ratio(module='chesstrainer', repeat=3):
+    '''Returns how many times as long as `import cmd` importing `module`
+    takes, see `startup_time`.'''
+    return startup_time(module, repeat) / startup_time('cmd', repeat)
+
+@benchmark(sized=True)
+def read_csv_log(rounds):
+    '''read_csv_log of a `rounds` round CSV log, for comparison with the
+    binary log read_trials reads'''
+    import csv
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'knight.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(ct.Round._fields)
+            writer.writerows(synthetic_rounds(rounds))
+        start = time.perf_counter()
+        count = sum(1 for _ in ct.read_csv_log(path))
+        return count, time.perf_counter() - start
+
+def analytics(rounds):
+    '''chessanalytics.heatmaps of a `rounds` round history, loading it included'''
+    with tempfile.TemporaryDirectory() as directory:
+        game = ct.KnightSquareGame(directory=directory)
+        _log_history(game, rounds)
+        start = time.perf_counter()
+        chessanalytics.heatmaps(chessanalytics.History.load(game.open_trial_log()))
+        return rounds, time.perf_counter() - start
+
+if chessanalytics is not None:
+    benchmark(sized=True)(analytics)
+
+def measure(function, rounds, min_time=0.2):
+    '''Calls `function(rounds)` until the time it measures adds up to
+    `min_time` seconds, like `timeit.Timer.autorange`, or until it has
+    taken ten times that long, for benchmarks that mostly set up. Returns
+    how many operations a call did and the seconds per operation.'''
+    total_ops = total_seconds = calls = 0
+    deadline = time.perf_counter() + 10 * min_time
+    while True:
+        start = time.perf_counter()
+        ops = function(rounds)
+        seconds = time.perf_counter() - start
+        if isinstance(ops, tuple):
+            # The benchmark timed just the part that matters itself.
+            ops, seconds = ops
+        total_ops += ops
+        total_seconds += seconds
+        calls += 1
+        if total_seconds >= min_time or time.perf_counter() >= deadline:
+            return total_ops // calls, total_seconds / total_ops
+
+def run(max_rounds=100000, repeat=5, names=None, stdout=None, min_time=0.2):
+    '''Runs the benchmarks on histories of 10^3 rounds up to `max_rounds`
+    and returns the median of `repeat` runs of each, as a dict. Each run
+    lasts at least `min_time` seconds.'''
+    stdout = stdout if stdout is not None else sys.stdout
+    sizes = [10 ** exponent for exponent in range(3, 8) if 10 ** exponent <= max_rounds]
+    ct.get_knight_graph()
+    results = {}
+    for function, sized in BENCHMARKS:
+        if names and function.__name__ not in names:
+            continue
+        for rounds in sizes if sized else [None]:
+            name = function.__name__ if rounds is None else '{}[{}]'.format(function.__name__, rounds)
+            runs = [measure(function, rounds, min_time) for _ in range(repeat)]
+            ops = runs[0][0]
+            per_op = statistics.median(seconds for _, seconds in runs)
+            results[name] = {'seconds': per_op * ops, 'ops': ops, 'ns_per_op': per_op * 1e9}
+            stdout.write('{:<28} {:>12.6f} s {:>12.1f} ns/op\n'.format(name, per_op * ops, per_op * 1e9))
+    return {'python': platform.python_version(), 'machine': platform.machine(),
+            'system': platform.system(), 'seed': SEED, 'benchmarks': results}
+
+# Timings taken with another Python or on another kind of machine say
+# nothing about this one, so results are only compared if these match.
+PLATFORM_FIELDS = ('python', 'machine', 'system')
+
+def compare(results, baseline, threshold=0.2):
+    '''Returns the names of the benchmarks that are more than `threshold`
+    (a fraction) slower per operation than in `baseline`. Raises ValueError
+    if `baseline` was saved on a different platform, see `PLATFORM_FIELDS`.'''
+    for field in PLATFORM_FIELDS:
+        if field in baseline and baseline[field] != results.get(field):
+            raise ValueError('The baseline was saved with {} {}, not {}'.format(
+                field, baseline[field], results.get(field)))
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        expected = baseline['benchmarks'].get(name)
+        if expected is not None and result['ns_per_op'] > expected['ns_per_op'] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--max-rounds', type=int, default=100000,
+            help='the biggest history to benchmark, from 1000 up to 10000000 rounds')
+    parser.add_argument('--repeat', type=int, default=5, help='keep the median of this many runs')
+    parser.add_argument('--min-time', type=float, default=0.2, metavar='SECONDS',
+            help='run each benchmark for at least this long per run')
+    parser.add_argument('--only', nargs='+', metavar='NAME', help='only run these benchmarks')
+    parser.add_argument('--output', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--baseline', default=BASELINE, metavar='FILE',
+            help='compare against this baseline, saved with --save-baseline on this machine')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+            help='fail if a benchmark is this fraction slower than the baseline')
+    parser.add_argument('--startup-budget', type=float, nargs='?', const=STARTUP_BUDGET, metavar='RATIO',
+            help='only check that importing the trainer takes at most RATIO times as long as '
+                 'a bare "import cmd" (default {})'.format(STARTUP_BUDGET))
+    args = parser.parse_args(argv)
+    if args.startup_budget is not None:
+        ratio = startup_ratio()
+        print('Importing chesstrainer takes {:.2f} times as long as importing cmd, the budget is {:.2f}'.format(
+            ratio, args.startup_budget))
+        return 1 if ratio > args.startup_budget else 0
+    results = run(args.max_rounds, args.repeat, args.only, min_time=args.min_time)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Saved the baseline to {}'.format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at {} to compare against'.format(args.baseline))
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    try:
+        regressions = compare(results, baseline, args.threshold)
+    except ValueError as e:
+        print('{}: save a baseline on this machine with --save-baseline'.format(e))
+        return 1
+    for name in regressions:
+        print('Regression: {} is more than {:.0%} slower than the baseline'.format(name, args.threshold))
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
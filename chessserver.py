@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+'''Serves the chess visualization trainer's games over TCP, so that many
+players can train on one machine at once, and load tests the server with
+simulated players.
+
+    python3 chessserver.py serve --port 8765
+    python3 chessserver.py play --port 8765
+    python3 chessserver.py load --port 8765 --players 1000 --concurrency 200
+'''
+import argparse
+import asyncio
+import io
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+
+import chesstrainer as ct
+
+# Every reply from the server ends with a prompt on a line of its own, i.e.
+# "(knight)" during a game or "(chess-trainer)" between games.
+prompt_regex = re.compile(r'^\(.+\)$')
+position_regex = re.compile(r'^(\S.*) \?\s*$')
+
+MENU_PROMPT = '(chess-trainer)'
+
+def _menu():
+    names = ', '.join(ct.GAME_REGISTRY)
+    return ("Choose a game to play: {}. Enter '<game> [rounds] [board size]' or 'quit'.\n"
+            .format(names))
+
+class TrainerServer:
+    '''Plays a `chesstrainer.RandomSquareGame` per connection. The games run
+    on the event loop, apart from `postloop`, which reads the all-time
+    statistics on a thread so that it never blocks other sessions. Sessions
+    are logged by a single `chesstrainer.TrialWriter`, which groups the
+    rounds of many sessions into one append per log.
+
+    Sending "metrics" instead of a game returns the time spent in each
+    phase of every round, see `chesstrainer.Instrumentation`.
+
+    Boards can be at most `max_size` squares across. Answers on boards
+    other than 8x8 can take a while to work out, so they are graded on a
+    thread too.'''
+
+    def __init__(self, database=None, fsync=False, max_size=64):
+        self.database = database
+        self.max_size = max_size
+        self.games = {name: entry.factory for name, entry in ct.GAME_REGISTRY.items()}
+        self.log_executor = ThreadPoolExecutor()
+        self.grade_executor = ThreadPoolExecutor()
+        self.writer = ct.TrialWriter(fsync=fsync)
+        self.sessions = 0
+        # So that no session pays for working out an 8x8 answer.
+        for game in ct.GAMES:
+            ct.ANSWER_CACHE.warm(game())
+
+    def close(self):
+        '''Writes every session played so far to the logs.'''
+        self.writer.close()
+        self.grade_executor.shutdown()
+        self.log_executor.shutdown()
+
+    async def handle(self, reader, writer):
+        try:
+            writer.write((_menu() + MENU_PROMPT + '\n').encode())
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = line.decode().split()
+                if not args:
+                    reply = ''
+                elif args[0] == 'quit':
+                    break
+                elif args[0] == 'metrics':
+                    reply = ct.INSTRUMENTS.to_prometheus()
+                elif args[0] not in self.games:
+                    reply = 'Game "{}" does not exist. '.format(args[0]) + _menu()
+                else:
+                    try:
+                        game = self._new_game(args)
+                    except (ValueError, AssertionError) as e:
+                        reply = 'Bad arguments: {}\n'.format(e)
+                    else:
+                        finished = await self.play(game, reader, writer)
+                        if not finished:
+                            break
+                        reply = ''
+                writer.write((reply + MENU_PROMPT + '\n').encode())
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _new_game(self, args):
+        kwargs = {'database': self.database, 'writer': self.writer}
+        if len(args) > 1:
+            kwargs['rounds'] = int(args[1])
+        if len(args) > 2:
+            kwargs['size'] = int(args[2])
+            if kwargs['size'] > self.max_size:
+                raise ValueError('Board size must be at most {}'.format(self.max_size))
+        return self.games[args[0]](**kwargs)
+
+    async def play(self, game, reader, writer):
+        '''Plays one session of `game` over the connection, like
+        `cmd.Cmd.cmdloop` would. Returns False if the player disconnected.'''
+        output = io.StringIO()
+        game.stdout = output
+        game.preloop()
+        output.write(str(game.intro) + '\n')
+        stop = False
+        while not stop:
+            output.write(game.prompt + '\n')
+            writer.write(output.getvalue().encode())
+            output.seek(0)
+            output.truncate()
+            await writer.drain()
+            line = await reader.readline()
+            if not line:
+                return False
+            line = line.decode().rstrip('\r\n')
+            line = game.precmd(line)
+            if game.size == 8:
+                stop = game.onecmd(line)
+                stop = game.postcmd(stop, line)
+            else:
+                stop = await asyncio.get_running_loop().run_in_executor(
+                        self.grade_executor, lambda: game.postcmd(game.onecmd(line), line))
+        await asyncio.get_running_loop().run_in_executor(self.log_executor, game.postloop)
+        writer.write(output.getvalue().encode())
+        self.sessions += 1
+        return True
+
+async def serve(host, port, database=None, fsync=False, max_size=64):
+    trainer = TrainerServer(database, fsync, max_size)
+    server = await asyncio.start_server(trainer.handle, host, port)
+    addresses = ', '.join(str(sock.getsockname()) for sock in server.sockets)
+    print('Serving the chess trainer on {}'.format(addresses))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        trainer.close()
+
+async def read_reply(reader):
+    '''Returns the lines the server sent up to and including its next prompt.'''
+    lines = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('The server closed the connection')
+        line = line.decode().rstrip('\n')
+        lines.append(line)
+        if prompt_regex.match(line):
+            return lines
+
+def _find_position(lines):
+    for line in reversed(lines):
+        match = position_regex.match(line)
+        if match:
+            return match.group(1)
+    raise ValueError('No position in {}'.format(lines))
+
+async def play_interactively(host, port):
+    '''A minimal client: prints what the server sends and sends what you type.'''
+    reader, writer = await asyncio.open_connection(host, port)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            lines = await read_reply(reader)
+            sys.stdout.write('\n'.join(lines[:-1]) + '\n' + lines[-1] + ' ')
+            sys.stdout.flush()
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                line = 'quit\n'
+            writer.write(line.encode())
+            if line.strip() == 'quit':
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def simulate_player(host, port, game_class, rounds, accuracy, rng, latencies, size=8):
+    '''Connects and plays one session of `game_class`, answering correctly
+    with probability `accuracy`. Appends the time from sending each answer
+    to getting the reply to `latencies`.'''
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        await read_reply(reader)
+        writer.write('{} {} {}\n'.format(game_class.prompt.strip('()'), rounds, size).encode())
+        lines = await read_reply(reader)
+        game = game_class(size=size)
+        for _ in range(rounds):
+            position = _find_position(lines)
+            if rng.random() < accuracy:
+                answer = game.get_correct_answer(position)
+            else:
+                answer = game.get_correct_answer(game.get_random_position())
+            start = time.perf_counter()
+            writer.write((ct.format_answer(answer) + '\n').encode())
+            lines = await read_reply(reader)
+            latencies.append(time.perf_counter() - start)
+        writer.write(b'quit\n')
+    finally:
+        writer.close()
+
+async def generate_load(host, port, players, concurrency, rounds, accuracy, seed=0, size=8):
+    '''Plays `players` sessions against the server, at most `concurrency` at
+    a time, and returns a dict describing throughput and latency.'''
+    rng = Random(seed)
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def player(game_class, player_rng):
+        nonlocal failures
+        async with semaphore:
+            try:
+                await simulate_player(host, port, game_class, rounds, accuracy, player_rng, latencies, size)
+            except (ConnectionError, OSError, ValueError):
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(player(rng.choice(ct.GAMES), Random(rng.random())) for _ in range(players)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def percentile(percent):
+        if not latencies:
+            return 0.0
+        return latencies[min(int(len(latencies) * percent / 100.0), len(latencies) - 1)]
+    return {'sessions': players - failures, 'failures': failures, 'seconds': elapsed,
+            'sessions_per_second': (players - failures) / elapsed,
+            'rounds_per_second': len(latencies) / elapsed,
+            'p50_ms': percentile(50) * 1000, 'p90_ms': percentile(90) * 1000,
+            'p99_ms': percentile(99) * 1000}
+
+def print_load_report(report):
+    print('Sessions: {} ({} failed) in {:.2f} seconds'.format(report['sessions'], report['failures'], report['seconds']))
+    print('Sessions per second: {:.1f}'.format(report['sessions_per_second']))
+    print('Rounds per second: {:.1f}'.format(report['rounds_per_second']))
+    print('Round trip latency in ms: 50% {:.2f}, 90% {:.2f}, 99% {:.2f}'.format(
+        report['p50_ms'], report['p90_ms'], report['p99_ms']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='run the server')
+    serve_parser.add_argument('--database', help='keep the history of every game in this SQLite database')
+    serve_parser.add_argument('--fsync', action='store_true', help='sync every write to the history to disk')
+    serve_parser.add_argument('--max-size', type=int, default=64, help='the biggest board players can ask for')
+    commands.add_parser('play', help='play on a running server')
+    load_parser = commands.add_parser('load', help='load test a running server with simulated players')
+    load_parser.add_argument('--players', type=int, default=100)
+    load_parser.add_argument('--concurrency', type=int, default=100)
+    load_parser.add_argument('--rounds', type=int, default=5)
+    load_parser.add_argument('--accuracy', type=float, default=0.8)
+    load_parser.add_argument('--size', type=int, default=8)
+    load_parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'serve':
+            asyncio.run(serve(args.host, args.port, args.database, args.fsync, args.max_size))
+        elif args.command == 'play':
+            asyncio.run(play_interactively(args.host, args.port))
+        else:
+            print_load_report(asyncio.run(generate_load(args.host, args.port, args.players,
+                args.concurrency, args.rounds, args.accuracy, args.seed, args.size)))
+    except KeyboardInterrupt:
+        print('')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+'''Simulates players going through the trainer's games end to end, through
+the real `cmd.Cmd` loop, from the intro to the statistics that are logged
+and printed when a session finishes, and reports how fast it went.
+
+    python3 chesssim.py --sessions 2000 --rounds 5 --accuracy 0.8
+    python3 chesssim.py --sessions 20000 --workers 4 --game knight --database history.db
+'''
+import argparse
+import io
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import chesstrainer as ct
+
+GAMES = {name: entry.factory for name, entry in ct.GAME_REGISTRY.items()}
+
+class RandomPlayer:
+    '''Answers correctly with probability `accuracy`, after thinking for an
+    exponentially distributed time averaging `latency` seconds.'''
+
+    def __init__(self, accuracy=0.8, latency=0.0, rng=None):
+        self.accuracy = accuracy
+        self.latency = latency
+        self.rng = rng if rng is not None else random.Random()
+
+    def answer(self, game):
+        if self.latency:
+            time.sleep(self.rng.expovariate(1.0 / self.latency))
+        if self.rng.random() < self.accuracy:
+            return ct.format_answer(game.get_correct_answer(game.cur_pos))
+        return ct.format_answer(game.get_correct_answer(game.get_random_position()))
+
+class ScriptedPlayer:
+    '''Types `lines` in order, then ends the input.'''
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+
+    def answer(self, game):
+        return next(self.lines, None)
+
+class PlayerInput:
+    '''A file-like `stdin` for a game that asks `player` for each line, so
+    the player can see the position the game is asking about.'''
+
+    def __init__(self, game, player):
+        self.game = game
+        self.player = player
+        self.lines = 0
+
+    def readline(self):
+        line = self.player.answer(self.game)
+        if line is None:
+            return ''
+        self.lines += 1
+        return line + '\n'
+
+def play_session(game_class, player, rounds=5, size=8, database=None, directory='', rng=None):
+    '''Plays one session of `game_class` with `player` through
+    `cmd.Cmd.cmdloop` and returns the game. The game chooses its positions
+    with `rng` and keeps its log in `directory`.'''
+    game = game_class(rounds=rounds, size=size, database=database, rng=rng, directory=directory,
+                      stdout=io.StringIO())
+    game.stdin = PlayerInput(game, player)
+    game.use_rawinput = False
+    game.cmdloop()
+    return game
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+def simulate_sessions(first, count, games, rounds=5, size=8, accuracy=0.8, latency=0.0,
+                      seed=0, database=None, directory='.'):
+    '''Plays sessions `first` to `first + count` in this process. Session
+    `n` is seeded with `seed` and `n`, so it plays out the same wherever it
+    runs. Returns (sessions, rounds, failures, peak RSS in MB).'''
+    played = rounds_played = failures = 0
+    if database is not None:
+        database = os.path.join(directory, database)
+    for session in range(first, first + count):
+        rng = random.Random('{}-{}'.format(seed, session))
+        game_class = GAMES[rng.choice(games)]
+        try:
+            game = play_session(game_class, RandomPlayer(accuracy, latency, rng), rounds, size, database,
+                                directory, rng)
+        except Exception as e:
+            failures += 1
+            sys.stderr.write('Session {} failed: {!r}\n'.format(session, e))
+            continue
+        played += 1
+        rounds_played += len(game.round_results)
+    return played, rounds_played, failures, _peak_rss_mb()
+
+def _simulate_chunk(job):
+    return simulate_sessions(*job[0], **job[1])
+
+def simulate(sessions, games=None, rounds=5, size=8, accuracy=0.8, latency=0.0, seed=0,
+             database=None, directory='.', workers=0):
+    '''Plays `sessions` sessions of randomly chosen `games`, in this process
+    if `workers` is 0 and in a pool of `workers` processes otherwise, and
+    returns a dict describing throughput and memory use.'''
+    games = list(games or GAMES)
+    kwargs = {'games': games, 'rounds': rounds, 'size': size, 'accuracy': accuracy,
+              'latency': latency, 'seed': seed, 'database': database, 'directory': directory}
+    start = time.perf_counter()
+    if not workers:
+        results = [simulate_sessions(0, sessions, **kwargs)]
+    else:
+        chunk = max(sessions // (workers * 4), 1)
+        jobs = [((first, min(chunk, sessions - first)), kwargs) for first in range(0, sessions, chunk)]
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(_simulate_chunk, jobs))
+    elapsed = time.perf_counter() - start
+    played = sum(result[0] for result in results)
+    rounds_played = sum(result[1] for result in results)
+    return {'sessions': played, 'failures': sum(result[2] for result in results),
+            'rounds': rounds_played, 'seconds': elapsed,
+            'sessions_per_second': played / elapsed, 'rounds_per_second': rounds_played / elapsed,
+            'peak_rss_mb': max(max(result[3] for result in results), _peak_rss_mb())}
+
+def print_report(report):
+    print('Sessions: {} ({} failed), {} rounds in {:.2f} seconds'.format(
+        report['sessions'], report['failures'], report['rounds'], report['seconds']))
+    print('Sessions per second: {:.1f}'.format(report['sessions_per_second']))
+    print('Rounds per second: {:.1f}'.format(report['rounds_per_second']))
+    print('Peak RSS of a process in MB: {:.1f}'.format(report['peak_rss_mb']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--game', action='append', choices=sorted(GAMES),
+            help='play only this game; can be given more than once')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--size', type=int, default=8)
+    parser.add_argument('--accuracy', type=float, default=0.8)
+    parser.add_argument('--latency', type=float, default=0.0, help="the players' average thinking time in seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=0, help='processes to play in; 0 plays in this one')
+    parser.add_argument('--database', help='log to this SQLite database instead of trial log files')
+    parser.add_argument('--directory', help='where to write the logs; a temporary directory by default')
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = os.path.abspath(args.directory or temporary_directory)
+        print_report(simulate(args.sessions, args.game, args.rounds, args.size, args.accuracy,
+            args.latency, args.seed, args.database, directory, args.workers))
+
+if __name__ == "__main__":
+    main()
@@ -1,276 +1,2346 @@
 #!/usr/bin/env python3
 import cmd
 import re
-import csv
+import math
 import os
+import struct
 import sys
-from queue import PriorityQueue as _PriorityQueue
-from collections import namedtuple, defaultdict
-from random import randint
-from datetime import datetime
-
-mv_regex = "[a|b|c|d|e|f|g|h]:[1-8]"
-move_regex = re.compile(mv_regex)
-clor_regex = 'w|b'
-color_regex = re.compile(clor_regex)
+import time
+from _thread import allocate_lock
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from functools import wraps
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+# contextlib, csv, datetime, gzip, json, mmap, queue, random, sqlite3,
+# threading and concurrent.futures are only imported by the code that needs
+# them, so that the trainer starts quickly. cmd already imports the rest.
+
+def contextmanager(function):
+    '''`contextlib.contextmanager`, but contextlib is imported the first time
+    the context manager is used.'''
+    manager = None
+    @wraps(function)
+    def helper(*args, **kwargs):
+        nonlocal manager
+        if manager is None:
+            import contextlib
+            manager = contextlib.contextmanager(function)
+        return manager(*args, **kwargs)
+    return helper
+
+# Any square a player might type, i.e. "e4", "e:4" or "E4", see `SquareCodec`
+square_regex = re.compile(r'([a-zA-Z]+):?([0-9]+)')
+# What a player may type for a color -> the color
+COLOR_CODES = {'w': 'w', 'b': 'b', 'W': 'w', 'B': 'b'}
 
 chess_notation = {1:'a', 2:'b', 3:'c', 4:'d', 5:'e', 6:'f', 7:'g', 8:'h'}
 chess_notation_backwards = {value:key for key,value in chess_notation.items()}
 
-def get_random_position(xmin=1,xmax=8,ymin=1,ymax=8):
+def get_random_position(xmin=1,xmax=None,ymin=1,ymax=None,size=8,rng=None):
     '''Returns a random position on a chessboard as a string, i.e. "a:1".
     Use the parameters to constrain the random position to a certain part of the board,
     i.e. xmin=1, xmax=1 would contrain the random position to just the a file.
     :param int xmin: The minimum board position that the x-axis can be (defaults to 1) 
-    :param int xmax: The maximum board position that the x-axis can be (defaults to 8)
+    :param int xmax: The maximum board position that the x-axis can be (defaults to size)
     :param int ymin: The minimum board position that the y-axis can be (defaults to 1)
-    :param int ymax: The maximum board position that the x-axis can be (defaults to 8)
+    :param int ymax: The maximum board position that the x-axis can be (defaults to size)
+    :param int size: The number of files and ranks on the board (defaults to 8)
+    :param rng: The `random.Random` to choose with (defaults to the `random` module)
     '''
-    assert 1<=xmin and xmin<=8
-    assert 1<=xmax and xmax<=8
-    assert 1<=ymin and ymin<=8
-    assert 1<=ymax and ymax<=8
-
-    letter = randint(xmin,xmax)
-    number = randint(ymin,ymax)
+    if xmax is None:
+        xmax = size
+    if ymax is None:
+        ymax = size
+    assert 1<=xmin and xmin<=size
+    assert 1<=xmax and xmax<=size
+    assert 1<=ymin and ymin<=size
+    assert 1<=ymax and ymax<=size
+
+    if rng is None:
+        import random as rng
+    letter = rng.randint(xmin,xmax)
+    number = rng.randint(ymin,ymax)
+    if size == 8:
+        return SQUARE_NAMES[get_square_index(letter, number)]
     return get_chess_notation(letter, number)
 
-class Node:
-    '''A single square on a chess board.'''
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-        self.distance = float("inf")
-        # length of route
-        self.route =  []
-        # i.e. ["a:1","b:2"...]
-        self.name = get_chess_notation(x, y) 
-        # i.e. "a:1"
+def get_file_name(x):
+    '''1 -> "a", 8 -> "h", 26 -> "z", 27 -> "aa" ... for boards bigger than 8x8'''
+    if x in chess_notation:
+        return chess_notation[x]
+    if x < 1:
+        raise KeyError(x)
+    letters = ''
+    while x:
+        x, remainder = divmod(x - 1, 26)
+        letters = chr(ord('a') + remainder) + letters
+    return letters
+
+def get_file_number(letters):
+    '''"a" -> 1, "h" -> 8, "aa" -> 27'''
+    if letters in chess_notation_backwards:
+        return chess_notation_backwards[letters]
+    if not letters or not ('a' <= min(letters) and max(letters) <= 'z'):
+        raise KeyError(letters)
+    x = 0
+    for letter in letters:
+        x = x * 26 + ord(letter) - ord('a') + 1
+    return x
 
-    def __eq__(self, other):
-        return other.name == self.name
-    
-    @classmethod
-    def from_chess_name(cls, name):
-        return Node(*get_num_notation(name))
+def get_chess_notation(x, y):
+    '''i.e. x=1, y=1 would return "a:1"'''
+    return "{}:{}".format(get_file_name(x), str(y))
 
-def generate_graph():
-    '''Generates all the nodes on a chess board.'''
-    for x in range(1,9):
-        for y in range(1,9):
-            yield Node(x,y)
+def square_exists(x,y,size=8):
+    result = (1<=x<=size) and (1<=y<=size)
+    return result
 
-def generate_knight_neighbors(x,y):
-    directions = ((1, 2),(-1, 2),(2, 1),(-2, 1),
-             (1, -2),(-1, -2),(2, -1),(-2, -1))
-    for direction in directions:
-        square = x+direction[0], y+direction[1]
-        if square_exists(*square):
-            yield get_chess_notation(*square)
-
-class PriorityQueue(_PriorityQueue):
-    '''queue.PriorityQueue with a 'contains' method'''
-
-    def _find(self, item):
-        index = None
-        for _index, _item_tuple in enumerate(self.queue):
-            old_priority, _item = _item_tuple
-            if _item == item:
-                index = _index
-                break
-        return index
+def _walk_path(x,y,xi,yi,size=8):
+    curx, cury = x+xi,y+yi
+    while square_exists(curx,cury,size):
+        yield curx,cury
+        curx+=xi
+        cury+=yi
+
+# The core of the trainer works on squares as indexes 0-63 and on sets of
+# squares as 64-bit bitboards, where bit `index` is set if the square is in
+# the set. Chess notation ("a:1") is only used to talk to the player.
+
+def get_square_index(x, y):
+    '''(1,1) -> 0, (8,1) -> 7, (1,2) -> 8 ... (8,8) -> 63'''
+    return (y - 1) * 8 + (x - 1)
+
+def get_square_coordinates(index):
+    '''0 -> (1,1), 63 -> (8,8)'''
+    return index % 8 + 1, index // 8 + 1
 
-    def __contains__(self, item):
-        index = self._find(item) 
-        return index is not None 
+SQUARE_NAMES = tuple(get_chess_notation(*get_square_coordinates(index)) for index in range(64))
+SQUARE_INDEXES = {name: index for index, name in enumerate(SQUARE_NAMES)}
+COLOR_NAMES = ('b', 'w')
 
-class KeyBasedDefaultDict(defaultdict):
-    def __missing__(self, key):
-        if self.default_factory is None:
-            raise KeyError(key)
-        self[key] = self.default_factory(key)
-        return self[key]
+KNIGHT_DIRECTIONS = ((1, 2),(-1, 2),(2, 1),(-2, 1),
+        (1, -2),(-1, -2),(2, -1),(-2, -1))
+DIAGONAL_DIRECTIONS = ((1,1), (-1,1), (1,-1),(-1,-1))
+STRAIGHT_DIRECTIONS = ((0,1), (0,-1), (1,0), (-1,0))
+KING_DIRECTIONS = DIAGONAL_DIRECTIONS + STRAIGHT_DIRECTIONS
 
-def find_shortest_path_for_knight(start_position,end_position):
+def get_num_notation(position):
+    '''"a:1" -> (1,1)'''
+    square = get_tables()['SQUARES_BY_NAME'].get(position)
+    if square is not None:
+        return square.coordinates
+    letters, number = position.split(':')
+    if not number.isdigit():
+        raise ValueError(position)
+    return get_file_number(letters), int(number)
+
+def get_square_id(position, size=8):
+    '''Like `get_square_index`, but for a board of any size: "a:1" -> 0'''
+    if size == 8:
+        return SQUARE_INDEXES[position]
+    try:
+        return get_codec(size).parse_square(position)
+    except BadFormatError:
+        raise ValueError(position) from None
+
+def get_square_name(square_id, size=8):
+    '''The reverse of `get_square_id`: 0 -> "a:1"'''
+    if size == 8:
+        return SQUARE_NAMES[square_id]
+    y, x = divmod(square_id, size)
+    return get_chess_notation(x + 1, y + 1)
+
+def iter_bits(bitboard):
+    '''Yields the index of every square in `bitboard`, lowest first.'''
+    while bitboard:
+        lowest = bitboard & -bitboard
+        yield lowest.bit_length() - 1
+        bitboard ^= lowest
+
+def square_color(index):
+    '''Returns 1 if the square is white and 0 if it is black.'''
+    return ((index >> 3) + index) & 1
+
+def brother_square(index):
+    '''Returns the square mirrored through the centre of the board.'''
+    return 63 - index
+
+def _jump_bitboard(index, directions):
+    x, y = get_square_coordinates(index)
+    bitboard = 0
+    for xi, yi in directions:
+        if square_exists(x + xi, y + yi):
+            bitboard |= 1 << get_square_index(x + xi, y + yi)
+    return bitboard
+
+def _ray_bitboard(index, direction):
+    x, y = get_square_coordinates(index)
+    bitboard = 0
+    for square in _walk_path(x, y, *direction):
+        bitboard |= 1 << get_square_index(*square)
+    return bitboard
+
+def _slide_bitboards(rays, directions):
+    return tuple(sum(rays[direction][index] for direction in directions) for index in range(64))
+
+# Move tables: every square a piece attacks from each square of an otherwise
+# empty board. RAYS[direction][index] holds a single sliding direction,
+# ATTACKED_SQUARE_NAMES the tables as sorted square names, which is how the
+# games answer. They and the 64 `Square`s are built the first time any of
+# them is used rather than on import, see `get_tables`.
+TABLE_NAMES = ('RAYS', 'KNIGHT_ATTACKS', 'KING_ATTACKS', 'BISHOP_ATTACKS', 'ROOK_ATTACKS',
+        'QUEEN_ATTACKS', 'PIECE_ATTACKS', 'ATTACKED_SQUARE_NAMES', 'SQUARES', 'SQUARES_BY_NAME')
+_tables = None
+_tables_lock = allocate_lock()
+
+def get_tables():
+    '''Returns a dict of the tables in `TABLE_NAMES`, i.e.
+    get_tables()['KNIGHT_ATTACKS'], which is also `chesstrainer.KNIGHT_ATTACKS`.'''
+    global _tables
+    if _tables is None:
+        # Squares are compared by identity, so only one thread builds them.
+        with _tables_lock:
+            if _tables is None:
+                _tables = _build_tables()
+    return _tables
+
+def _build_tables():
+    rays = {direction: tuple(_ray_bitboard(index, direction) for index in range(64))
+            for direction in KING_DIRECTIONS}
+    knight = tuple(_jump_bitboard(index, KNIGHT_DIRECTIONS) for index in range(64))
+    king = tuple(_jump_bitboard(index, KING_DIRECTIONS) for index in range(64))
+    bishop = _slide_bitboards(rays, DIAGONAL_DIRECTIONS)
+    rook = _slide_bitboards(rays, STRAIGHT_DIRECTIONS)
+    queen = tuple(diagonals | lines for diagonals, lines in zip(bishop, rook))
+    attacks = {'knight': knight, 'king': king, 'bishop': bishop, 'rook': rook, 'queen': queen}
+    names = {piece: tuple(tuple(sorted(SQUARE_NAMES[square] for square in iter_bits(bitboard)))
+            for bitboard in bitboards) for piece, bitboards in attacks.items()}
+    squares = tuple(Square(index) for index in range(64))
+    for square in squares:
+        square._link(squares, knight)
+    return {'RAYS': rays, 'KNIGHT_ATTACKS': knight, 'KING_ATTACKS': king, 'BISHOP_ATTACKS': bishop,
+            'ROOK_ATTACKS': rook, 'QUEEN_ATTACKS': queen, 'PIECE_ATTACKS': attacks,
+            'ATTACKED_SQUARE_NAMES': names, 'SQUARES': squares,
+            'SQUARES_BY_NAME': {square.name: square for square in squares}}
+
+def __getattr__(name):
+    if name in TABLE_NAMES:
+        return get_tables()[name]
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+# How each piece moves on boards that are not 8x8: (directions, slides)
+PIECE_DIRECTIONS = {'knight': (KNIGHT_DIRECTIONS, False), 'king': (KING_DIRECTIONS, False),
+        'bishop': (DIAGONAL_DIRECTIONS, True), 'rook': (STRAIGHT_DIRECTIONS, True),
+        'queen': (KING_DIRECTIONS, True)}
+
+def get_attacked_squares(piece, position, size=8):
+    '''Returns the sorted squares `piece` attacks from `position` on an empty
+    board, i.e. "rook", "a:1" -> ["a:2", ... "a:8", "b:1", ... "h:1"]'''
+    if size == 8:
+        return list(get_tables()['ATTACKED_SQUARE_NAMES'][piece][SQUARE_INDEXES[position]])
+    x, y = get_num_notation(position)
+    directions, slides = PIECE_DIRECTIONS[piece]
+    squares = []
+    for xi, yi in directions:
+        if slides:
+            squares.extend(_walk_path(x, y, xi, yi, size))
+        elif square_exists(x + xi, y + yi, size):
+            squares.append((x + xi, y + yi))
+    return sorted(get_chess_notation(*square) for square in squares)
+
+class Square:
+    '''A square of an 8x8 board. There are exactly 64 of them, in `SQUARES`,
+    so squares can be compared by identity and everything about a square is
+    worked out once: its index, coordinates, name, color, brother square and
+    the squares a knight on it attacks. Squares are immutable.'''
+    __slots__ = ('index', 'x', 'y', 'coordinates', 'name', 'color', 'brother', 'knight_moves')
+
+    def __init__(self, index):
+        x, y = get_square_coordinates(index)
+        for name, value in (('index', index), ('x', x), ('y', y), ('coordinates', (x, y)),
+                ('name', SQUARE_NAMES[index]), ('color', COLOR_NAMES[square_color(index)])):
+            object.__setattr__(self, name, value)
+
+    def _link(self, squares, knight_attacks):
+        # The other squares only exist once all 64 have been made.
+        object.__setattr__(self, 'brother', squares[brother_square(self.index)])
+        object.__setattr__(self, 'knight_moves', tuple(squares[index] for index in iter_bits(knight_attacks[self.index])))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Squares are immutable')
+
+    def __reduce__(self):
+        # Unpickles to the same instance.
+        return (get_square, (self.name,))
+
+    def __repr__(self):
+        return 'Square({!r})'.format(self.name)
+
+def get_square(position):
+    '''"a:1" -> SQUARES[0]'''
+    return get_tables()['SQUARES_BY_NAME'][position]
+
+class SquareCodec:
+    '''Converts between square ids (see `get_square_id`) and what a player
+    types on a `size` x `size` board. Every way of writing a square, "e:4",
+    "e4", "E:4" and "E4", is a key of one dict, so parsing an answer is a
+    lookup per square. Boards bigger than `prefill` fill the dict with the
+    squares that are actually typed instead, so that it stays small.'''
+    prefill = 64
+
+    def __init__(self, size=8):
+        self.size = size
+        self.ids = {}
+        if size <= self.prefill:
+            self.names = tuple(get_square_name(square_id, size) for square_id in range(size * size))
+            for square_id, name in enumerate(self.names):
+                letters, number = name.split(':')
+                for spelling in (name, letters + number, letters.upper() + ':' + number, letters.upper() + number):
+                    self.ids[spelling] = square_id
+        else:
+            self.names = None
+
+    def name(self, square_id):
+        '''0 -> "a:1"'''
+        if self.names is not None:
+            return self.names[square_id]
+        return get_square_name(square_id, self.size)
+
+    def parse_square(self, token):
+        '''"e4", "E:4" ... -> the id of e:4. Raises BadFormatError saying
+        what is wrong with `token` if it is not a square on the board.'''
+        square_id = self.ids.get(token)
+        if square_id is None:
+            square_id = self._parse(token)
+        return square_id
+
+    def parse_squares(self, tokens):
+        '''Parses a line of squares, or a list of its words, into a list of
+        square ids. See `parse_square`.'''
+        if isinstance(tokens, str):
+            tokens = tokens.split()
+        ids = self.ids
+        try:
+            return [ids[token] for token in tokens]
+        except KeyError:
+            return [self.parse_square(token) for token in tokens]
+
+    def parse_names(self, tokens):
+        '''Like `parse_squares`, but returns the squares' names, i.e.
+        "E4 f6" -> ["e:4", "f:6"]'''
+        if isinstance(tokens, str):
+            tokens = tokens.split()
+        names = self.names
+        if names is not None:
+            ids = self.ids
+            try:
+                return [names[ids[token]] for token in tokens]
+            except KeyError:
+                pass
+        return [self.name(square_id) for square_id in self.parse_squares(tokens)]
+
+    def _parse(self, token):
+        # Not in the dict: explain why, or on a big board, add it.
+        match = square_regex.fullmatch(token)
+        if match is None or not (match.group(1).islower() or match.group(1).isupper()):
+            raise BadFormatError('Squares must look like "e4" or "e:4". You gave {}\n'.format(token))
+        letters, number = match.groups()
+        if get_file_number(letters.lower()) > self.size:
+            raise BadFormatError('There is no {} file on the {}x{} board. You gave {}\n'.format(
+                letters.lower(), self.size, self.size, token))
+        if number.startswith('0') or int(number) > self.size:
+            raise BadFormatError('There is no rank {} on the {}x{} board. You gave {}\n'.format(
+                number, self.size, self.size, token))
+        square_id = (int(number) - 1) * self.size + get_file_number(letters.lower()) - 1
+        self.ids[token] = square_id
+        return square_id
+
+_codecs = {}
+
+def get_codec(size=8):
+    '''Returns the shared `SquareCodec` of `size` x `size` boards.'''
+    codec = _codecs.get(size)
+    if codec is None:
+        codec = _codecs[size] = SquareCodec(size)
+    return codec
+
+def parse_color(token):
+    '''"w" or "W" -> "w", "b" or "B" -> "b". Raises BadFormatError otherwise.'''
+    color = COLOR_CODES.get(token)
+    if color is None:
+        raise BadFormatError("Color must be 'w' or 'b'. You gave {}\n".format(token))
+    return color
+
+def generate_knight_neighbors(x,y):
+    for square in get_tables()['SQUARES'][get_square_index(x, y)].knight_moves:
+        yield square.name
+
+class KnightGraph:
+    '''All-pairs shortest knight distances on a chess board, computed once.
+
+    ``distance[a][b]`` is the number of knight moves from square ``a`` to
+    square ``b``, ``next_hop[a][b]`` is the square a knight on ``a`` should
+    jump to next to reach ``b`` in that many moves and ``path_count[a][b]`` is
+    how many different shortest routes there are. Squares are indexed 0-63
+    (see `get_square_index`) and ``neighbors[a]`` are the squares a knight on
+    ``a`` attacks.
+
+    Grouping squares by their distance to a target gives layers of a
+    directed acyclic graph: every shortest route moves from one layer to the
+    next one down, which is what `count`, `paths` and `is_shortest_path` use.
+    '''
+    def __init__(self):
+        self.neighbors = tuple(tuple(move.index for move in square.knight_moves) for square in get_tables()['SQUARES'])
+        self.distance = [[-1] * 64 for _ in range(64)]
+        self.next_hop = [[-1] * 64 for _ in range(64)]
+        self.path_count = [[0] * 64 for _ in range(64)]
+        for target in range(64):
+            self._breadth_first_search(target)
+
+    def _breadth_first_search(self, target):
+        # The knight graph is undirected, so searching outwards from the
+        # target gives every square's distance *to* the target, and the square
+        # each one was discovered from is its next hop towards the target.
+        self.distance[target][target] = 0
+        self.next_hop[target][target] = target
+        self.path_count[target][target] = 1
+        frontier = [target]
+        while frontier:
+            next_frontier = []
+            for current in frontier:
+                steps = self.distance[current][target] + 1
+                for neighbor in self.neighbors[current]:
+                    if self.distance[neighbor][target] == -1:
+                        self.distance[neighbor][target] = steps
+                        self.next_hop[neighbor][target] = current
+                        next_frontier.append(neighbor)
+                    if self.distance[neighbor][target] == steps:
+                        self.path_count[neighbor][target] += self.path_count[current][target]
+            frontier = next_frontier
+
+    def path(self, start, end):
+        '''Returns the list of square indexes from start to end, inclusive.'''
+        route = [start]
+        next_hop = self.next_hop
+        while start != end:
+            start = next_hop[start][end]
+            route.append(start)
+        return route
+
+    def count(self, start, end):
+        '''Returns the number of different shortest routes from start to end.'''
+        return self.path_count[start][end]
+
+    def paths(self, start, end):
+        '''Lazily generates every shortest route from start to end as a list
+        of square indexes.'''
+        distance = self.distance
+        route = [start]
+        # One iterator per square on the route, over the neighbors that are a
+        # step closer to the end.
+        stack = [iter(self.neighbors[start])]
+        if start == end:
+            yield list(route)
+            return
+        while stack:
+            remaining = distance[route[-1]][end] - 1
+            for neighbor in stack[-1]:
+                if distance[neighbor][end] == remaining:
+                    break
+            else:
+                stack.pop()
+                route.pop()
+                continue
+            route.append(neighbor)
+            if neighbor == end:
+                yield list(route)
+                route.pop()
+            else:
+                stack.append(iter(self.neighbors[neighbor]))
+
+    def is_shortest_path(self, route, start, end):
+        '''Returns True if the list of square indexes `route` is a shortest
+        route from start to end.'''
+        if not route or route[0] != start or route[-1] != end:
+            return False
+        distance = self.distance
+        if len(route) != distance[start][end] + 1:
+            return False
+        knight_attacks = get_tables()['KNIGHT_ATTACKS']
+        for current, next_square in zip(route, route[1:]):
+            if not (knight_attacks[current] >> next_square) & 1:
+                return False
+        return True
+
+_knight_graph = None
+
+def get_knight_graph():
+    '''Returns the shared `KnightGraph`, building it on first use.'''
+    global _knight_graph
+    if _knight_graph is None:
+        _knight_graph = KnightGraph()
+    return _knight_graph
+
+# Boards other than 8x8 can be far too big for tables, so knight distances
+# come from the closed-form distance on an unbounded board. On any board of
+# 5x5 or bigger the edges only get in the way when a knight is stuck in a
+# corner, which is covered by searching the corner's (at most two) moves.
+
+def generate_knight_moves(x, y, size=8):
+    '''Yields the (x, y) squares a knight on (x, y) can jump to.'''
+    for xi, yi in KNIGHT_DIRECTIONS:
+        if square_exists(x + xi, y + yi, size):
+            yield x + xi, y + yi
+
+def _unbounded_knight_distance(dx, dy):
+    dx, dy = abs(dx), abs(dy)
+    if dx < dy:
+        dx, dy = dy, dx
+    if (dx, dy) == (1, 0):
+        return 3
+    if (dx, dy) == (2, 2):
+        return 4
+    delta = dx - dy
+    if dy > delta:
+        return delta - 2 * ((delta - dy) // 3)
+    return delta - 2 * ((delta - dy) // 4)
+
+def _is_corner(x, y, size):
+    return x in (1, size) and y in (1, size)
+
+def knight_distance(x1, y1, x2, y2, size=8):
+    '''Returns the minimum number of knight moves from (x1, y1) to (x2, y2)
+    on a `size` x `size` board in constant time. `size` must be at least 5.'''
+    if (x1, y1) != (x2, y2):
+        if _is_corner(x1, y1, size):
+            return 1 + min(knight_distance(x, y, x2, y2, size) for x, y in generate_knight_moves(x1, y1, size))
+        if _is_corner(x2, y2, size):
+            return 1 + min(knight_distance(x1, y1, x, y, size) for x, y in generate_knight_moves(x2, y2, size))
+    return _unbounded_knight_distance(x2 - x1, y2 - y1)
+
+def knight_path(x1, y1, x2, y2, size=8):
+    '''Returns one shortest list of (x, y) squares from (x1, y1) to (x2, y2),
+    found by always jumping to a square one move closer to the end.'''
+    route = [(x1, y1)]
+    remaining = knight_distance(x1, y1, x2, y2, size)
+    while remaining:
+        remaining -= 1
+        for x, y in generate_knight_moves(x1, y1, size):
+            if knight_distance(x, y, x2, y2, size) == remaining:
+                x1, y1 = x, y
+                break
+        route.append((x1, y1))
+    return route
+
+def find_shortest_path_for_knight(start_position,end_position,size=8):
     '''Finds *one* of the many shortest paths from start_position to end_position
     for a knight.
     :param str start_position: The starting position on a chess board, i.e. "a:1"
     :param str end_position: The end positiion on a chess board, i.e. "h:8"
+    :param int size: The number of files and ranks on the board (defaults to 8)
     Returns a route from start_position -> end_position that is one of the shortest
     (never gauranteed to be the only path)
     '''
-    queue = PriorityQueue() # distance to node, with the name, i.e. "a:1"
-    nodes = KeyBasedDefaultDict(Node.from_chess_name) # 'a:1' -> Node(1,1)
-    edge_length = 1 # 1 move
-    start_node = nodes[start_position] 
-    start_node.distance = 0
-    start_node.route = [start_node.name]
-    queue.put((start_node.distance, start_node.name))
-    
-    # A version of djikstra's algorithm
-    while not queue.empty():
-        _, cur = queue.get()
-        current = nodes[cur]
-        tentative_distance = current.distance + edge_length
-        for n in generate_knight_neighbors(current.x, current.y):
-            neighbor = nodes[n]
-            if tentative_distance < neighbor.distance:
-                if neighbor.name not in queue:
-                    neighbor.distance = tentative_distance
-                    neighbor.route = current.route + [neighbor.name]
-                    queue.put((neighbor.distance, neighbor.name))
-    
-    return nodes[end_position].route
-
-def is_a_shortest_path_for_knight(path, a_shortest_path):
+    if size != 8:
+        route = knight_path(*get_num_notation(start_position), *get_num_notation(end_position), size)
+        return [get_chess_notation(*square) for square in route]
+    start = SQUARE_INDEXES[start_position]
+    end = SQUARE_INDEXES[end_position]
+    route = get_knight_graph().path(start, end)
+    return [SQUARE_NAMES[index] for index in route]
+
+def get_knight_distance(start_position, end_position, size=8):
+    '''Returns the minimum number of moves a knight needs to go from
+    start_position to end_position, i.e. "a:1", "b:3" -> 1'''
+    if size != 8:
+        return knight_distance(*get_num_notation(start_position), *get_num_notation(end_position), size)
+    start = SQUARE_INDEXES[start_position]
+    end = SQUARE_INDEXES[end_position]
+    return get_knight_graph().distance[start][end]
+
+def count_shortest_paths_for_knight(start_position, end_position):
+    '''Returns how many different shortest routes a knight has from
+    start_position to end_position, without listing them.'''
+    start = SQUARE_INDEXES[start_position]
+    end = SQUARE_INDEXES[end_position]
+    return get_knight_graph().count(start, end)
+
+def generate_shortest_paths_for_knight(start_position, end_position):
+    '''Lazily yields every shortest route a knight has from start_position to
+    end_position, i.e. ['a:1', 'b:3', 'd:4'], ['a:1', 'c:2', 'd:4']'''
+    start = SQUARE_INDEXES[start_position]
+    end = SQUARE_INDEXES[end_position]
+    for route in get_knight_graph().paths(start, end):
+        yield [SQUARE_NAMES[index] for index in route]
+
+def is_a_shortest_path_for_knight(path, a_shortest_path, size=8):
     '''
     :param list(str) path: A list of chess squares along a chess board, i.e. 
         ['a:1', 'b:3', ...]
     :param list(str) a_shortest_path: A shortest path for a knight between two
         squares on a chess board. Same format as `path`
-    Returns a boolean if `path` is a shortest path.
+    :param int size: The number of files and ranks on the board (defaults to 8)
+    Returns a boolean if `path` is a shortest path between the same two squares
+    as `a_shortest_path`.
     '''
-
-    if path == a_shortest_path:
-        return True
     if len(path) != len(a_shortest_path):
         return False
-    # the lengths are the same, so now we must
-    # transverse their path and see if it exists
-    cur = path[0]
-    path_exists = True
-    for next_square in path[1:]:
-        x,y = get_num_notation(cur)
-        neighbors = tuple(generate_knight_neighbors(x,y))
-        if next_square not in neighbors:
-            path_exists = False
-            break
-        cur = next_square
-    return path_exists
+    if size != 8:
+        return _is_a_knight_route(path, a_shortest_path[0], a_shortest_path[-1], size)
+    try:
+        route = [SQUARE_INDEXES[square] for square in path]
+    except KeyError:
+        return False
+    start = SQUARE_INDEXES[a_shortest_path[0]]
+    end = SQUARE_INDEXES[a_shortest_path[-1]]
+    return get_knight_graph().is_shortest_path(route, start, end)
+
+def _is_a_knight_route(path, start, end, size):
+    # `path` is already known to have the length of a shortest route, so it is
+    # one if it is made of knight moves from start to end.
+    if path[0] != start or path[-1] != end:
+        return False
+    try:
+        route = [divmod(square_id, size) for square_id in get_codec(size).parse_squares(path)]
+    except BadFormatError:
+        return False
+    for (y1, x1), (y2, x2) in zip(route, route[1:]):
+        if {abs(x2 - x1), abs(y2 - y1)} != {1, 2}:
+            return False
+    return True
 
 def get_color(position):
-    letter,number = position.split(':')
-    number = int(number) - 1 
-    # We subtract 1 to go from chess notation to 0-7, 
-    # which is easier to use with modulo arithmetic.
-    if letter in ('a','c', 'e', 'g'):
-        initial_color = 0 # black
-    else:
-        initial_color = 1 # white
-    number_color = (initial_color + number) % 2
-    if number_color == 1:
-        return 'w'
-    return 'b'
-
-
-def get_brother_square(position):
-    letter,number = position.split(':')
-    x = chess_notation_backwards[letter]
-    y = int(number)
-
-    xbro =  -1*x + 9
-    ybro =  -1*y + 9
-    return get_chess_notation(xbro, ybro)
+    square = get_tables()['SQUARES_BY_NAME'].get(position)
+    if square is not None:
+        return square.color
+    x, y = get_num_notation(position)
+    return COLOR_NAMES[(x + y) & 1]
 
-def get_chess_notation(x, y):
-    '''i.e. x=1, y=1 would return "a:1"'''
-    return "{}:{}".format(chess_notation[x], str(y))
+def get_brother_square(position, size=8):
+    if size == 8:
+        return get_tables()['SQUARES_BY_NAME'][position].brother.name
+    x, y = get_num_notation(position)
+    return get_chess_notation(size + 1 - x, size + 1 - y)
 
-def get_num_notation(position):
-    '''"a:1" -> (1,1)'''
-    letter,number = position.split(':')
-    return chess_notation_backwards [letter], int(number)
+def get_diagonal_squares(position, size=8):
+    return get_attacked_squares('bishop', position, size)
 
-def square_exists(x,y):
-    result = (1<=x<=8) and (1<=y<=8)
-    return result
+Round = namedtuple("Round", ['number', 'correct', 'total_time', 'position', 'answer', 'utc_datetime'])
 
-def _walk_path(x,y,xi,yi):
-    curx, cury = x+xi,y+yi
-    while square_exists(curx,cury):
-        yield curx,cury
-        curx+=xi
-        cury+=yi
-    
-def _get_diagonal_squares(x,y):
-    diagonals = ((1,1), (-1,1), (1,-1),(-1,-1))
-    for direction in diagonals:
-        for square in _walk_path(x,y,*direction):
-            yield square
-
-def _to_strings(chesspath):
-    for x,y in chesspath:
-        yield "{}:{}".format(chess_notation[x],y)
-
-def get_diagonal_squares(position):
-    letter, number = position.split(":")
-    y_num = int(number)
-    x_num = chess_notation_backwards[letter]
-    diagonals = _get_diagonal_squares(x_num,y_num) 
-    as_strings = _to_strings(diagonals)
-    return sorted(as_strings)
+class LoggedRound:
+    '''A `Round` read from a `TrialLog`. Its position, answer and date are
+    only decoded when they are looked at, since decoding them costs far
+    more than reading the record, and most readers only add up whether
+    rounds were correct and how long they took. It compares equal to the
+    `Round` that was logged, and `to_round` converts it to one.'''
+    __slots__ = ('number', 'correct', 'total_time', '_start', '_end', '_timestamp', '_answer', '_size')
+
+    def __init__(self, number, correct, total_time, start, end, timestamp, answer, size=8):
+        self.number = number
+        self.correct = correct
+        self.total_time = total_time
+        self._start = start
+        self._end = end
+        self._timestamp = timestamp
+        # A copy, so that the round outlives the memory map it was read from
+        self._answer = answer
+        self._size = size
 
-Round = namedtuple("Round", ['number', 'correct', 'total_time', 'position', 'answer', 'utc_datetime'])
+    @property
+    def position(self):
+        name = get_codec(self._size).name
+        if self._end == -1:
+            return name(self._start)
+        return name(self._start) + ' ' + name(self._end)
+
+    @property
+    def answer(self):
+        return str(self._answer, 'utf-8')
+
+    @property
+    def utc_datetime(self):
+        from datetime import datetime
+        return str(datetime.fromtimestamp(self._timestamp))
+
+    def to_round(self):
+        return Round(self.number, self.correct, self.total_time, self.position, self.answer, self.utc_datetime)
+
+    def __iter__(self):
+        return iter(self.to_round())
+
+    def __len__(self):
+        return len(Round._fields)
+
+    def __getitem__(self, index):
+        return self.to_round()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, (tuple, LoggedRound)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.to_round())
+
+    def __repr__(self):
+        return 'Logged' + repr(self.to_round())
+
+class TrialLog:
+    '''An append-only binary log of `Round`s.
+
+    The file at `path` is a short header followed by fixed-width records, so
+    reading it is a memory map plus `struct` unpacking instead of parsing.
+    Positions are stored as square ids (see `get_square_id`), times as floats
+    and dates as epoch timestamps. Answers can be any length, so they are
+    appended to ``path + '.answers'`` and each record points at its answer by
+    offset and length.
+
+    `compact` moves old rounds to the log's `TrialArchive`. Each compaction
+    starts a new generation of the log, which the header and the archive
+    record, and which has its own answers file, so a log and an archive from
+    different generations are never counted together.
+    '''
+    magic = b'CVTL'
+    version = 1
+    header = struct.Struct('<4sHHQ') # magic, version, generation, board size
+    # Generations count up modulo this
+    generations = 2 ** 16
+    # number, correct, total_time, start square, end square (-1 if none),
+    # timestamp, answer offset, answer length
+    record = struct.Struct('<IB3xdqqdQI4x')
+
+    def __init__(self, path, size=8):
+        self.path = path
+        self.summary_path = path + '.summary'
+        self.lock_path = path + '.lock'
+        self.size = size
+        # Identifies the log for `TrialWriter`
+        self.key = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def __len__(self):
+        '''The number of complete records in the log, from its file size.'''
+        if not self.exists():
+            return 0
+        return (os.path.getsize(self.path) - self.header.size) // self.record.size
+
+    def generation(self, path=None):
+        '''The generation of the log, from its header. 0 if it does not exist.'''
+        try:
+            with open(path or self.path, 'rb') as f:
+                return self.header.unpack(f.read(self.header.size))[2]
+        except (OSError, struct.error):
+            return 0
+
+    def answers_path(self, generation=None):
+        '''The answers file of the log's current generation, or of `generation`.'''
+        if generation is None:
+            generation = self.generation()
+        if not generation:
+            return self.path + '.answers'
+        return '{}.answers.{}'.format(self.path, generation)
+
+    def _encode(self, round, answer_offset, answer_length):
+        squares = [get_square_id(square, self.size) for square in round.position.split()]
+        end = squares[1] if len(squares) > 1 else -1
+        from datetime import datetime
+        timestamp = datetime.fromisoformat(str(round.utc_datetime)).timestamp()
+        return self.record.pack(int(round.number), int(round.correct), float(round.total_time),
+                squares[0], end, timestamp, answer_offset, answer_length)
+
+    def _decode(self, fields, answers):
+        number, correct, total_time, start, end, timestamp, answer_offset, answer_length = fields
+        return LoggedRound(number, correct, total_time, start, end, timestamp,
+                bytes(answers[answer_offset:answer_offset + answer_length]), self.size)
+
+    @contextmanager
+    def _locked(self):
+        # An advisory lock, so that processes appending to the same log at the
+        # same time take turns.
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def append(self, rounds, fsync=False):
+        '''Appends an iterable of `Round`s to the end of the log. With
+        `fsync`, the rounds are on disk when this returns.'''
+        rounds = list(rounds)
+        with self._locked():
+            self._append(rounds, fsync)
+
+    def _append(self, rounds, fsync=False):
+        if not self.exists():
+            # A new log continues the generations of its archive, if any.
+            self._create(self.path, self.archive().generation)
+        generation = self.generation()
+        summary = self._read_summary()
+        self._write_rounds(self.path, self.answers_path(generation), rounds, fsync)
+        if summary is not None and summary.records + len(rounds) == len(self):
+            summary.update(rounds)
+            self._write_summary(summary, generation)
+        else:
+            self._rebuild_summary()
+
+    def _create(self, path, generation):
+        with open(path, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.version, generation, self.size))
+
+    def _write_rounds(self, path, answers_path, rounds, fsync=False):
+        offset = os.path.getsize(answers_path) if os.path.exists(answers_path) else 0
+        records = []
+        answers = []
+        for round in rounds:
+            answer = str(round.answer).encode('utf-8')
+            records.append(self._encode(round, offset, len(answer)))
+            answers.append(answer)
+            offset += len(answer)
+        # Answers go first so that a record never points past the end of the
+        # answers file, even if we are interrupted in between.
+        for path, data in ((answers_path, answers), (path, records)):
+            with open(path, 'ab') as f:
+                f.write(b''.join(data))
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def compact(self, before, compress=False):
+        '''Rolls the rounds played before `before` up into the log's
+        `TrialArchive` and removes them from the log. Returns the number of
+        rounds archived.
+
+        :param str before: i.e. "2020-01-02 03:04:05"
+        :param bool compress: gzip the archive.
+        '''
+        if not self.exists():
+            return 0
+        from datetime import datetime
+        cutoff = datetime.fromisoformat(before).timestamp()
+        with self._locked():
+            self._finish_compaction()
+            archive = TrialArchive.load(self.path)
+            generation = (archive.generation + 1) % self.generations
+            temporary_path = self.path + '.tmp'
+            answers_path = self.answers_path(generation)
+            # Left over from an earlier compaction that was interrupted
+            # before it was committed, or that was committed but not cleaned up.
+            previous = (archive.generation - 1) % self.generations
+            for path in (temporary_path, answers_path, self.answers_path(previous)):
+                if os.path.exists(path):
+                    os.remove(path)
+            kept = []
+            with self.view() as trials:
+                for fields in trials.fields():
+                    round = self._decode(fields, trials.answers)
+                    if fields[5] < cutoff:
+                        archive.add(round)
+                    else:
+                        kept.append(round)
+            archived = len(self) - len(kept)
+            if archived:
+                # Write the next generation of the log next to this one,
+                # commit it by saving the archive, then swap it in.
+                self._create(temporary_path, generation)
+                self._write_rounds(temporary_path, answers_path, kept)
+                archive.generation = generation
+                archive.save(compress)
+                self._swap_in(temporary_path)
+                summary = TrialSummary()
+                summary.update(kept)
+                self._write_summary(summary, generation)
+            elif compress != archive.compressed:
+                archive.save(compress)
+        return archived
+
+    def _swap_in(self, temporary_path):
+        old_answers_path = self.answers_path()
+        os.replace(temporary_path, self.path)
+        if old_answers_path != self.answers_path():
+            os.remove(old_answers_path)
+
+    def finish_compaction(self):
+        '''Waits for a compaction of the log that is under way, or finishes
+        one that was interrupted after it saved the archive.'''
+        with self._locked():
+            self._finish_compaction()
+
+    def _finish_compaction(self):
+        generation = self.archive().generation
+        if not self.exists() or self.generation() == generation:
+            return
+        temporary_path = self.path + '.tmp'
+        if self.generation(temporary_path) != generation or not os.path.exists(temporary_path):
+            raise ValueError('{} does not match its archive'.format(self.path))
+        self._swap_in(temporary_path)
+        self._rebuild_summary()
+
+    def read_with_archive(self, read):
+        '''Returns what `read()` read from the log and the log's
+        `TrialArchive`. `read` returns what it read and the generation of
+        the log it read it from. If the archive is of another generation, a
+        compaction was under way, so both are read again once it is done.'''
+        archive = self.archive()
+        result, generation = read()
+        if generation != archive.generation:
+            self.finish_compaction()
+            archive = self.archive()
+            result, generation = read()
+        return result, archive
+
+    def archive(self):
+        return TrialArchive.load(self.path)
+
+    def _read_summary(self, generation=None):
+        # Returns None unless the summary covers exactly the records in the
+        # log, and is of its generation, or of `generation` if it is given.
+        import json
+        if generation is None:
+            generation = self.generation()
+        try:
+            with open(self.summary_path, mode='r') as f:
+                data = json.load(f)
+            summary = TrialSummary.from_dict(data)
+        except (OSError, ValueError, KeyError):
+            return None
+        if summary.records != len(self) or data.get('generation', 0) != generation:
+            return None
+        return summary
+
+    def _write_summary(self, summary, generation):
+        import json
+        temporary_path = self.summary_path + '.tmp'
+        data = summary.to_dict()
+        data['generation'] = generation
+        with open(temporary_path, mode='w') as f:
+            json.dump(data, f)
+        os.replace(temporary_path, self.summary_path)
+
+    def summary(self, since=None, file=None, last=None):
+        '''Returns the `TrialSummary` of every round in the log and its
+        archive. The log's part is read from the summary file next to the
+        log, which is rebuilt if it is missing or out of date.
+
+        :param str since: Only count rounds played at or after this time,
+            i.e. "2020-01-02 03:04:05". Archived rounds are filtered by day.
+        :param str file: Only count rounds whose (first) square is on this
+            file, i.e. "e". Filtering means scanning the whole log.
+        :param int last: Only count the last `last` rounds played that are
+            still in the log.
+        '''
+        if not self.exists():
+            return TrialSummary()
+        if since is not None or file is not None or last is not None:
+            summary, archive = self.read_with_archive(lambda: self._scan_summary(since, file, last))
+        else:
+            summary, archive = self.read_with_archive(self._all_time_summary)
+        if not archive.days:
+            return summary
+        total = archive.summary(since, file, last)
+        total.merge(summary)
+        return total
+
+    def _all_time_summary(self):
+        generation = self.generation()
+        summary = self._read_summary(generation)
+        if summary is None:
+            # An append may be between writing its records and the
+            # summary. Once it is done the summary is likely up to date,
+            # so only scan the log if it still is not.
+            with self._locked():
+                summary = self._read_summary()
+                if summary is None:
+                    summary = self._rebuild_summary()
+                return summary, self.generation()
+        return summary, generation
+
+    def _scan_summary(self, since, file, last):
+        from datetime import datetime
+        earliest = datetime.fromisoformat(since).timestamp() if since is not None else None
+        x = get_file_number(file) if file is not None else None
+        summary = TrialSummary()
+        with self.view() as trials:
+            first = max(len(trials) - last, 0) if last is not None else 0
+            for fields in trials.fields(first):
+                start, timestamp = fields[3], fields[5]
+                if earliest is not None and timestamp < earliest:
+                    continue
+                if x is not None and start % self.size + 1 != x:
+                    continue
+                summary.add(self._decode(fields, trials.answers))
+            return summary, trials.generation
+
+    def rebuild_summary(self):
+        '''Recomputes the summary file from every record in the log.'''
+        with self._locked():
+            return self._rebuild_summary()
+
+    def _rebuild_summary(self):
+        summary = TrialSummary()
+        with self.view() as trials:
+            summary.update(trials)
+            generation = trials.generation
+        self._write_summary(summary, generation)
+        return summary
+
+    def verify_summary(self):
+        '''Returns True if the summary file matches the records in the log.'''
+        summary = self._read_summary()
+        if summary is None:
+            return False
+        expected = TrialSummary()
+        with self.view() as trials:
+            expected.update(trials)
+        return summary == expected
+
+    @contextmanager
+    def view(self):
+        '''Memory maps the log and yields a `TrialView` over its records. The
+        view is only valid inside the ``with`` block.'''
+        import mmap
+        while True:
+            with open(self.path, 'rb') as records_file:
+                records_map = mmap.mmap(records_file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, generation, size = self.header.unpack_from(records_map)
+            if magic != self.magic or version != self.version:
+                records_map.close()
+                raise ValueError('{} is not a version {} trial log'.format(self.path, self.version))
+            try:
+                answers_file = open(self.answers_path(generation), 'rb')
+            except FileNotFoundError:
+                # A compaction swapped in the next generation since the
+                # records were opened, and removed this one's answers.
+                records_map.close()
+                continue
+            with answers_file:
+                answers_map = None
+                if os.fstat(answers_file.fileno()).st_size:
+                    answers_map = mmap.mmap(answers_file.fileno(), 0, access=mmap.ACCESS_READ)
+            break
+        view = TrialView(self, records_map, answers_map, generation)
+        try:
+            yield view
+        finally:
+            view.release()
+            records_map.close()
+            if answers_map is not None:
+                answers_map.close()
+
+    @contextmanager
+    def archived_view(self):
+        '''Yields the `TrialArchive` and a `view` of the log, from the same
+        generation.'''
+        with self.view() as trials:
+            archive = self.archive()
+            if archive.generation == trials.generation:
+                yield archive, trials
+                return
+        self.finish_compaction()
+        with self.view() as trials:
+            yield self.archive(), trials
+
+class TrialView:
+    '''A read-only sequence of the rounds in a memory-mapped `TrialLog`, as
+    `LoggedRound`s. Nothing is copied out of the map until a record is
+    looked at.'''
+
+    def __init__(self, log, records_map, answers_map, generation=0):
+        self.log = log
+        self.generation = generation
+        records = memoryview(records_map)
+        start = log.header.size
+        # Drop a partially written record at the end of the file, if any.
+        end = start + (len(records) - start) // log.record.size * log.record.size
+        self.records = records[start:end]
+        self._memoryviews = [records, self.records]
+        self.answers = memoryview(answers_map) if answers_map is not None else memoryview(b'')
+        self._memoryviews.append(self.answers)
+
+    def __len__(self):
+        return len(self.records) // self.log.record.size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        fields = self.log.record.unpack_from(self.records, index * self.log.record.size)
+        return self.log._decode(fields, self.answers)
+
+    def fields(self, start=0):
+        '''Iterates over the raw, undecoded record tuples, from record `start` on.'''
+        if not start:
+            return self.log.record.iter_unpack(self.records)
+        return self._fields_from(start)
+
+    def _fields_from(self, start):
+        record = self.log.record
+        for index in range(start, len(self)):
+            yield record.unpack_from(self.records, index * record.size)
+
+    def __iter__(self):
+        decode = self.log._decode
+        answers = self.answers
+        for fields in self.fields():
+            yield decode(fields, answers)
+
+    def release(self):
+        for view in reversed(self._memoryviews):
+            view.release()
+
+class TrialArchive:
+    '''Per-day, per-position rollups of the rounds that have been compacted
+    out of a trial log: how many rounds, how many correct, the sum and sum
+    of squares of their answer times and a sparse `TimeHistogram`. That is
+    enough to merge them into a `TrialSummary` exactly, so all-time
+    statistics do not change when a log is compacted.
+
+    It is kept as JSON in ``log path + '.archive'``, or gzip-compressed in
+    ``log path + '.archive.gz'``.
+    '''
+    version = 1
+
+    def __init__(self, log_path=None):
+        self.path = log_path + '.archive' if log_path is not None else None
+        self.compressed = False
+        # The generation of the log these rounds were compacted out of
+        self.generation = 0
+        # day -> position -> [rounds, correct, total time, total time squared, {time bin: rounds}]
+        self.days = {}
+
+    @classmethod
+    def load(cls, log_path):
+        import gzip, json
+        archive = cls(log_path)
+        for path, opener in ((archive.path, open), (archive.path + '.gz', gzip.open)):
+            if os.path.exists(path):
+                with opener(path, 'rt') as f:
+                    data = json.load(f)
+                if data['version'] != cls.version:
+                    raise ValueError('{} is not a version {} trial archive'.format(path, cls.version))
+                archive.days = data['days']
+                archive.generation = data.get('generation', 0)
+                archive.compressed = opener is gzip.open
+        return archive
+
+    def save(self, compress=False):
+        import gzip, json
+        path, opener = (self.path + '.gz', gzip.open) if compress else (self.path, open)
+        temporary_path = path + '.tmp'
+        with opener(temporary_path, 'wt') as f:
+            json.dump({'version': self.version, 'generation': self.generation, 'days': self.days},
+                      f, separators=(',', ':'))
+        os.replace(temporary_path, path)
+        other_path = self.path if compress else self.path + '.gz'
+        if os.path.exists(other_path):
+            os.remove(other_path)
+        self.compressed = compress
+
+    def add(self, round):
+        total_time = float(round.total_time)
+        self.add_tally(str(round.utc_datetime)[:10], round.position, TimeHistogram.bin(total_time),
+                1, int(round.correct), total_time, total_time * total_time)
+
+    def add_tally(self, day, position, time_bin, count, correct, total_time, total_time_squared):
+        tally = self.days.setdefault(day, {}).setdefault(position, [0, 0, 0.0, 0.0, {}])
+        tally[0] += count
+        tally[1] += correct
+        tally[2] += total_time
+        tally[3] += total_time_squared
+        tally[4][str(time_bin)] = tally[4].get(str(time_bin), 0) + count
+
+    def day_summary(self, day, file=None):
+        '''Returns the `TrialSummary` of the rounds archived for `day`,
+        i.e. "2020-01-02", optionally only those on `file`.'''
+        summary = TrialSummary()
+        for position, (count, correct, total_time, total_time_squared, bins) in self.days[day].items():
+            if file is not None and position.split(':')[0] != file:
+                continue
+            part = TrialSummary.from_sums(count, correct, total_time, total_time_squared)
+            for time_bin, bin_count in bins.items():
+                part.histogram.counts[int(time_bin)] += bin_count
+            part.positions[position] = [count, correct, total_time]
+            summary.merge(part)
+        return summary
+
+    def summary(self, since=None, file=None, last=None):
+        '''Returns the `TrialSummary` of the archived rounds. See
+        `TrialLog.summary` for the filters.'''
+        summary = TrialSummary()
+        if last is not None:
+            return summary
+        for day in sorted(self.days):
+            if since is None or day >= since[:10]:
+                summary.merge(self.day_summary(day, file))
+        return summary
+
+class TimeHistogram:
+    '''Counts answer times in fixed bins that are evenly spaced on a log
+    scale, which gives percentiles to within a few percent in constant
+    memory. Histograms with the same bins can be added together.'''
+    minimum = 0.01 # seconds; everything faster shares the first bin
+    bins_per_decade = 20
+    decades = 6 # up to 10^4 seconds; everything slower shares the last bin
+    num_bins = decades * bins_per_decade + 2
+
+    def __init__(self, counts=None):
+        self.counts = list(counts) if counts is not None else [0] * self.num_bins
+
+    @classmethod
+    def bin(cls, seconds):
+        if seconds < cls.minimum:
+            return 0
+        return min(1 + int(math.log10(seconds / cls.minimum) * cls.bins_per_decade), cls.num_bins - 1)
+
+    def add(self, seconds, count=1):
+        self.counts[self.bin(seconds)] += count
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+
+    def percentile(self, percent):
+        '''Returns the approximate answer time that `percent` percent of
+        answers were at least as fast as.'''
+        total = sum(self.counts)
+        if not total:
+            return 0.0
+        target = total * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                break
+        if index == 0:
+            return 0.0
+        # The geometric middle of the bin
+        return self.minimum * 10 ** ((index - 0.5) / self.bins_per_decade)
+
+class TrialSummary:
+    '''Running statistics over a stream of `Round`s, in constant memory:
+    how many were answered and answered correctly, the mean and variance of
+    the answer times (by Welford's method), a `TimeHistogram` of them, and
+    tallies per position. Adding a round is O(1), so a log's summary can be
+    kept up to date as rounds are appended.'''
+
+    def __init__(self):
+        self.records = 0
+        self.num_correct = 0
+        self.mean_time = 0.0
+        # The sum of squared differences from the mean
+        self.time_m2 = 0.0
+        self.histogram = TimeHistogram()
+        # position -> [rounds, correct, total time]
+        self.positions = {}
+
+    @classmethod
+    def from_sums(cls, records, num_correct, total_time, total_time_squared):
+        '''Builds a summary from plain sums, i.e. the result of a database query.'''
+        summary = cls()
+        summary.records = records
+        summary.num_correct = num_correct
+        if records:
+            summary.mean_time = total_time / records
+            summary.time_m2 = max(total_time_squared - total_time * summary.mean_time, 0.0)
+        return summary
+
+    def add(self, round):
+        correct = int(round.correct)
+        total_time = float(round.total_time)
+        self.records += 1
+        self.num_correct += correct
+        delta = total_time - self.mean_time
+        self.mean_time += delta / self.records
+        self.time_m2 += delta * (total_time - self.mean_time)
+        self.histogram.add(total_time)
+        tally = self.positions.setdefault(round.position, [0, 0, 0.0])
+        tally[0] += 1
+        tally[1] += correct
+        tally[2] += total_time
+
+    def update(self, rounds):
+        for round in rounds:
+            self.add(round)
+
+    def merge(self, other):
+        '''Adds the rounds summarized by `other` to this summary.'''
+        records = self.records + other.records
+        if not records:
+            return
+        delta = other.mean_time - self.mean_time
+        self.time_m2 += other.time_m2 + delta * delta * self.records * other.records / records
+        self.mean_time += delta * other.records / records
+        self.records = records
+        self.num_correct += other.num_correct
+        self.histogram.merge(other.histogram)
+        for position, (count, correct, total_time) in other.positions.items():
+            tally = self.positions.setdefault(position, [0, 0, 0.0])
+            tally[0] += count
+            tally[1] += correct
+            tally[2] += total_time
+
+    def statistics(self):
+        '''Returns the statistics `RandomSquareGame.print_statistics` shows.'''
+        num_results = self.records
+        if not num_results:
+            return {'num_correct': 0, 'num_results': 0, 'perc_correct': 0.0, 'avg_time': 0.0,
+                    'std_time': 0.0, 'p50_time': 0.0, 'p90_time': 0.0, 'p99_time': 0.0}
+        return {'num_correct': self.num_correct, 'num_results': num_results,
+                'perc_correct': round(self.num_correct / num_results, 3),
+                'avg_time': round(self.mean_time, 2),
+                'std_time': round(math.sqrt(self.time_m2 / num_results), 2),
+                'p50_time': round(self.histogram.percentile(50), 2),
+                'p90_time': round(self.histogram.percentile(90), 2),
+                'p99_time': round(self.histogram.percentile(99), 2)}
+
+    def to_dict(self):
+        return {'records': self.records, 'num_correct': self.num_correct,
+                'mean_time': self.mean_time, 'time_m2': self.time_m2,
+                'histogram': self.histogram.counts, 'positions': self.positions}
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls()
+        summary.records = data['records']
+        summary.num_correct = data['num_correct']
+        summary.mean_time = data['mean_time']
+        summary.time_m2 = data['time_m2']
+        summary.histogram = TimeHistogram(data['histogram'])
+        summary.positions = data['positions']
+        return summary
+
+    def __eq__(self, other):
+        # Float sums depend on the order they were added up in.
+        def close(a, b):
+            return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9)
+        if not isinstance(other, TrialSummary):
+            return NotImplemented
+        if (self.records, self.num_correct) != (other.records, other.num_correct):
+            return False
+        if not (close(self.mean_time, other.mean_time) and close(self.time_m2, other.time_m2)):
+            return False
+        if self.histogram.counts != other.histogram.counts:
+            return False
+        if self.positions.keys() != other.positions.keys():
+            return False
+        return all(tally[:2] == other.positions[position][:2] and close(tally[2], other.positions[position][2])
+                for position, tally in self.positions.items())
+
+class SqliteTrialLog:
+    '''Keeps the `Round`s of one game in a table shared by every game in an
+    SQLite database. It has the same interface as `TrialLog`, but filtered
+    summaries are indexed queries instead of scans, and any number of
+    sessions can write to the same database.'''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS rounds (
+            id INTEGER PRIMARY KEY,
+            game TEXT NOT NULL,
+            number INTEGER NOT NULL,
+            correct INTEGER NOT NULL,
+            total_time REAL NOT NULL,
+            position TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            utc_datetime TEXT NOT NULL,
+            time_bin INTEGER NOT NULL -- see TimeHistogram.bin
+        );
+        CREATE INDEX IF NOT EXISTS rounds_game_time ON rounds (game, utc_datetime);
+        CREATE INDEX IF NOT EXISTS rounds_game_position ON rounds (game, position);
+        -- Rounds rolled up by `compact`, see TrialArchive
+        CREATE TABLE IF NOT EXISTS rollups (
+            game TEXT NOT NULL,
+            day TEXT NOT NULL,
+            position TEXT NOT NULL,
+            time_bin INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            correct INTEGER NOT NULL,
+            total_time REAL NOT NULL,
+            total_time_squared REAL NOT NULL,
+            PRIMARY KEY (game, day, position, time_bin)
+        );
+    '''
+
+    def __init__(self, path, game, size=8):
+        self.path = path
+        self.game = game
+        self.size = size
+        # Identifies the log for `TrialWriter`
+        self.key = (path, game)
+
+    @contextmanager
+    def _connect(self, fsync=False):
+        import sqlite3
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous={}'.format('FULL' if fsync else 'NORMAL'))
+            connection.executescript(self.schema)
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def exists(self):
+        if len(self) > 0:
+            return True
+        with self._connect() as connection:
+            return connection.execute('SELECT 1 FROM rollups WHERE game = ? LIMIT 1',
+                    (self.game,)).fetchone() is not None
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        with self._connect() as connection:
+            return connection.execute('SELECT COUNT(*) FROM rounds WHERE game = ?', (self.game,)).fetchone()[0]
+
+    def compact(self, before, compress=False):
+        '''Rolls the rounds played before `before` up into the rollups
+        table and deletes them, in one transaction. Returns the number of
+        rounds archived. `compress` is ignored; the database is compact.'''
+        if not os.path.exists(self.path):
+            return 0
+        with self._connect() as connection:
+            connection.execute('''INSERT INTO rollups
+                (game, day, position, time_bin, count, correct, total_time, total_time_squared)
+                SELECT game, substr(utc_datetime, 1, 10), position, time_bin, COUNT(*), SUM(correct),
+                    SUM(total_time), SUM(total_time * total_time)
+                FROM rounds WHERE game = ? AND utc_datetime < ?
+                GROUP BY game, substr(utc_datetime, 1, 10), position, time_bin
+                ON CONFLICT (game, day, position, time_bin) DO UPDATE SET
+                    count = count + excluded.count,
+                    correct = correct + excluded.correct,
+                    total_time = total_time + excluded.total_time,
+                    total_time_squared = total_time_squared + excluded.total_time_squared''',
+                (self.game, before))
+            return connection.execute('DELETE FROM rounds WHERE game = ? AND utc_datetime < ?',
+                    (self.game, before)).rowcount
+
+    def archive(self):
+        '''Returns the game's rollups as a `TrialArchive`.'''
+        archive = TrialArchive()
+        if not os.path.exists(self.path):
+            return archive
+        with self._connect() as connection:
+            rows = connection.execute('''SELECT day, position, time_bin, count, correct, total_time,
+                total_time_squared FROM rollups WHERE game = ?''', (self.game,))
+            for row in rows:
+                archive.add_tally(*row)
+        return archive
+
+    def append(self, rounds, fsync=False):
+        '''Inserts an iterable of `Round`s in a single transaction.'''
+        rows = [(self.game, int(round.number), int(round.correct), float(round.total_time),
+                round.position, str(round.answer), str(round.utc_datetime),
+                TimeHistogram.bin(float(round.total_time))) for round in rounds]
+        with self._connect(fsync) as connection:
+            connection.executemany('''INSERT INTO rounds
+                (game, number, correct, total_time, position, answer, utc_datetime, time_bin)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+
+    @contextmanager
+    def view(self):
+        '''Yields an iterator over the game's `Round`s in the order they were played.'''
+        with self._connect() as connection:
+            cursor = connection.execute('''SELECT number, correct, total_time, position, answer, utc_datetime
+                FROM rounds WHERE game = ? ORDER BY id''', (self.game,))
+            yield (Round(*row) for row in cursor)
+
+    @contextmanager
+    def archived_view(self):
+        '''Yields the game's rollups and a `view` of its rounds.'''
+        with self.view() as rounds:
+            yield self.archive(), rounds
+
+    def _where(self, since, file, last):
+        clauses = ['game = ?']
+        parameters = [self.game]
+        if last is not None:
+            clauses.append('''id >= (SELECT MIN(id) FROM
+                (SELECT id FROM rounds WHERE game = ? ORDER BY id DESC LIMIT ?))''')
+            parameters.extend((self.game, last))
+        if since is not None:
+            clauses.append('utc_datetime >= ?')
+            parameters.append(since)
+        if file is not None:
+            # A range rather than LIKE so that the position index is used.
+            clauses.append('position >= ? AND position < ?')
+            parameters.extend((file + ':', file + ';'))
+        return ' AND '.join(clauses), parameters
+
+    def summary(self, since=None, file=None, last=None):
+        '''Returns the `TrialSummary` of the game's rounds and rollups,
+        computed by the database. See `TrialLog.summary` for the filters.'''
+        if not os.path.exists(self.path):
+            return TrialSummary()
+        summary = self._rollup_summary(since, file, last)
+        summary.merge(self._rounds_summary(since, file, last))
+        return summary
+
+    def _rollup_summary(self, since, file, last):
+        summary = TrialSummary()
+        if last is not None:
+            return summary
+        clauses = ['game = ?']
+        parameters = [self.game]
+        if since is not None:
+            clauses.append('day >= ?')
+            parameters.append(since[:10])
+        if file is not None:
+            clauses.append('position >= ? AND position < ?')
+            parameters.extend((file + ':', file + ';'))
+        where = ' AND '.join(clauses)
+        with self._connect() as connection:
+            count, correct, total_time, total_time_squared = connection.execute('''SELECT SUM(count),
+                SUM(correct), SUM(total_time), SUM(total_time_squared)
+                FROM rollups WHERE {}'''.format(where), parameters).fetchone()
+            if not count:
+                return summary
+            summary = TrialSummary.from_sums(count, correct, total_time, total_time_squared)
+            rows = connection.execute('''SELECT time_bin, SUM(count) FROM rollups
+                WHERE {} GROUP BY time_bin'''.format(where), parameters)
+            for time_bin, count in rows:
+                summary.histogram.counts[time_bin] = count
+            rows = connection.execute('''SELECT position, SUM(count), SUM(correct), SUM(total_time)
+                FROM rollups WHERE {} GROUP BY position'''.format(where), parameters)
+            for position, count, correct, total_time in rows:
+                summary.positions[position] = [count, correct, total_time]
+        return summary
+
+    def _rounds_summary(self, since, file, last):
+        where, parameters = self._where(since, file, last)
+        with self._connect() as connection:
+            count, correct, total_time, total_time_squared = connection.execute('''SELECT COUNT(*),
+                SUM(correct), SUM(total_time), SUM(total_time * total_time)
+                FROM rounds WHERE {}'''.format(where), parameters).fetchone()
+            summary = TrialSummary.from_sums(count, correct or 0, total_time or 0.0, total_time_squared or 0.0)
+            rows = connection.execute('''SELECT time_bin, COUNT(*) FROM rounds
+                WHERE {} GROUP BY time_bin'''.format(where), parameters)
+            for time_bin, count in rows:
+                summary.histogram.counts[time_bin] = count
+            rows = connection.execute('''SELECT position, COUNT(*), SUM(correct), SUM(total_time)
+                FROM rounds WHERE {} GROUP BY position'''.format(where), parameters)
+            for position, count, correct, total_time in rows:
+                summary.positions[position] = [count, correct, total_time]
+        return summary
+
+    def rebuild_summary(self):
+        return self.summary()
+
+    def verify_summary(self):
+        # Summaries are always computed from the rounds themselves.
+        return True
+
+class TrialWriter:
+    '''Appends rounds to trial logs on a background thread, so that logging
+    is off the critical path of a session.
+
+    Rounds submitted for the same log are grouped into a single append,
+    which happens once `max_rounds` rounds are waiting or `max_delay`
+    seconds after the first of them was submitted, whichever is sooner.
+    With `fsync`, every group is synced to disk. Call `flush` to wait for
+    everything submitted so far to be written and `close` to drain the
+    queue and stop the thread. `pending` gets at the rounds that have not
+    been written yet without waiting for them.
+    '''
+    _flush = object()
+    _close = object()
+
+    def __init__(self, max_rounds=1000, max_delay=1.0, fsync=False):
+        self.max_rounds = max_rounds
+        self.max_delay = max_delay
+        self.fsync = fsync
+        self._queue = None
+        self._thread = None
+        self._lock = allocate_lock()
+        # key -> rounds submitted for that log and not appended yet
+        self._pending = {}
+        # Held while appending, so that `pending` sees a log and its
+        # pending rounds without a group moving from one to the other.
+        self._appending = allocate_lock()
+
+    def _start(self):
+        # The thread is started when there is first something to write.
+        import queue, threading
+        with self._lock:
+            if self._thread is None:
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name='trial-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, trial_log, rounds):
+        '''Queues an iterable of `Round`s to be appended to `trial_log`.'''
+        self._start()
+        rounds = list(rounds)
+        with self._lock:
+            self._pending.setdefault(trial_log.key, []).extend(rounds)
+        self._queue.put((trial_log, rounds))
+
+    @contextmanager
+    def pending(self, trial_log):
+        '''Yields the rounds submitted for `trial_log` that have not been
+        appended to it yet. Nothing is appended to it until the block ends,
+        so reading the log in the block gives the rest of its rounds.'''
+        with self._appending:
+            with self._lock:
+                rounds = list(self._pending.get(trial_log.key, ()))
+            yield rounds
+
+    def flush(self):
+        if self._thread is None:
+            return
+        import threading
+        done = threading.Event()
+        self._queue.put((self._flush, done))
+        done.wait()
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put((self._close, None))
+            self._thread.join()
+
+    def _run(self):
+        import queue
+        pending = {} # key -> (trial log, rounds)
+        waiting = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                trial_log, item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                trial_log, item = self._flush, None
+            if trial_log is self._flush or trial_log is self._close:
+                self._commit(pending)
+                pending, waiting, deadline = {}, 0, None
+                if item is not None:
+                    item.set()
+                if trial_log is self._close:
+                    return
+                continue
+            pending.setdefault(trial_log.key, (trial_log, []))[1].extend(item)
+            waiting += len(item)
+            if deadline is None:
+                deadline = time.monotonic() + self.max_delay
+            if waiting >= self.max_rounds:
+                self._commit(pending)
+                pending, waiting, deadline = {}, 0, None
+
+    def _commit(self, pending):
+        for trial_log, rounds in pending.values():
+            with self._appending:
+                try:
+                    trial_log.append(rounds, fsync=self.fsync)
+                except Exception as e:
+                    # Keep the writer alive for every other log.
+                    sys.stderr.write('Could not log {} rounds to {}: {!r}\n'.format(len(rounds), trial_log.key, e))
+                with self._lock:
+                    # Groups are appended in the order they were submitted.
+                    queued = self._pending[trial_log.key]
+                    del queued[:len(rounds)]
+                    if not queued:
+                        del self._pending[trial_log.key]
+
+class WeakSpotScheduler:
+    '''Chooses a game's next position in proportion to how weak the player
+    is at it, so drills focus on the squares they miss or answer slowly.
+
+    A position's weight is its error rate times its average answer time,
+    both smoothed so that positions never played count as missed half the
+    time at `prior_time` seconds. The weights are kept in a Fenwick tree, so
+    recording a round and choosing a position each take O(log n) in the
+    number of positions, however long the history is. With probability
+    `explore` the position is uniform instead, so no square is forgotten.
+
+    Every position gets a weight up front, so games with more than
+    `max_positions` positions are not scheduled.
+    '''
+    max_positions = 2 ** 16
+
+    def __init__(self, positions, tallies=None, explore=0.2, prior_time=5.0, rng=None):
+        ''':param list positions: Every position the game can ask.
+        :param dict tallies: position -> [rounds, correct, total time], as in
+            `TrialSummary.positions`.'''
+        self.positions = list(positions)
+        self.indexes = {position: index for index, position in enumerate(self.positions)}
+        self.explore = explore
+        self.prior_time = prior_time
+        if rng is None:
+            from random import Random
+            rng = Random()
+        self.rng = rng
+        self.tallies = [[0, 0, 0.0] for _ in self.positions]
+        for position, tally in (tallies or {}).items():
+            if position in self.indexes:
+                self.tallies[self.indexes[position]] = list(tally)
+        self.weights = [self.weight(tally) for tally in self.tallies]
+        # Builds the tree in O(n) by pushing every node's sum to its parent.
+        self.tree = [0.0] + self.weights
+        for index in range(1, len(self.tree)):
+            parent = index + (index & -index)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[index]
+        self.total = sum(self.weights)
+
+    @classmethod
+    def for_game(cls, game):
+        '''Seeds a scheduler from the summary of the game's trial log.'''
+        return cls(game.all_positions(), game.all_time_summary().positions, rng=game.rng)
+
+    def weight(self, tally):
+        count, correct, total_time = tally
+        error_rate = (count - correct + 1) / (count + 2)
+        average_time = (total_time + self.prior_time) / (count + 1)
+        return error_rate * average_time
+
+    def update(self, round):
+        '''Records a `Round` that was just played.'''
+        index = self.indexes.get(round.position)
+        if index is None:
+            return
+        tally = self.tallies[index]
+        tally[0] += 1
+        tally[1] += int(round.correct)
+        tally[2] += float(round.total_time)
+        weight = self.weight(tally)
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        self.total += delta
+        node = index + 1
+        while node < len(self.tree):
+            self.tree[node] += delta
+            node += node & -node
+
+    def next_position(self):
+        if self.rng.random() < self.explore:
+            return self.positions[self.rng.randrange(len(self.positions))]
+        target = self.rng.random() * self.total
+        # Descends the tree to the first position whose running total of
+        # weights passes `target`.
+        node = 0
+        step = 1 << (len(self.positions).bit_length() - 1)
+        while step:
+            child = node + step
+            if child < len(self.tree) and self.tree[child] <= target:
+                node = child
+                target -= self.tree[child]
+            step >>= 1
+        return self.positions[min(node, len(self.positions) - 1)]
+
+PUZZLE_PIECES = ('knight', 'king', 'bishop', 'rook', 'queen')
+
+def solve_puzzles(piece, size, start):
+    '''Finds how many moves `piece` needs to get from square id `start` to
+    every square it can reach on an empty board, and by how many shortest
+    routes. Returns a list of (end, distance, routes).'''
+    directions, slides = PIECE_DIRECTIONS[piece]
+    distances = {start: 0}
+    routes = {start: 1}
+    frontier = [start]
+    while frontier:
+        next_frontier = []
+        for square in frontier:
+            y, x = divmod(square, size)
+            distance = distances[square] + 1
+            for xi, yi in directions:
+                nx, ny = x + xi, y + yi
+                while 0 <= nx < size and 0 <= ny < size:
+                    target = ny * size + nx
+                    known = distances.get(target)
+                    if known is None:
+                        distances[target] = distance
+                        routes[target] = routes[square]
+                        next_frontier.append(target)
+                    elif known == distance:
+                        routes[target] += routes[square]
+                    if not slides:
+                        break
+                    nx, ny = nx + xi, ny + yi
+        frontier = next_frontier
+    return [(end, distances[end], routes[end]) for end in distances if end != start]
+
+def _solve_puzzles(job):
+    return job, solve_puzzles(*job)
+
+class PuzzleBank:
+    '''Every pair of squares on a board, indexed by piece, by how many moves
+    the piece needs between them and by how many shortest routes there are,
+    so that games can ask for i.e. "knight puzzles exactly 5 moves long"
+    without searching at prompt time.
+
+    A bank is saved as a header, a table of groups, one per (piece,
+    distance, routes), and the square id pairs of every group as unsigned
+    16 bit integers, so boards can be up to 256x256. Route counts are saved
+    as 64 bit integers, so on big boards every pair with `max_routes` or
+    more routes is in one group, with `max_routes` routes.
+    '''
+    max_routes = 2 ** 64 - 1
+    magic = b'CVPB'
+    version = 1
+    header = struct.Struct('<4sHHI') # magic, version, board size, groups
+    # piece (index in PUZZLE_PIECES), distance, routes, first pair, pairs
+    group = struct.Struct('<BxHxxxxQQQ')
+
+    def __init__(self, size, groups, pairs):
+        ''':param dict groups: (piece, distance, routes) -> (first pair, pairs)
+        :param array pairs: start and end square ids, one after the other.'''
+        self.size = size
+        self.groups = groups
+        self.pairs = pairs
+
+    @classmethod
+    def build(cls, size=8, pieces=PUZZLE_PIECES, workers=None):
+        '''Solves every start square of every piece in a process pool of
+        `workers` processes, or in this process if `workers` is 0.'''
+        assert size <= 256, 'Board size must be at most 256'
+        jobs = [(piece, size, start) for piece in pieces for start in range(size * size)]
+        grouped = {}
+        if workers == 0:
+            results = map(_solve_puzzles, jobs)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(workers)
+            results = executor.map(_solve_puzzles, jobs, chunksize=max(len(jobs) // 64, 1))
+        try:
+            for (piece, _, start), solutions in results:
+                for end, distance, routes in solutions:
+                    routes = min(routes, cls.max_routes)
+                    grouped.setdefault((piece, distance, routes), array('H')).extend((start, end))
+        finally:
+            if workers != 0:
+                executor.shutdown()
+        groups = {}
+        pairs = array('H')
+        for key in sorted(grouped, key=lambda key: (PUZZLE_PIECES.index(key[0]), key[1], key[2])):
+            groups[key] = (len(pairs) // 2, len(grouped[key]) // 2)
+            pairs.extend(grouped[key])
+        return cls(size, groups, pairs)
+
+    def save(self, path):
+        pairs = array('H', self.pairs)
+        if sys.byteorder == 'big':
+            pairs.byteswap()
+        with open(path, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.version, self.size, len(self.groups)))
+            for (piece, distance, routes), (first, count) in self.groups.items():
+                f.write(self.group.pack(PUZZLE_PIECES.index(piece), distance, routes, first, count))
+            pairs.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic, version, size, num_groups = cls.header.unpack(f.read(cls.header.size))
+            if magic != cls.magic or version != cls.version:
+                raise ValueError('{} is not a version {} puzzle bank'.format(path, cls.version))
+            groups = {}
+            for _ in range(num_groups):
+                piece, distance, routes, first, count = cls.group.unpack(f.read(cls.group.size))
+                groups[(PUZZLE_PIECES[piece], distance, routes)] = (first, count)
+            pairs = array('H')
+            pairs.frombytes(f.read())
+        if sys.byteorder == 'big':
+            pairs.byteswap()
+        return cls(size, groups, pairs)
+
+    def puzzles(self, piece, distance=None, min_routes=None, max_routes=None, rng=None):
+        '''Returns the `PuzzleSet` of `piece` puzzles that are `distance`
+        moves long and have from `min_routes` to `max_routes` shortest routes.
+        Puzzles with at least `PuzzleBank.max_routes` routes count as having
+        exactly that many.'''
+        groups = [group for (group_piece, group_distance, routes), group in self.groups.items()
+                if group_piece == piece
+                and (distance is None or group_distance == distance)
+                and (min_routes is None or routes >= min_routes)
+                and (max_routes is None or routes <= max_routes)]
+        return PuzzleSet(self, groups, rng)
+
+class PuzzleSet:
+    '''Some of the groups of a `PuzzleBank`, which can be sampled from in
+    O(1) per group. It can be used as a game's scheduler.'''
+
+    def __init__(self, bank, groups, rng=None):
+        self.bank = bank
+        self.firsts = [first for first, _ in groups]
+        # The number of pairs in all of the groups up to and including each one
+        self.ends = []
+        total = 0
+        for _, count in groups:
+            total += count
+            self.ends.append(total)
+        if rng is None:
+            from random import Random
+            rng = Random()
+        self.rng = rng
+
+    def __len__(self):
+        return self.ends[-1] if self.ends else 0
+
+    def for_game(self, game):
+        if game.size != self.bank.size:
+            raise ValueError('The puzzles are for a {0}x{0} board'.format(self.bank.size))
+        if not len(self):
+            raise ValueError('No puzzles match')
+        return self
+
+    def next_position(self):
+        index = self.rng.randrange(len(self))
+        group = bisect_right(self.ends, index)
+        pair = self.firsts[group] + index - (self.ends[group - 1] if group else 0)
+        start, end = self.bank.pairs[2 * pair], self.bank.pairs[2 * pair + 1]
+        return '{} {}'.format(get_square_name(start, self.bank.size), get_square_name(end, self.bank.size))
+
+    def update(self, round):
+        pass
+
+def read_csv_log(csv_path):
+    '''Yields the rounds in a CSV trial log, as written by older versions
+    of the trainer.'''
+    import csv
+    with open(csv_path, mode='r') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        for row in reader:
+            yield Round(*row)
+
+def convert_csv_log(csv_path, log_path, size=8):
+    '''Copies the rounds in a CSV trial log to the end of the binary
+    `TrialLog` at log_path.'''
+    TrialLog(log_path, size).append(read_csv_log(csv_path))
+
+class LatencyHistogram(TimeHistogram):
+    '''A `TimeHistogram` fine enough for the time the trainer itself takes,
+    from 100 nanoseconds to 100 seconds.'''
+    minimum = 1e-7
+    decades = 9
+    num_bins = decades * TimeHistogram.bins_per_decade + 2
+
+class Instrumentation:
+    '''Times the phases of every game's rounds with `time.perf_counter_ns`
+    and keeps a `LatencyHistogram` per game and phase, which can be dumped
+    as JSON or in the Prometheus text format.
+
+    The phases are the trainer's own work, "precmd", "get_answer",
+    "get_correct_answer", "postcmd" and "log_trials", plus "think", the
+    time the player took to answer.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        # (game, phase) -> [count, total nanoseconds, LatencyHistogram]
+        self.phases = {}
+        self._lock = allocate_lock()
+
+    @contextmanager
+    def timer(self, game, phase):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(game, phase, time.perf_counter_ns() - start)
+
+    def record(self, game, phase, nanoseconds):
+        with self._lock:
+            timing = self.phases.get((game, phase))
+            if timing is None:
+                timing = self.phases[(game, phase)] = [0, 0, LatencyHistogram()]
+            timing[0] += 1
+            timing[1] += nanoseconds
+            timing[2].add(nanoseconds / 1e9)
+
+    def reset(self):
+        with self._lock:
+            self.phases = {}
+
+    def _snapshot(self):
+        # Copies the timings under the lock, so that rounds recorded while
+        # they are formatted cannot change a histogram half way through.
+        with self._lock:
+            return sorted((key, (count, total, LatencyHistogram(histogram.counts)))
+                          for key, (count, total, histogram) in self.phases.items())
+
+    def to_dict(self):
+        '''Returns {game: {phase: {'count': ..., 'total_seconds': ...,
+        'p50_seconds': ..., 'p90_seconds': ..., 'p99_seconds': ...}}}'''
+        timings = {}
+        for (game, phase), (count, total, histogram) in self._snapshot():
+            timings.setdefault(game, {})[phase] = {'count': count, 'total_seconds': total / 1e9,
+                    'p50_seconds': histogram.percentile(50), 'p90_seconds': histogram.percentile(90),
+                    'p99_seconds': histogram.percentile(99)}
+        return timings
+
+    def to_prometheus(self):
+        '''Returns the timings as a Prometheus histogram with a bucket per
+        decade of seconds.'''
+        name = 'chesstrainer_phase_seconds'
+        lines = ['# HELP {} Time spent in each phase of a round.'.format(name),
+                 '# TYPE {} histogram'.format(name)]
+        for (game, phase), (count, total, histogram) in self._snapshot():
+            labels = 'game="{}",phase="{}"'.format(game, phase)
+            seen = histogram.counts[0]
+            for decade in range(1, histogram.decades + 1):
+                last_bin = decade * histogram.bins_per_decade
+                seen += sum(histogram.counts[last_bin - histogram.bins_per_decade + 1:last_bin + 1])
+                lines.append('{}_bucket{{{},le="{:g}"}} {}'.format(name, labels, histogram.minimum * 10 ** decade, seen))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, count))
+            lines.append('{}_sum{{{}}} {}'.format(name, labels, total / 1e9))
+            lines.append('{}_count{{{}}} {}'.format(name, labels, count))
+        return '\n'.join(lines) + '\n'
+
+INSTRUMENTS = Instrumentation()
+
+class AnswerCache:
+    '''A bounded, least recently used cache of games' correct answers,
+    keyed by game, board size and position. 8x8 games that set
+    `cache_answers` share `ANSWER_CACHE`, so after the first time a
+    position comes up its answer is a dictionary lookup. Hits and misses
+    are counted per game.'''
+    _missing = object()
+
+    def __init__(self, max_entries=65536):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = {}
+        self.misses = {}
+        self._lock = allocate_lock()
+
+    def get(self, game, position):
+        '''Returns `game.get_correct_answer(position)`, computing it on a miss.'''
+        key = (game._basename, position)
+        with self._lock:
+            answer = self.entries.get(key, self._missing)
+            if answer is not self._missing:
+                self.entries.move_to_end(key)
+                self.hits[key[0]] = self.hits.get(key[0], 0) + 1
+                return answer
+            self.misses[key[0]] = self.misses.get(key[0], 0) + 1
+        answer = game.get_correct_answer(position)
+        self._store(key, answer)
+        return answer
+
+    def _store(self, key, answer):
+        with self._lock:
+            self.entries[key] = answer
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def warm(self, game):
+        '''Computes the answer to every position in `game.all_positions()`
+        that is not cached yet, without counting misses.'''
+        if not game.uses_answer_cache:
+            return
+        for position in game.all_positions():
+            key = (game._basename, position)
+            if key not in self.entries:
+                self._store(key, game.get_correct_answer(position))
+
+    def stats(self):
+        '''Returns {game: {'hits': ..., 'misses': ..., 'hit_rate': ...}}'''
+        stats = {}
+        for name in sorted(set(self.hits) | set(self.misses)):
+            hits, misses = self.hits.get(name, 0), self.misses.get(name, 0)
+            stats[name] = {'hits': hits, 'misses': misses, 'hit_rate': round(hits / (hits + misses), 3)}
+        return stats
+
+    def save(self, path):
+        # JSON has no tuples, so they are saved as {"tuple": [...]}.
+        import json
+        entries = [[name, position, {'tuple': list(answer)} if isinstance(answer, tuple) else answer]
+                for (name, position), answer in self.entries.items()]
+        temporary_path = path + '.tmp'
+        with open(temporary_path, mode='w') as f:
+            json.dump(entries, f, separators=(',', ':'))
+        os.replace(temporary_path, path)
+
+    def load(self, path):
+        import json
+        with open(path, mode='r') as f:
+            entries = json.load(f)
+        for name, position, answer in entries:
+            if isinstance(answer, dict):
+                answer = tuple(answer['tuple'])
+            self._store((name, position), answer)
+
+ANSWER_CACHE = AnswerCache()
 
 class ChessVisualizationTrainer(cmd.Cmd):
     intro = "Chess visualization trainer. Choose a game to play! Type help or '?' to see a list of commands. 'Ctrl+c' to quit\n"
     prompt = '(chess-trainer)'
     file = None
-
-    def do_colorgame(self, arg):
-        '''Displays a random square on the chess board, repeatedly. 'colorgame 10' would play the game for 10 trials. Respond with 'w' for 'white' and 'b' for black. Displays statistics at the end.'''
+    # The biggest board `puzzle_bank` builds a bank for at the prompt. It
+    # takes about a quarter of a second, and grows with the size to the fourth.
+    max_built_puzzle_size = 16
+
+    def __init__(self, database=None, writer=None, puzzles=None, **kwargs):
+        ''':param str database: Keep every game's history in this SQLite
+            database instead of in one log file per game.
+        :param TrialWriter writer: Log the games' rounds in the background.
+        :param str puzzles: A `PuzzleBank` file to take knight puzzles from.
+            Banks for other board sizes up to `max_built_puzzle_size` are
+            built when they are first needed.'''
+        super(ChessVisualizationTrainer, self).__init__(**kwargs)
+        self.database = database
+        self.writer = writer
+        self.puzzles = puzzles
+        self._puzzle_banks = {}
+
+    def puzzle_bank(self, size):
+        '''The knight `PuzzleBank` of `size` x `size` boards, from the
+        `puzzles` file or built on demand up to `max_built_puzzle_size`.'''
+        if size not in self._puzzle_banks:
+            if self.puzzles is not None and os.path.exists(self.puzzles):
+                bank = PuzzleBank.load(self.puzzles)
+                self._puzzle_banks[bank.size] = bank
+            if size not in self._puzzle_banks:
+                if size > self.max_built_puzzle_size:
+                    raise ValueError('Puzzles for a {0}x{0} board need a prebuilt bank: run with '
+                                     '"--build-puzzles FILE --size {0}", then "--puzzles FILE"'.format(size))
+                self._puzzle_banks[size] = PuzzleBank.build(size, ('knight',), workers=0 if size <= 8 else None)
+        return self._puzzle_banks[size]
+
+    def _parse_game_args(self, arg):
+        '''"10 12" -> play 10 rounds on a 12x12 board. "--adaptive"
+        anywhere drills the squares you are weakest at.'''
         args = arg.split()
-        kwargs = {}
+        kwargs = {'database': self.database, 'writer': self.writer}
+        if '--adaptive' in args:
+            args.remove('--adaptive')
+            kwargs['scheduler'] = WeakSpotScheduler
         if len(args):
-             kwargs['rounds'] = int(arg.split()[0])
-        ColorGame(**kwargs).cmdloop()
-        return False 
-    
-    def do_diagonal(self, arg):
-        '''play "diagonal" chess game.'''
-        # change to square and color
+            kwargs['rounds'] = int(args[0])
+        if len(args) > 1:
+            kwargs['size'] = int(args[1])
+        # Every game has size x size positions, which the scheduler weighs one by one.
+        size = kwargs.get('size', 8)
+        if 'scheduler' in kwargs and size * size > WeakSpotScheduler.max_positions:
+            raise ValueError('--adaptive is for boards of at most {} squares'.format(WeakSpotScheduler.max_positions))
+        return kwargs
+
+    # The commands that play each game are added by `register_game`.
+
+    def _games(self, game_name='', size=8):
+        '''Makes the game called `game_name`, or every game, on a `size` x
+        `size` board to get at its history.'''
+        return [entry.factory(size=size, database=self.database, writer=self.writer, stdout=self.stdout)
+                for entry in GAME_REGISTRY.values() if not game_name or entry.name == game_name]
+
+    def _parse_size(self, value):
+        size = int(value)
+        if size < 5:
+            raise ValueError('Board size must be at least 5')
+        return size
+
+    def _parse_stats_args(self, arg):
+        '''"knight --days 7 --file e --slowest 20 --size 10" ->
+        ("knight", {"since": ..., "file": "e"}, {"slowest": 20, "heatmaps": False, "export": None, "size": 10})'''
+        from datetime import datetime, timedelta
         args = arg.split()
-        kwargs = {}
-        if len(args):
-            kwargs['rounds'] = int(arg.split()[0])
-        DiagonalSquareGame(**kwargs).cmdloop()
-        return False
+        game_name = ''
+        filters = {}
+        options = {'slowest': 0, 'heatmaps': False, 'export': None, 'size': 8}
+        while args:
+            option = args.pop(0)
+            if not option.startswith('--'):
+                game_name = option
+                continue
+            if option == '--heatmaps':
+                options['heatmaps'] = True
+                continue
+            if not args:
+                raise ValueError('{} needs a value'.format(option))
+            value = args.pop(0)
+            if option == '--days':
+                filters['since'] = str(datetime.now() - timedelta(days=float(value)))
+            elif option == '--file':
+                get_file_number(value)
+                filters['file'] = value
+            elif option == '--last':
+                filters['last'] = int(value)
+            elif option == '--slowest':
+                options['slowest'] = int(value)
+            elif option == '--export':
+                options['export'] = value
+            elif option == '--size':
+                options['size'] = self._parse_size(value)
+            else:
+                raise ValueError('Unknown option {}'.format(option))
+        if options['export'] and not game_name:
+            raise ValueError('--export needs a game')
+        return game_name, filters, options
+
+    def do_EOF(self, arg):
+        '''Quits at the end of the input (Ctrl+D).'''
+        self.stdout.write('\n')
+        return True
 
-    def do_brothergame(self, arg):
-        '''play "brothers square" chess game.'''
-        # change to square and color
-        args = arg.split()
-        kwargs = {}
-        if len(args):
-            kwargs['rounds'] = int(arg.split()[0])
-        BrotherSquareGame(**kwargs).cmdloop()
-        return False
-    
     def do_getstats(self, arg):
         '''Grabs the statistics for all games. Enter a name
-        as a second parameter to print a specific games statitstics.'''
-        games = ColorGame(),BrotherSquareGame(), DiagonalSquareGame(),KnightSquareGame() 
-        game_name = arg
-        options = [x.name for x in games]
-        if game_name and game_name not in options:
-            self.stdout.write('\nGame "{}" does not exist. Options are: {}\n'.format(game_name, ", ".join(options)))
-        for game in games:
-            if game_name and game_name != game.name:
+        as a second parameter to print a specific games statitstics.
+        Filter with '--days 7' for the last week, '--last 100' for the last
+        100 rounds, '--file e' for squares on the e file and '--slowest 20'
+        to list the 20 slowest positions. '--heatmaps' adds accuracy and
+        time by square and trends, and 'knight --export knight.json' saves
+        them as JSON, or CSV for any other extension. Both need NumPy.
+        '--size 10' shows the games played on a 10x10 board.'''
+        try:
+            game_name, filters, options = self._parse_stats_args(arg)
+        except (KeyError, ValueError) as e:
+            self.stdout.write('\nBad arguments: {}\n'.format(e))
+            return
+        if game_name and game_name not in GAME_REGISTRY:
+            self.stdout.write('\nGame "{}" does not exist. Options are: {}\n'.format(game_name, ", ".join(GAME_REGISTRY)))
+            return
+        analytics = None
+        if options['heatmaps'] or options['export']:
+            try:
+                import chessanalytics as analytics
+            except ImportError as e:
+                self.stdout.write('\nHeatmaps and exports need NumPy ({}). Install it with "pip install numpy".\n'.format(e))
+                return
+        for game in self._games(game_name, options['size']):
+            if not game.has_trials():
+                self.stdout.write("\nNo games of {} played yet.\n".format(game.name))
+            else:
+                summary = game.flushed_trial_log().summary(**filters)
+                if filters:
+                    self.stdout.write("\nFiltered stats for {}:\n".format(game.name))
+                else:
+                    self.stdout.write("\nAll-time stats for {}:\n".format(game.name))
+                statistics = game.compute_statistics(summary)
+                if analytics is not None:
+                    history = analytics.History.load(game.flushed_trial_log(), **filters)
+                    if options['heatmaps']:
+                        statistics['heatmaps'] = analytics.heatmaps(history)
+                    if options['export']:
+                        analytics.export(history, options['export'])
+                        self.stdout.write("Saved the analytics to {}\n".format(options['export']))
+                game.print_statistics(statistics)
+                if options['slowest']:
+                    game.print_slowest_positions(summary, options['slowest'])
+
+    def do_verifystats(self, arg):
+        '''Checks that the saved all-time statistics of every game match its
+        trial log, and rebuilds them if they do not. '--size 10' checks the
+        games played on a 10x10 board.'''
+        args = arg.split()
+        size = 8
+        try:
+            while args:
+                option = args.pop(0)
+                if option != '--size':
+                    raise ValueError('Unknown option {}'.format(option))
+                if not args:
+                    raise ValueError('--size needs a value')
+                size = self._parse_size(args.pop(0))
+        except ValueError as e:
+            self.stdout.write('\nBad arguments: {}\n'.format(e))
+            return
+        for game in self._games(size=size):
+            if not game.has_trials():
                 continue
+            trial_log = game.flushed_trial_log()
+            if trial_log.verify_summary():
+                self.stdout.write("{}: ok\n".format(game.name))
             else:
-                all_time_rounds = tuple(game.read_trials())
-                self.stdout.write("\nAll-time stats for {}:\n".format(game.name))
-                all_time_stats = game.compute_statistics(all_time_rounds)
-                game.print_statistics(all_time_stats)
+                trial_log.rebuild_summary()
+                self.stdout.write("{}: rebuilt from {} rounds\n".format(game.name, len(trial_log)))
+
+    def do_compact(self, arg):
+        '''Rolls rounds older than 90 days up into a per-day archive, so
+        that statistics stay fast as the history grows. All-time statistics
+        do not change. Enter a name to compact a specific game, '--days 30'
+        to keep a different number of days in full, '--gzip' to compress
+        the archive and '--size 10' for the games played on a 10x10 board.'''
+        args = arg.split()
+        game_name = ''
+        days = 90.0
+        compress = False
+        size = 8
+        try:
+            while args:
+                option = args.pop(0)
+                if option == '--gzip':
+                    compress = True
+                elif option == '--days':
+                    if not args:
+                        raise ValueError('--days needs a value')
+                    days = float(args.pop(0))
+                elif option == '--size':
+                    if not args:
+                        raise ValueError('--size needs a value')
+                    size = self._parse_size(args.pop(0))
+                elif option.startswith('--'):
+                    raise ValueError('Unknown option {}'.format(option))
+                else:
+                    game_name = option
+        except ValueError as e:
+            self.stdout.write('\nBad arguments: {}\n'.format(e))
+            return
+        from datetime import datetime, timedelta
+        before = str(datetime.now() - timedelta(days=days))
+        for game in self._games(game_name, size):
+            if not game.has_trials():
+                continue
+            trial_log = game.flushed_trial_log()
+            archived = trial_log.compact(before, compress)
+            self.stdout.write("{}: archived {} rounds, {} left in the log\n".format(
+                game.name, archived, len(trial_log)))
+
+    def do_cachestats(self, arg):
+        '''Shows how often each game's answers came from the answer cache.'''
+        stats = ANSWER_CACHE.stats()
+        if not stats:
+            self.stdout.write("No answers looked up yet.\n")
+        for name, counts in stats.items():
+            self.stdout.write("{}: {} hits, {} misses, hit rate {}\n".format(
+                name, counts['hits'], counts['misses'], counts['hit_rate']))
+
+    def do_timings(self, arg):
+        '''Shows how long each phase of the rounds played so far took, as
+        JSON, or in the Prometheus text format with 'timings --prometheus'.'''
+        if arg.strip() == '--prometheus':
+            self.stdout.write(INSTRUMENTS.to_prometheus())
+        else:
+            import json
+            self.stdout.write(json.dumps(INSTRUMENTS.to_dict(), indent=2) + '\n')
 
     def do_knightgame(self, arg):
         '''play "knight game", where you find the shortest path
-        between two squares for a knight.'''
+        between two squares for a knight. 'knightgame 10 --distance 5'
+        asks only for routes 5 moves long and '--routes 20' only for
+        squares with at least 20 shortest routes between them.'''
         args = arg.split()
-        kwargs = {}
-        if len(args):
-            kwargs['rounds'] = int(arg.split()[0])
-        KnightSquareGame(**kwargs).cmdloop()
+        filters = {}
+        try:
+            for option, name in (('--distance', 'distance'), ('--routes', 'min_routes')):
+                if option in args:
+                    index = args.index(option)
+                    if index + 1 == len(args):
+                        raise ValueError('{} needs a value'.format(option))
+                    filters[name] = int(args[index + 1])
+                    del args[index:index + 2]
+            kwargs = self._parse_game_args(' '.join(args))
+            if filters:
+                kwargs['scheduler'] = self.puzzle_bank(kwargs.get('size', 8)).puzzles('knight', **filters)
+            game = KnightSquareGame(**kwargs)
+            if filters:
+                # Fails here rather than in the game if no puzzles match.
+                game.scheduler.for_game(game)
+        except (ValueError, AssertionError) as e:
+            self.stdout.write('\nBad arguments: {}\n'.format(e))
+            return False
+        game.cmdloop()
         return False
 
 
@@ -278,13 +2348,76 @@ class BadFormatError(Exception):
     '''Raised when an answer to a prompt is poorly formatted.'''
     pass
 
+def log_basename(name, size=8):
+    '''What the history of game `name` is kept under, i.e. "knight" or
+    "knight-12x12"'''
+    if size != 8:
+        return '{}-{}x{}'.format(name, size, size)
+    return name
+
+class GameEntry(namedtuple('GameEntry', ['name', 'command', 'factory', 'help'])):
+    '''A game in `GAME_REGISTRY`: its name, the trainer command that plays
+    it, what makes a game (its class) and the command's help.'''
+    __slots__ = ()
+
+    def log_file(self, size=8):
+        return log_basename(self.name, size) + '.trials'
+
+# name -> GameEntry, in the order the games are defined
+GAME_REGISTRY = {}
+
+def register_game(command, help=None):
+    '''Class decorator that adds a `RandomSquareGame` to `GAME_REGISTRY`
+    and, unless `ChessVisualizationTrainer` already has one, a
+    `do_<command>` that plays it, with `help` as its help.'''
+    def register(game_class):
+        name = game_class.prompt.strip('()')
+        GAME_REGISTRY[name] = GameEntry(name, command, game_class, help)
+        if not hasattr(ChessVisualizationTrainer, 'do_' + command):
+            def play(self, arg):
+                try:
+                    game = game_class(**self._parse_game_args(arg))
+                except (ValueError, AssertionError) as e:
+                    self.stdout.write('\nBad arguments: {}\n'.format(e))
+                    return False
+                game.cmdloop()
+                return False
+            play.__name__ = 'do_' + command
+            play.__doc__ = help
+            setattr(ChessVisualizationTrainer, play.__name__, play)
+        return game_class
+    return register
+
 class RandomSquareGame(cmd.Cmd):
     prompt = '(game)'
-
-    def __init__(self, rounds=5):
-        super(RandomSquareGame,self).__init__()
+    # Set to True if `get_correct_answer` only depends on the position and
+    # board size, to keep the answers of 8x8 games in `ANSWER_CACHE`.
+    cache_answers = False
+
+    # How many squares a position has, i.e. the knight's start and end
+    position_squares = 1
+
+    def __init__(self, rounds=5, size=8, database=None, writer=None, scheduler=None, rng=None,
+                 directory='', **kwargs):
+        ''':param scheduler: Chooses the positions instead of
+            `get_random_position`, i.e. `WeakSpotScheduler`. Its `for_game`
+            is called with the game when the game starts.
+        :param rng: The `random.Random` positions are chosen with, so that
+            a session can be replayed. The `random` module by default.
+        :param str directory: Where the game's trial log is kept, the
+            working directory by default.
+        Other keyword arguments, i.e. `stdin` and `stdout`, go to `cmd.Cmd`.'''
+        super(RandomSquareGame,self).__init__(**kwargs)
         assert rounds > 0, 'Number of rounds must be greater than 0'
+        assert size >= 5, 'Board size must be at least 5'
         self.rounds = rounds
+        self.size = size
+        self.database = database
+        self.writer = writer
+        self.scheduler = scheduler
+        self.rng = rng
+        self.directory = directory
+        self._scheduler = None
         self.cur_pos = None
         self.cur_trial_end_time = None
         self.round_results = []
@@ -292,34 +2425,50 @@ class RandomSquareGame(cmd.Cmd):
 
     def get_random_position(self):
         '''Grabs a random initial position from the board.'''
-        return get_random_position()
+        return get_random_position(size=self.size, rng=self.rng)
+
+    def all_positions(self):
+        '''Every position `get_random_position` can return.'''
+        return [get_chess_notation(x, y) for y in range(1, self.size + 1) for x in range(1, self.size + 1)]
+
+    def next_position(self):
+        if self._scheduler is not None:
+            return self._scheduler.next_position()
+        return self.get_random_position()
 
     def preloop(self):
-        self.cur_pos = self.get_random_position()
-        self.intro += '.\n Ready?... GO!\n\n\n{} ?'.format(self.cur_pos)
+        if self.scheduler is not None:
+            self._scheduler = self.scheduler.for_game(self)
+        self.cur_pos = self.next_position()
+        # From the class's intro, so that playing the game again does not
+        # repeat the suffix.
+        self.intro = type(self).intro + '.\n Ready?... GO!\n\n\n{} ?'.format(self.cur_pos)
         self._start_clock()
 
+    # A monotonic clock, so answer times do not jump when the system clock
+    # is adjusted.
     def _start_clock(self):
-        self._trial_stime = datetime.now()
+        self._trial_start_ns = time.perf_counter_ns()
 
     def _stop_clock(self):
-        self._trial_etime = datetime.now()
+        self._trial_end_ns = time.perf_counter_ns()
 
     def get_trial_time(self):
-        diff = self._trial_etime - self._trial_stime
-        return diff.total_seconds()
+        return (self._trial_end_ns - self._trial_start_ns) / 1e9
 
     def precmd(self, line):
-        self.answered = False
-        self._stop_clock()
-        return line
+        with INSTRUMENTS.timer(self._basename, 'precmd'):
+            self.answered = False
+            self._stop_clock()
+            return line
 
     def postcmd(self,stop,line):
-        if not stop and self.answered:
-            self.cur_pos = self.get_random_position()
-            self._start_clock()
-            self.stdout.write("{} ? \n".format(self.cur_pos))
-        return stop
+        with INSTRUMENTS.timer(self._basename, 'postcmd'):
+            if not stop and self.answered:
+                self.cur_pos = self.next_position()
+                self._start_clock()
+                self.stdout.write("{} ? \n".format(self.cur_pos))
+            return stop
 
     def get_answer(self, line):
         raise NotImplementedError('You must override get_correct_answer')
@@ -327,29 +2476,79 @@ class RandomSquareGame(cmd.Cmd):
     def get_correct_answer(self, cur_position):
         raise NotImplementedError('You must override get_correct_answer')
 
+    @property
+    def uses_answer_cache(self):
+        '''Only the answers of 8x8 games are cached. There are a few
+        thousand of them, while on big boards there can be millions, and
+        answers such as knight routes grow with the board.'''
+        return self.cache_answers and self.size == 8
+
+    def correct_answer(self, position):
+        '''`get_correct_answer`, from `ANSWER_CACHE` if the game caches answers.'''
+        if self.uses_answer_cache:
+            return ANSWER_CACHE.get(self, position)
+        return self.get_correct_answer(position)
+
+    @property
+    def codec(self):
+        return get_codec(self.size)
+
+    def parse_position(self, position):
+        '''Returns `position` in the game's notation, i.e. "E4" -> "e:4", or
+        raises BadFormatError if it is not `position_squares` squares on the
+        board.'''
+        squares = self.codec.parse_names(position)
+        if len(squares) != self.position_squares:
+            raise BadFormatError('A position must be {} square(s). You gave {}\n'.format(
+                self.position_squares, position))
+        return ' '.join(squares)
+
+    def check_square(self, square):
+        '''Returns the name of `square`, i.e. "E4" -> "e:4", or raises
+        BadFormatError if it is not a square on the board.'''
+        return self.codec.name(self.codec.parse_square(square))
+
     def is_right_answer(self, answer, right_answer):
         return answer == right_answer
 
+    def get_feedback(self, cur_position):
+        '''Extra text shown after an answer has been graded.'''
+        return ''
+
+    def grade(self, position, line):
+        '''Grades the answer `line` to the prompt `position`. Returns the
+        parsed answer, the right answer and whether they match, or raises
+        BadFormatError.'''
+        with INSTRUMENTS.timer(self._basename, 'get_answer'):
+            answer = self.get_answer(line)
+        with INSTRUMENTS.timer(self._basename, 'get_correct_answer'):
+            right_answer = self.correct_answer(position)
+        return answer, right_answer, self.is_right_answer(answer, right_answer)
+
     def onecmd(self, line):
         if line is None:
             return self.emptyline()
+        if line == 'EOF':
+            # The input ended, i.e. Ctrl+D or the end of a piped file.
+            self.stdout.write('\n')
+            return True
         try:
-            answer = self.get_answer(line)
+            answer, right_answer, correct = self.grade(self.cur_pos, line)
         except BadFormatError as e:
             self.stdout.write(e.args[0])
             self.answered = False
             stop = False
             return stop 
         self.answered = True
-        right_answer = self.get_correct_answer(self.cur_pos)
-        if self.is_right_answer(answer, right_answer):
+        from datetime import datetime
+        if correct:
             self.stdout.write("Correct!\n")
-            correct = True
         else:
             self.stdout.write("Incorrect! Answer was {}\n".format(right_answer))
-
-            correct = False
+        self.stdout.write(self.get_feedback(self.cur_pos))
         round_number = len(self.round_results) + 1
+        if INSTRUMENTS.enabled:
+            INSTRUMENTS.record(self._basename, 'think', self._trial_end_ns - self._trial_start_ns)
         self.round_results.append(Round(
             number=round_number,
             correct=int(correct),
@@ -358,6 +2557,8 @@ class RandomSquareGame(cmd.Cmd):
             answer=answer, 
             utc_datetime=str(datetime.now())
             ))
+        if self._scheduler is not None:
+            self._scheduler.update(self.round_results[-1])
         if round_number >= self.rounds:
             stop = True
         else:
@@ -365,102 +2566,163 @@ class RandomSquareGame(cmd.Cmd):
         return stop
 
     def compute_statistics(self,results):
-        correct = 0.0
-        incorrect = 0.0
-        total_time = 0.0
-        for trial in results:
-            correct +=int(trial.correct)
-            incorrect +=int(not int(trial.correct))
-            total_time += float(trial.total_time)
-        avg_time = round(total_time/len(results), 2)
-        perc_correct = round(correct/len(results), 3)
-        statistic = {'num_correct': correct, 'num_results': len(results),
-                'perc_correct': perc_correct, 'avg_time': avg_time}
-        return statistic
+        '''`results` is either a `TrialSummary` or an iterable of `Round`s
+        and `TrialSummary`s, like `read_trials(archived=True)`.'''
+        if isinstance(results, TrialSummary):
+            return results.statistics()
+        summary = TrialSummary()
+        for result in results:
+            if isinstance(result, TrialSummary):
+                summary.merge(result)
+            else:
+                summary.add(result)
+        return summary.statistics()
 
     def print_statistics(self,statistic):
         self.stdout.write("Number Correct: {} out of {}\n".format(int(statistic['num_correct']), statistic['num_results']))
         self.stdout.write("Percent Correct: {}\n".format(statistic['perc_correct']))
         self.stdout.write("Average time per answer in seconds: {}\n".format(statistic['avg_time']))
+        self.stdout.write("Standard deviation of answer times in seconds: {}\n".format(statistic['std_time']))
+        self.stdout.write("Answer time percentiles in seconds: 50% {}, 90% {}, 99% {}\n".format(
+            statistic['p50_time'], statistic['p90_time'], statistic['p99_time']))
+        # See chessanalytics.heatmaps
+        for title, heatmap in statistic.get('heatmaps', ()):
+            self.stdout.write("{}:\n{}\n".format(title, heatmap))
+
+    def print_slowest_positions(self, summary, count):
+        '''Prints the `count` positions of a `TrialSummary` with the highest
+        average answer time.'''
+        averages = sorted(((tally[2] / tally[0], position, tally) for position, tally in summary.positions.items()),
+                reverse=True)
+        self.stdout.write("Slowest positions:\n")
+        for average, position, tally in averages[:count]:
+            self.stdout.write("{}: {} seconds, {} out of {} correct\n".format(position, round(average, 2), tally[1], tally[0]))
 
     @property
     def name(self):
         return self.prompt.replace("(","").replace(")", "")
 
+    @property
+    def _basename(self):
+        return log_basename(self.name, self.size)
+
     @property
     def filename(self):
-        return self.name + '.csv'
+        return os.path.join(self.directory, self._basename + '.trials')
 
-    def log_trials(self, results):
-        file_exists = os.path.exists(self.filename)
-        if not file_exists:
-            mode = 'w+'
+    @property
+    def csv_filename(self):
+        '''Where older versions of the trainer logged this game'''
+        return os.path.join(self.directory, self._basename + '.csv')
+
+    def has_trials(self):
+        return self.flushed_trial_log().exists()
+
+    def flushed_trial_log(self):
+        '''`open_trial_log`, once the writer has written every round
+        submitted so far. Anything that reads the history should use this.'''
+        if self.writer is not None:
+            self.writer.flush()
+        return self.open_trial_log()
+
+    def all_time_summary(self):
+        '''The `TrialSummary` of the game's log and the rounds the writer
+        has not written to it yet, without waiting for them.'''
+        trial_log = self.open_trial_log()
+        if self.writer is None:
+            return trial_log.summary()
+        with self.writer.pending(trial_log) as rounds:
+            summary = trial_log.summary()
+        summary.update(rounds)
+        return summary
+
+    def open_trial_log(self):
+        '''Returns this game's `TrialLog`, or `SqliteTrialLog` if the game
+        has a database, copying in an old CSV log the first time it is opened.'''
+        if self.database is not None:
+            trial_log = SqliteTrialLog(self.database, self._basename, self.size)
         else:
-            mode = 'a'
-        with open(self.filename, mode=mode)  as f:
-            writer = csv.DictWriter(f,fieldnames=Round._fields)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerows(x._asdict() for x in results)
-
-    def read_trials(self):
-        with open(self.filename, mode='r')  as f:
-            reader = csv.reader(f)
-            header = reader.__next__()
-            for row in reader:
-                yield Round(*row)
+            trial_log = TrialLog(self.filename, self.size)
+        if not trial_log.exists() and os.path.exists(self.csv_filename):
+            trial_log.append(read_csv_log(self.csv_filename))
+        return trial_log
+
+    def log_trials(self, results):
+        with INSTRUMENTS.timer(self._basename, 'log_trials'):
+            if self.writer is not None:
+                self.writer.submit(self.open_trial_log(), results)
+            else:
+                self.open_trial_log().append(results)
+
+    def read_trials(self, archived=False):
+        '''Yields the `Round`s in the game's log. With `archived`, first
+        yields a `TrialSummary` for every day that has been compacted out of
+        the log, so that `compute_statistics` of the result is all-time.'''
+        trial_log = self.flushed_trial_log()
+        if not trial_log.exists():
+            return
+        with trial_log.archived_view() as (archive, trials):
+            if archived:
+                for day in sorted(archive.days):
+                    yield archive.day_summary(day)
+            for trial in trials:
+                yield trial
 
     def postloop(self):
+        # The history is read before this session is logged, because with a
+        # writer the session may not be in the log yet.
+        all_time = self.all_time_summary()
         self.log_trials(self.round_results)
-        this_session = self.compute_statistics(self.round_results)
+        this_session = TrialSummary()
+        this_session.update(self.round_results)
         self.stdout.write("\nSession Finished! Stats for this session:\n")
-        self.print_statistics(this_session)
-        all_time_rounds = tuple(self.read_trials())
+        self.print_statistics(self.compute_statistics(this_session))
         self.stdout.write("\nAll-time stats:\n")
-        all_time_stats = self.compute_statistics(all_time_rounds)
+        all_time.merge(this_session)
+        all_time_stats = self.compute_statistics(all_time)
         self.print_statistics(all_time_stats)
 
         
+@register_game('colorgame', help='''Displays a random square on the chess board, repeatedly. 'colorgame 10' would play the game for 10 trials and 'colorgame 10 12' for 10 trials on a 12x12 board. Add '--adaptive' to drill the squares you are weakest at. Respond with 'w' for 'white' and 'b' for black. Displays statistics at the end.''')
 class ColorGame(RandomSquareGame):
     intro="Enter the color ('w' or 'b') of the random position generated"
     prompt='(color-square)'
+    cache_answers = True
     
     def get_answer(self, line):
-        if not color_regex.match(line):
-            raise BadFormatError('Answer must match {}\n'.format(clor_regex))
-        return line
+        return parse_color(line.strip())
 
     def get_correct_answer(self, cur_position):
         return get_color(cur_position)
 
 
+@register_game('brothergame', help='''play "brothers square" chess game.''')
 class BrotherSquareGame(RandomSquareGame):
     intro="Enter the square (.e.g a1) and then the color ('w' or 'b') seperated \
             by a space of the brother square generated."
     
     prompt='(brother-square)'
+    cache_answers = True
     
     def get_answer(self, line):
         args = line.split()
         if len(args) != 2:
             raise BadFormatError('Answer must come in the form of "<square> <color>"\n')
         square, color = args
-        if not move_regex.match(square):
-            raise BadFormatError('Square must match {}. You gave {}\n'.format(mv_regex, square))
-        if not color_regex.match(color):
-            raise BadFormatError('Color must match {}. You gave {}\n'.format(clor_regex, color))
-        return square, color
+        return self.check_square(square), parse_color(color)
 
     def get_correct_answer(self, cur_position):
-        brother_square = get_brother_square(cur_position)
+        brother_square = get_brother_square(cur_position, self.size)
         brother_color = get_color(brother_square)
         return brother_square, brother_color
 
+@register_game('diagonal', help='''play "diagonal" chess game.''')
 class DiagonalSquareGame(RandomSquareGame):
     intro="enter all the diagonals of the random square, followed"+ \
     " by a color"
     
     prompt='(diag)'
+    cache_answers = True
     
     def get_answer(self, line):
         args = line.split()
@@ -468,54 +2730,209 @@ class DiagonalSquareGame(RandomSquareGame):
         if len(args) <= guess:
             raise BadFormatError('Answer must come in the form of "<square> <square> ... <color>"\n')
         
-        squares = args[:-1]
-        color  = args[-1]
-        for square in squares:
-            if not move_regex.match(square):
-                raise BadFormatError('Square must match {}. You gave {}\n'.format(mv_regex, square))
-        if not color_regex.match(color):
-            raise BadFormatError('Color must match {}. You gave {}\n'.format(clor_regex, color))
-        return sorted(squares) + [color]
+        squares = self.codec.parse_names(args[:-1])
+        return sorted(squares) + [parse_color(args[-1])]
 
     def get_correct_answer(self, cur_position):
-        diagonal_squares = get_diagonal_squares(cur_position)
+        diagonal_squares = get_diagonal_squares(cur_position, self.size)
         color = get_color(cur_position)
         answer = diagonal_squares + [color]
         return answer 
 
+# ChessVisualizationTrainer.do_knightgame has options of its own.
+@register_game('knightgame')
 class KnightSquareGame(RandomSquareGame):
     intro="given a start and end position for a knight, give *one of* the shortest routes."
     
     prompt='(knight)'
+    cache_answers = True
+    position_squares = 2
 
     def get_random_position(self):
-        start = get_random_position(xmin=1,xmax=8,ymin=1,ymax=1)
-        end = get_random_position(xmin=1,xmax=8,ymin=8,ymax=8)
+        start = get_random_position(ymin=1,ymax=1,size=self.size,rng=self.rng)
+        end = get_random_position(ymin=self.size,ymax=self.size,size=self.size,rng=self.rng)
         return "{} {}".format(start, end)
 
+    def all_positions(self):
+        return ["{} {}".format(get_chess_notation(x1, 1), get_chess_notation(x2, self.size))
+                for x1 in range(1, self.size + 1) for x2 in range(1, self.size + 1)]
+
     def get_answer(self, line):
         args = line.split()
         if len(args) < 2:
             raise BadFormatError('Answer must come in the form of "<square> <square> ... <square>"\n')
-        
-        for square in args:
-            if not move_regex.match(square):
-                raise BadFormatError('Square must match {}. You gave {}\n'.format(mv_regex, square))
-        return args 
+        return self.codec.parse_names(args)
 
     def get_correct_answer(self, cur_position):
         start, end = cur_position.split()
-        answer = find_shortest_path_for_knight(start, end)
+        answer = find_shortest_path_for_knight(start, end, self.size)
         return answer 
 
     def is_right_answer(self, answer, right_answer):
-        return is_a_shortest_path_for_knight(answer, right_answer)
+        return is_a_shortest_path_for_knight(answer, right_answer, self.size)
+
+    def get_feedback(self, cur_position):
+        if self.size != 8:
+            return ''
+        start, end = cur_position.split()
+        count = count_shortest_paths_for_knight(start, end)
+        if count == 1:
+            return "There is 1 shortest route.\n"
+        return "There are {} shortest routes.\n".format(count)
+
+class PieceSquareGame(RandomSquareGame):
+    '''Name every square `piece` attacks from the random square.'''
+    piece = None
+    cache_answers = True
+
+    def get_answer(self, line):
+        squares = line.split()
+        if not squares:
+            raise BadFormatError('Answer must come in the form of "<square> <square> ... <square>"\n')
+        return sorted(self.codec.parse_names(squares))
+
+    def get_correct_answer(self, cur_position):
+        return get_attacked_squares(self.piece, cur_position, self.size)
+
+@register_game('rookgame', help='''play "rook" chess game, where you name every square a rook attacks.''')
+class RookSquareGame(PieceSquareGame):
+    intro="enter all the squares a rook on the random square attacks"
+
+    prompt='(rook)'
+    piece='rook'
+
+@register_game('queengame', help='''play "queen" chess game, where you name every square a queen attacks.''')
+class QueenSquareGame(PieceSquareGame):
+    intro="enter all the squares a queen on the random square attacks"
+
+    prompt='(queen)'
+    piece='queen'
+
+GAMES = tuple(entry.factory for entry in GAME_REGISTRY.values())
+
+def format_answer(answer):
+    '''Turns a game's `get_correct_answer` into what a player would type,
+    i.e. ('h:8', 'b') -> "h:8 b"'''
+    if isinstance(answer, str):
+        return answer
+    return ' '.join(answer)
+
+ANSWER_FILE_HEADER = ['game', 'position', 'answer', 'time']
+
+def read_answer_file(f):
+    '''Yields (game, position, answer, time) rows from an open CSV answer
+    sheet, i.e. "knight,a:1 h:8,a:1 c:2 ... h:8,12.5". The header row is
+    optional.'''
+    import csv
+    reader = csv.reader(f)
+    for row in reader:
+        if row == ANSWER_FILE_HEADER:
+            continue
+        yield row
+
+def grade_answers(rows, size=8, database=None, chunk_size=1000, stdout=None):
+    '''Grades (game, position, answer, time) rows without playing the games
+    and appends them to each game's trial log, `chunk_size` rounds at a time.
+    Rows that cannot be graded are reported to `stdout` and skipped, and the
+    statistics of each game's graded rounds are printed at the end.
+    Returns a dict of game name -> `TrialSummary` of the graded rounds.'''
+    if stdout is None:
+        stdout = sys.stdout
+    games = {}
+    for game_class in GAMES:
+        game = game_class(size=size, database=database)
+        game.stdout = stdout
+        games[game.name] = game
+    summaries = {name: TrialSummary() for name in games}
+
+    def flush(game):
+        game.log_trials(game.round_results)
+        summaries[game.name].update(game.round_results)
+        game.round_results = []
+
+    from datetime import datetime
+    numbers = dict.fromkeys(games, 0)
+    for row_number, row in enumerate(rows, 1):
+        try:
+            name, position, line, total_time = row
+            game = games[name]
+            position = game.parse_position(position)
+            answer, right_answer, correct = game.grade(position, line)
+            total_time = float(total_time)
+        except BadFormatError as e:
+            stdout.write('Row {}: {}'.format(row_number, e.args[0]))
+            continue
+        except (KeyError, ValueError):
+            stdout.write('Row {}: cannot grade {}\n'.format(row_number, row))
+            continue
+        numbers[name] += 1
+        game.round_results.append(Round(
+            number=numbers[name],
+            correct=int(correct),
+            total_time=total_time,
+            position=position,
+            answer=answer,
+            utc_datetime=str(datetime.now())
+            ))
+        if len(game.round_results) >= chunk_size:
+            flush(game)
+    for game in games.values():
+        if game.round_results:
+            flush(game)
+        if summaries[game.name].records:
+            stdout.write("\nGraded stats for {}:\n".format(game.name))
+            game.print_statistics(game.compute_statistics(summaries[game.name]))
+    return {name: summary for name, summary in summaries.items() if summary.records}
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='A chess visualization trainer.')
+    parser.add_argument('--database', help='keep the history of every game in this SQLite database')
+    parser.add_argument('--grade', metavar='FILE',
+            help="grade a CSV answer sheet of game,position,answer,time rows ('-' for stdin) and exit")
+    parser.add_argument('--size', type=int, default=8, help='the board size for --grade and --build-puzzles')
+    parser.add_argument('--fsync', action='store_true', help='sync every write to the history to disk')
+    parser.add_argument('--puzzles', metavar='FILE', help='take knight puzzles from this puzzle bank')
+    parser.add_argument('--build-puzzles', metavar='FILE',
+            help='build a puzzle bank of every piece for --size boards, save it to FILE and exit')
+    parser.add_argument('--workers', type=int, help='processes to build the puzzle bank with')
+    parser.add_argument('--timings', metavar='FILE',
+            help='save the timings of every phase of the rounds to FILE on exit, in the Prometheus text format if it ends in .prom and as JSON otherwise')
+    parser.add_argument('--answer-cache', metavar='FILE',
+            help='load the answer cache from FILE, or fill it if FILE does not exist, and save it on exit')
+    args = parser.parse_args()
+    if args.build_puzzles:
+        bank = PuzzleBank.build(args.size, workers=args.workers)
+        bank.save(args.build_puzzles)
+        print('Saved {} puzzles in {} groups to {}'.format(len(bank.pairs) // 2, len(bank.groups), args.build_puzzles))
+        sys.exit(0)
+    if args.grade:
+        f = sys.stdin if args.grade == '-' else open(args.grade, newline='')
+        with f:
+            grade_answers(read_answer_file(f), size=args.size, database=args.database)
+        sys.exit(0)
+    if args.answer_cache:
+        if os.path.exists(args.answer_cache):
+            ANSWER_CACHE.load(args.answer_cache)
+        else:
+            for game in GAMES:
+                ANSWER_CACHE.warm(game())
+    writer = TrialWriter(fsync=args.fsync)
     try:
-        ChessVisualizationTrainer().cmdloop()
+        ChessVisualizationTrainer(database=args.database, writer=writer, puzzles=args.puzzles).cmdloop()
     except KeyboardInterrupt:
         print('')
         print('Thanks for playing!')
         sys.exit(0)
+    finally:
+        writer.close()
+        if args.answer_cache:
+            ANSWER_CACHE.save(args.answer_cache)
+        if args.timings:
+            with open(args.timings, 'w') as f:
+                if args.timings.endswith('.prom'):
+                    f.write(INSTRUMENTS.to_prometheus())
+                else:
+                    import json
+                    json.dump(INSTRUMENTS.to_dict(), f, indent=2)
 
@@ -0,0 +1,107 @@
+import io
+import json
+import time
+from datetime import datetime
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import chessanalytics as ca
+import chesstrainer as ct
+
+
+def _history():
+    return [ct.Round(1, 1, 1.0, 'e:4 f:6', 'f:6', '2020-01-01 10:00:00'),
+            ct.Round(2, 0, 4.0, 'e:4 f:6', 'f:6', '2020-01-05 10:00:00'),
+            ct.Round(3, 1, 2.0, 'a:1 b:3', 'b:3', '2020-01-06 10:00:00'),
+            ct.Round(4, 1, 3.0, 'e:5 c:4', 'c:4', '2020-01-07 23:30:00')]
+
+def test_history(tmp_path):
+    for log in (ct.TrialLog(str(tmp_path / 'knight.trials')),
+                ct.SqliteTrialLog(str(tmp_path / 'history.db'), 'knight')):
+        log.append(_history())
+        history = ca.History.load(log)
+        rounds, correct, avg_time = history.squares()
+        e4 = (3, 4)
+        assert (rounds[e4], correct[e4], avg_time[e4]) == (2, 0.5, 2.5)
+        assert rounds.sum() == 4 and np.isnan(correct[7, 7])
+        rounds, correct, avg_time = history.pairs()
+        assert rounds[ct.get_square_id('e:4'), ct.get_square_id('f:6')] == 2
+        assert rounds.sum() == 4
+        starts, ends, rounds, correct, avg_time = history.played_pairs()
+        assert [ct.get_square_name(end) for end in ends] == ['b:3', 'f:6', 'c:4'] and rounds.tolist() == [1, 2, 1]
+        starts, rounds, correct, avg_time = history.trend()
+        assert [str(start) for start in starts] == ['2020-01-01', '2020-01-05', '2020-01-06', '2020-01-07']
+        # Weeks start on Thursdays, like 1970-01-01.
+        starts, rounds, correct, avg_time = history.trend(days=7)
+        assert [str(start) for start in starts] == ['2019-12-26', '2020-01-02'] and rounds.tolist() == [1, 3]
+
+        assert len(ca.History.load(log, since='2020-01-06 00:00:00')) == 2
+        assert len(ca.History.load(log, file='e')) == 3
+        assert len(ca.History.load(log, last=1)) == 1
+
+        # Compacted rounds are still in the analytics.
+        log.compact('2020-01-06 00:00:00')
+        compacted = ca.History.load(log)
+        assert compacted.squares()[0].tolist() == history.squares()[0].tolist()
+        assert compacted.squares()[1][e4] == 0.5
+        assert len(ca.History.load(log, since='2020-01-05 12:00:00')) == 3
+        assert len(ca.History.load(log, last=10)) == 2
+
+def test_local_time(monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        dates = ['2021-03-13 12:00:00', '2021-03-14 01:30:00', '2021-03-14 03:30:00', '2021-11-07 23:00:00']
+        timestamps = np.array([datetime.fromisoformat(date).timestamp() for date in dates])
+        expected = np.array(dates, dtype='datetime64[s]').astype(np.int64)
+        assert ca._local_seconds(timestamps).tolist() == expected.tolist()
+    finally:
+        monkeypatch.delenv('TZ')
+        time.tzset()
+
+def test_heatmaps_and_export(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    game = ct.KnightSquareGame()
+    game.log_trials(_history())
+    history = ca.History.load(game.open_trial_log())
+    reports = dict(ca.heatmaps(history))
+    assert reports['Percent correct by square'].splitlines()[4].split() == ['4', '.', '.', '.', '.', '50', '.', '.', '.']
+    assert reports['Slowest pairs'].splitlines()[0] == 'e:5 c:4: 3.00 seconds, 1 out of 1 correct'
+
+    ca.export(history, 'knight.json')
+    with open('knight.json') as f:
+        report = json.load(f)
+    assert report['rounds'] == 4 and report['squares']['rounds'][3][4] == 2
+    assert {'position': 'a:1 b:3', 'rounds': 1, 'perc_correct': 1.0, 'avg_time': 2.0} in report['pairs']
+    assert len(report['pairs']) == 3
+    ca.export(history, 'knight.csv')
+    with open('knight.csv') as f:
+        rows = f.read().splitlines()
+    assert rows[0] == 'kind,key,rounds,perc_correct,avg_time'
+    assert 'square,e:4,2,0.5,2.5' in rows and 'pair,e:4 f:6,2,0.5,2.5' in rows and 'day,2020-01-07,1,1.0,3.0' in rows
+
+    trainer = ct.ChessVisualizationTrainer(stdout=io.StringIO())
+    trainer.onecmd('getstats knight --heatmaps --export knight.csv')
+    output = trainer.stdout.getvalue()
+    assert 'Average answer time by square in seconds:' in output
+    assert 'Saved the analytics to knight.csv' in output
+
+def test_pairs_on_big_boards(tmp_path, monkeypatch):
+    import pytest
+    log = ct.SqliteTrialLog(str(tmp_path / 'history.db'), 'knight')
+    log.append(_history() * 3)
+    history = ca.History.load(log)
+    dense = history.played_pairs()
+    monkeypatch.setattr(ca, 'DENSE_PAIRS', 0)
+    assert [part.tolist() for part in history.played_pairs()] == [part.tolist() for part in dense]
+
+    log = ct.TrialLog(str(tmp_path / 'knight-300x300.trials'), size=300)
+    log.append([ct.Round(1, 1, 2.0, 'a:1 kn:300', 'a:1', '2020-01-01 10:00:00')])
+    history = ca.History.load(log)
+    starts, ends, rounds, correct, avg_time = history.played_pairs()
+    assert (ct.get_square_name(ends[0], 300), rounds.tolist()) == ('kn:300', [1])
+    assert ca.to_dict(history)['pairs'] == [{'position': 'a:1 kn:300', 'rounds': 1, 'perc_correct': 1.0, 'avg_time': 2.0}]
+    with pytest.raises(ValueError):
+        history.pairs()
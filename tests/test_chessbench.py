@@ -0,0 +1,42 @@
+import io
+
+import chessbench as cb
+
+
+def test_benchmarks_and_regressions():
+    results = cb.run(max_rounds=1000, repeat=1, stdout=io.StringIO(), min_time=0)
+    assert set(results['benchmarks']) == {'knight_paths', 'knight_path_checks', 'diagonal_squares', 'parse_answers',
+        'compute_statistics[1000]', 'log_trials[1000]', 'read_trials[1000]',
+        'read_csv_log[1000]'} \
+        | ({'analytics[1000]'} if cb.chessanalytics is not None else set())
+    assert results['benchmarks']['read_trials[1000]']['ops'] == 1000
+    assert cb.compare(results, results) == []
+    baseline = {'benchmarks': {name: dict(result, ns_per_op=result['ns_per_op'] / 2)
+                               for name, result in results['benchmarks'].items()}}
+    assert cb.compare(results, baseline, threshold=0.5) == list(results['benchmarks'])
+    assert cb.compare(results, baseline, threshold=1.5) == []
+
+def test_measure():
+    calls = []
+    def sleepy(rounds):
+        calls.append(rounds)
+        return 10, 0.01
+    import pytest
+    ops, seconds = cb.measure(sleepy, 1000, min_time=0.045)
+    assert (ops, seconds) == (10, pytest.approx(0.001)) and calls == [1000] * 5
+
+def test_startup_time():
+    assert cb.startup_time(repeat=1) > 0
+    assert cb.startup_ratio(repeat=5) <= cb.STARTUP_BUDGET
+    assert cb.main(['--startup-budget', '100']) == 0
+
+def test_baseline_platform():
+    import pytest
+    results = {'python': '3.11.7', 'machine': 'x86_64', 'system': 'Linux',
+               'benchmarks': {'knight_paths': {'ns_per_op': 100.0}}}
+    older = {'python': '3.11.7', 'machine': 'x86_64', 'benchmarks': {}}
+    assert cb.compare(results, older) == []
+    with pytest.raises(ValueError, match='python 3.8.10'):
+        cb.compare(results, dict(results, python='3.8.10'))
+    with pytest.raises(ValueError, match='machine arm64'):
+        cb.compare(results, dict(results, machine='arm64'))
@@ -0,0 +1,48 @@
+import asyncio
+import os
+
+import chessserver as cs
+import chesstrainer as ct
+
+
+def test_load_generator_against_server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run():
+        trainer = cs.TrainerServer()
+        server = await asyncio.start_server(trainer.handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            report = await cs.generate_load('127.0.0.1', port, players=12, concurrency=4,
+                                            rounds=3, accuracy=1.0, seed=1)
+        trainer.close()
+        return trainer, report
+
+    trainer, report = asyncio.run(run())
+    assert report['sessions'] == 12 and report['failures'] == 0
+    assert trainer.sessions == 12
+    summaries = [game().open_trial_log().summary() for game in ct.GAMES if os.path.exists(game().filename)]
+    assert sum(summary.records for summary in summaries) == 36
+    assert all(summary.num_correct == summary.records for summary in summaries)
+
+def test_board_sizes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run():
+        trainer = cs.TrainerServer(max_size=16)
+        server = await asyncio.start_server(trainer.handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            report = await cs.generate_load('127.0.0.1', port, players=3, concurrency=3,
+                                            rounds=2, accuracy=1.0, seed=1, size=12)
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            await cs.read_reply(reader)
+            writer.write(b'knight 1 1000\n')
+            reply = await cs.read_reply(reader)
+            writer.close()
+        trainer.close()
+        return report, reply
+
+    report, reply = asyncio.run(run())
+    assert report['sessions'] == 3 and report['failures'] == 0
+    assert reply[0] == 'Bad arguments: Board size must be at most 16'
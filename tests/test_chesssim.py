@@ -0,0 +1,40 @@
+import chesssim as cs
+import chesstrainer as ct
+
+
+def test_scripted_session(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    game = cs.play_session(ct.ColorGame, cs.ScriptedPlayer(['x', 'w', 'b']), rounds=5)
+    assert len(game.round_results) == 2
+    assert "Color must be 'w' or 'b'. You gave x" in game.stdout.getvalue()
+    assert 'All-time stats' in game.stdout.getvalue()
+    assert len(game.open_trial_log()) == 2
+    game.preloop()
+    assert game.intro.count('GO!') == 1
+
+def test_simulate(tmp_path):
+    report = cs.simulate(30, rounds=3, accuracy=1.0, seed=1, directory=str(tmp_path))
+    assert (report['sessions'], report['failures'], report['rounds']) == (30, 0, 90)
+    assert report['peak_rss_mb'] > 0
+    summaries = [ct.TrialLog(str(tmp_path / game().filename)).summary() for game in ct.GAMES]
+    assert sum(summary.records for summary in summaries) == 90
+    assert all(summary.num_correct == summary.records for summary in summaries)
+
+    pooled = cs.simulate(30, ['knight', 'diag'], rounds=3, seed=1, workers=2, database='history.db',
+                         directory=str(tmp_path))
+    assert (pooled['sessions'], pooled['rounds']) == (30, 90)
+    logs = [ct.SqliteTrialLog(str(tmp_path / 'history.db'), name) for name in ('knight', 'diag')]
+    assert sum(len(log) for log in logs) == 90
+
+def test_sessions_replay(tmp_path):
+    import os
+    import random
+    state, cwd = random.getstate(), os.getcwd()
+    for name in ('first', 'second'):
+        (tmp_path / name).mkdir()
+        cs.simulate(10, ['knight', 'color-square'], rounds=3, seed=2, directory=str(tmp_path / name))
+    assert random.getstate() == state and os.getcwd() == cwd
+    def positions(name):
+        return [[round.position for round in game(directory=str(tmp_path / name)).read_trials()]
+                for game in (ct.KnightSquareGame, ct.ColorGame)]
+    assert positions('first') == positions('second') and sum(map(len, positions('first'))) == 30
@@ -1,3 +1,5 @@
+import os
+
 import chesstrainer as ct
 
 def test_get_brother_square():
@@ -58,3 +60,534 @@ def test_is_a_shortest_path_for_knight():
     nonexistant_path = ct.is_a_shortest_path_for_knight(['d:1', 'h:8'], a_shortest_path) 
     assert nonexistant_path == False
 
+
+def test_get_knight_distance():
+    assert ct.get_knight_distance("a:1", "a:1") == 0
+    assert ct.get_knight_distance("a:1", "b:3") == 1
+    assert ct.get_knight_distance("a:1", "h:8") == 6
+    assert ct.get_knight_distance("a:1", "b:2") == 4
+    for start, end in (("a:1", "h:8"), ("d:1", "h:8"), ("h:1", "a:8")):
+        path = ct.find_shortest_path_for_knight(start, end)
+        assert path[0] == start and path[-1] == end
+        assert len(path) == ct.get_knight_distance(start, end) + 1
+
+def test_shortest_paths_for_knight():
+    assert ct.count_shortest_paths_for_knight("a:1", "a:1") == 1
+    assert ct.count_shortest_paths_for_knight("a:1", "d:4") == 2
+    paths = sorted(ct.generate_shortest_paths_for_knight("a:1", "d:4"))
+    assert paths == [['a:1', 'b:3', 'd:4'], ['a:1', 'c:2', 'd:4']]
+
+    for start, end in (("a:1", "h:8"), ("d:1", "h:8"), ("b:1", "g:8")):
+        paths = list(ct.generate_shortest_paths_for_knight(start, end))
+        assert len(paths) == ct.count_shortest_paths_for_knight(start, end)
+        assert len(set(map(tuple, paths))) == len(paths)
+        reference = ct.find_shortest_path_for_knight(start, end)
+        assert all(ct.is_a_shortest_path_for_knight(path, reference) for path in paths)
+
+def test_is_a_shortest_path_for_knight_checks_endpoints():
+    a_shortest_path = ct.find_shortest_path_for_knight("a:1", "d:4")
+    assert not ct.is_a_shortest_path_for_knight(['h:8', 'f:7', 'd:6'], a_shortest_path)
+    assert not ct.is_a_shortest_path_for_knight(['a:1', 'b:3', 'c:5'], a_shortest_path)
+
+def test_square_indexes_and_bitboards():
+    assert ct.SQUARE_INDEXES['a:1'] == 0
+    assert ct.SQUARE_INDEXES['h:8'] == 63
+    assert ct.SQUARE_NAMES[ct.SQUARE_INDEXES['e:4']] == 'e:4'
+    assert ct.brother_square(ct.SQUARE_INDEXES['e:4']) == ct.SQUARE_INDEXES['d:5']
+    assert ct.COLOR_NAMES[ct.square_color(ct.SQUARE_INDEXES['a:1'])] == 'b'
+    assert ct.COLOR_NAMES[ct.square_color(ct.SQUARE_INDEXES['h:1'])] == 'w'
+    a1_knight = ct.KNIGHT_ATTACKS[ct.SQUARE_INDEXES['a:1']]
+    assert sorted(ct.SQUARE_NAMES[i] for i in ct.iter_bits(a1_knight)) == ['b:3', 'c:2']
+    assert bin(ct.BISHOP_ATTACKS[ct.SQUARE_INDEXES['e:4']]).count('1') == 13
+
+def test_get_attacked_squares():
+    assert ct.get_attacked_squares('rook', 'a:1') == sorted(
+        ['a:2', 'a:3', 'a:4', 'a:5', 'a:6', 'a:7', 'a:8',
+         'b:1', 'c:1', 'd:1', 'e:1', 'f:1', 'g:1', 'h:1'])
+    assert ct.get_attacked_squares('king', 'a:1') == ['a:2', 'b:1', 'b:2']
+    assert ct.get_attacked_squares('knight', 'a:1') == ['b:3', 'c:2']
+    assert len(ct.get_attacked_squares('queen', 'd:4')) == 27
+    assert ct.get_attacked_squares('bishop', 'e:4') == ct.get_diagonal_squares('e:4')
+
+def test_rook_square_game():
+    game = ct.RookSquareGame()
+    answer = game.get_answer('a:8 a:2 a:3 a:4 a:5 a:6 a:7 h:1 b:1 c:1 d:1 e:1 f:1 g:1')
+    assert game.is_right_answer(answer, game.get_correct_answer('a:1'))
+
+def test_file_names():
+    assert ct.get_file_name(8) == 'h'
+    assert ct.get_file_name(27) == 'aa'
+    assert ct.get_file_number('zz') == 702
+    assert ct.get_num_notation('aa:100') == (27, 100)
+    assert ct.get_chess_notation(27, 100) == 'aa:100'
+
+def test_knight_distance_on_big_boards():
+    for start in ct.SQUARE_NAMES:
+        for end in ct.SQUARE_NAMES:
+            expected = ct.get_knight_distance(start, end)
+            x1, y1 = ct.get_num_notation(start)
+            x2, y2 = ct.get_num_notation(end)
+            assert ct.knight_distance(x1, y1, x2, y2) == expected
+    assert ct.get_knight_distance('a:1', 'b:2', size=100) == 4
+    assert ct.get_knight_distance('a:1', 'a:100000', size=100000) == 50001
+    path = ct.find_shortest_path_for_knight('a:1', 'cv:100', size=100)
+    assert len(path) == ct.get_knight_distance('a:1', 'cv:100', size=100) + 1
+    assert ct.is_a_shortest_path_for_knight(path, path, size=100)
+
+def test_games_on_big_boards():
+    game = ct.BrotherSquareGame(size=12)
+    assert game.get_correct_answer('a:1') == ('l:12', 'b')
+    assert game.filename == 'brother-square-12x12.trials'
+    game = ct.KnightSquareGame(size=12)
+    answer = game.get_answer('a:1 b:3 c:5 d:7 e:9 f:11 h:12')
+    assert game.is_right_answer(answer, game.get_correct_answer('a:1 h:12'))
+
+def test_trial_log(tmp_path):
+    rounds = [
+        ct.Round(1, 1, 1.5, 'a:1 h:8', ['a:1', 'b:3'], '2020-01-02 03:04:05.000006'),
+        ct.Round(2, 0, 0.25, 'e:4', "('d:5', 'w')", '2020-01-02 03:04:06.500000'),
+    ]
+    log = ct.TrialLog(str(tmp_path / 'knight.trials'))
+    log.append(rounds[:1])
+    log.append(rounds[1:])
+    with log.view() as trials:
+        assert len(trials) == 2
+        assert trials[-1] == ct.Round(2, 0, 0.25, 'e:4', "('d:5', 'w')", '2020-01-02 03:04:06.500000')
+        assert list(trials)[0] == ct.Round(1, 1, 1.5, 'a:1 h:8', "['a:1', 'b:3']", '2020-01-02 03:04:05.000006')
+        logged = list(trials)
+    # Rounds are decoded lazily, and outlive the view they were read from.
+    assert logged[0].position == 'a:1 h:8' and logged[1].answer == "('d:5', 'w')"
+    assert logged[1].to_round() == rounds[1]._replace(answer="('d:5', 'w')") == logged[1]
+    assert tuple(logged[0])[3:] == ('a:1 h:8', "['a:1', 'b:3']", '2020-01-02 03:04:05.000006')
+    assert hash(logged[1]) == hash(logged[1].to_round())
+
+def test_convert_csv_log(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('color-square.csv', 'w') as f:
+        f.write('number,correct,total_time,position,answer,utc_datetime\n')
+        f.write('1,1,2.5,e:4,w,2020-01-02 03:04:05.000006\n')
+    game = ct.ColorGame()
+    assert game.has_trials()
+    game.log_trials([ct.Round(1, 0, 1.0, 'a:1', 'w', '2020-01-03 03:04:05.000006')])
+    trials = list(game.read_trials())
+    assert [(t.position, t.correct, t.total_time) for t in trials] == [('e:4', 1, 2.5), ('a:1', 0, 1.0)]
+
+def test_trial_summary(tmp_path):
+    log = ct.TrialLog(str(tmp_path / 'color-square.trials'))
+    log.append([ct.Round(1, 1, 1.0, 'a:1', 'b', '2020-01-02 03:04:05'),
+                ct.Round(2, 0, 3.0, 'a:1', 'w', '2020-01-02 03:04:06')])
+    log.append([ct.Round(1, 1, 2.0, 'e:4', 'w', '2020-01-02 03:04:07')])
+    summary = log.summary()
+    assert summary.records == 3
+    assert summary.positions == {'a:1': [2, 1, 4.0], 'e:4': [1, 1, 2.0]}
+    statistics = summary.statistics()
+    assert {key: statistics[key] for key in ('num_correct', 'num_results', 'perc_correct', 'avg_time', 'std_time')} \
+        == {'num_correct': 2, 'num_results': 3, 'perc_correct': 0.667, 'avg_time': 2.0, 'std_time': 0.82}
+    assert abs(statistics['p50_time'] - 2.0) < 0.2
+    assert abs(statistics['p99_time'] - 3.0) < 0.3
+    assert log.verify_summary()
+
+    with open(log.summary_path, 'w') as f:
+        f.write('{}')
+    assert not log.verify_summary()
+    assert log.summary().records == 3
+    assert log.verify_summary()
+    assert ct.TrialSummary().statistics()['num_results'] == 0
+
+def test_summary_waits_for_appends(tmp_path, monkeypatch):
+    log = ct.TrialLog(str(tmp_path / 'color-square.trials'))
+    log.append(_history())
+    read_summary = log._read_summary
+    reads = []
+    rebuilds = []
+    # The first read lands between an append's records and its summary.
+    monkeypatch.setattr(log, '_read_summary', lambda *args: read_summary(*args) if reads.append(1) or len(reads) > 1 else None)
+    monkeypatch.setattr(log, '_rebuild_summary', lambda: rebuilds.append(1))
+    assert log.summary().records == 4
+    assert len(reads) == 2 and not rebuilds
+
+def _history():
+    return [ct.Round(1, 1, 1.0, 'e:4', 'w', '2020-01-01 10:00:00'),
+            ct.Round(2, 0, 4.0, 'e:5', 'w', '2020-01-05 10:00:00'),
+            ct.Round(3, 1, 2.0, 'a:1', 'b', '2020-01-06 10:00:00'),
+            ct.Round(4, 1, 3.0, 'e:5', 'b', '2020-01-07 10:00:00')]
+
+def test_filtered_summaries(tmp_path):
+    logs = (ct.TrialLog(str(tmp_path / 'color-square.trials')),
+            ct.SqliteTrialLog(str(tmp_path / 'history.db'), 'color-square'))
+    for log in logs:
+        log.append(_history())
+        assert len(log) == 4
+        assert log.summary().statistics()['num_results'] == 4
+        assert log.summary(file='e').positions == {'e:4': [1, 1, 1.0], 'e:5': [2, 1, 7.0]}
+        assert log.summary(since='2020-01-05 00:00:00').records == 3
+        assert log.summary(since='2020-01-05 00:00:00', file='a').positions == {'a:1': [1, 1, 2.0]}
+        with log.view() as trials:
+            assert [trial.position for trial in trials] == ['e:4', 'e:5', 'a:1', 'e:5']
+
+def test_sqlite_game_history(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    game = ct.ColorGame(database='history.db')
+    assert not game.has_trials()
+    game.log_trials(_history())
+    assert ct.KnightSquareGame(database='history.db').has_trials() is False
+    assert [trial.number for trial in game.read_trials()] == [1, 2, 3, 4]
+    assert not os.path.exists(game.filename)
+
+def test_time_histogram_and_windows(tmp_path):
+    summary = ct.TrialSummary()
+    summary.update(ct.Round(i, 1, i / 100.0, 'a:1', 'b', '2020-01-01 00:00:00') for i in range(1, 1001))
+    assert abs(summary.histogram.percentile(50) - 5.0) / 5.0 < 0.06
+    assert abs(summary.histogram.percentile(90) - 9.0) / 9.0 < 0.06
+    assert abs(summary.statistics()['std_time'] - 2.89) < 0.01
+    merged = ct.TrialSummary()
+    merged.merge(summary)
+    merged.merge(ct.TrialSummary.from_sums(1, 1, 5.005, 5.005 ** 2))
+    assert merged.records == 1001 and abs(merged.mean_time - 5.005) < 1e-9
+
+    for log in (ct.TrialLog(str(tmp_path / 'color-square.trials')),
+                ct.SqliteTrialLog(str(tmp_path / 'history.db'), 'color-square')):
+        log.append(_history())
+        assert log.summary(last=2).positions == {'a:1': [1, 1, 2.0], 'e:5': [1, 1, 3.0]}
+        assert log.summary(last=3, file='e').records == 2
+
+def test_grade_answers(tmp_path, monkeypatch):
+    import io
+    monkeypatch.chdir(tmp_path)
+    sheet = io.StringIO('game,position,answer,time\n'
+                        'color-square,a:1,b,1.5\n'
+                        'color-square,a:1,w,2.5\n'
+                        'knight,a:1 d:4,a:1 c:2 d:4,10\n'
+                        'knight,a:1 d:4,a:1,3\n'
+                        'nogame,a:1,b,1\n')
+    output = io.StringIO()
+    summaries = ct.grade_answers(ct.read_answer_file(sheet), chunk_size=1, stdout=output)
+    assert {name: (s.records, s.num_correct) for name, s in summaries.items()} == {
+        'color-square': (2, 1), 'knight': (1, 1)}
+    assert 'Row 4:' in output.getvalue() and 'Row 5:' in output.getvalue()
+    assert [t.answer for t in ct.ColorGame().read_trials()] == ['b', 'w']
+
+    # Bad positions are reported, and the good rows of the chunk are kept.
+    sheet = io.StringIO('color-square,z:9,w,1.0\n'
+                        'color-square,A1,b,1.0\n'
+                        'knight,a:1,a:1 c:2,1.0\n'
+                        'brother-square,e:9,d:1 w,1.0\n')
+    output = io.StringIO()
+    summaries = ct.grade_answers(ct.read_answer_file(sheet), stdout=output)
+    assert {name: s.records for name, s in summaries.items()} == {'color-square': 1}
+    assert all('Row {}:'.format(row) in output.getvalue() for row in (1, 3, 4))
+    assert [t.position for t in ct.ColorGame().read_trials()][-1] == 'a:1'
+
+def test_trial_writer_groups_rounds(tmp_path):
+    log = ct.TrialLog(str(tmp_path / 'color-square.trials'))
+    database = ct.SqliteTrialLog(str(tmp_path / 'history.db'), 'color-square')
+    writer = ct.TrialWriter(max_rounds=6, max_delay=60)
+    for _ in range(3):
+        writer.submit(log, _history()[:2])
+        writer.submit(database, _history()[2:])
+    writer.flush()
+    assert len(log) == 6 and len(database) == 6
+    writer.submit(log, _history())
+    writer.close()
+    assert len(log) == 10 and log.verify_summary()
+
+def test_history_reads_flush_the_writer(tmp_path, monkeypatch):
+    import io
+    monkeypatch.chdir(tmp_path)
+    writer = ct.TrialWriter(max_delay=60)
+    game = ct.ColorGame(writer=writer, stdout=io.StringIO())
+    game.log_trials(_history())
+    trainer = ct.ChessVisualizationTrainer(writer=writer, stdout=io.StringIO())
+    trainer.onecmd('getstats color-square')
+    assert 'Number Correct: 3 out of 4' in trainer.stdout.getvalue()
+    game.log_trials(_history())
+    game.round_results = _history()[:1]
+    game.postloop()
+    assert 'Number Correct: 7 out of 9' in game.stdout.getvalue()
+    # Ending a session does not wait for its rounds to be written.
+    assert len(game.open_trial_log()) == 4
+    with writer.pending(game.open_trial_log()) as rounds:
+        assert len(rounds) == 5
+    writer.close()
+    assert len(game.open_trial_log()) == 9
+
+def test_concurrent_appends(tmp_path):
+    import threading
+    log_path = str(tmp_path / 'color-square.trials')
+    threads = [threading.Thread(target=lambda: [ct.TrialLog(log_path).append(_history()) for _ in range(10)])
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log = ct.TrialLog(log_path)
+    assert len(log) == 160 and log.verify_summary()
+    assert log.summary().records == 160
+
+def test_compact(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for game, compress in ((ct.ColorGame(), True), (ct.ColorGame(database='history.db'), False)):
+        game.log_trials(_history())
+        trial_log = game.open_trial_log()
+        before = trial_log.summary()
+        assert trial_log.compact('2020-01-06 00:00:00', compress) == 2
+        assert trial_log.compact('2020-01-06 00:00:00', compress) == 0
+        assert len(trial_log) == 2
+        assert trial_log.summary() == before
+        assert game.compute_statistics(game.read_trials(archived=True)) == before.statistics()
+        assert [trial.number for trial in game.read_trials()] == [3, 4]
+        assert trial_log.summary(file='e').positions == {'e:4': [1, 1, 1.0], 'e:5': [2, 1, 7.0]}
+        assert trial_log.summary(since='2020-01-05 12:00:00').records == 3
+        assert trial_log.summary(last=2).records == 2
+    assert os.path.exists('color-square.trials.archive.gz')
+
+def test_interrupted_compact(tmp_path, monkeypatch):
+    import pytest
+    log = ct.TrialLog(str(tmp_path / 'color-square.trials'))
+    log.append(_history() + _history())
+    before = log.summary()
+
+    def interrupt(*args):
+        raise KeyboardInterrupt
+    # Interrupted while writing the next generation: nothing changes.
+    monkeypatch.setattr(log, '_write_rounds', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        log.compact('2020-01-06 00:00:00')
+    monkeypatch.undo()
+    assert log.summary() == before and len(log) == 8 and not log.archive().days
+
+    # Interrupted after saving the archive: readers finish the compaction.
+    monkeypatch.setattr(log, '_swap_in', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        log.compact('2020-01-06 00:00:00')
+    monkeypatch.undo()
+    assert len(log) == 8 and log.archive().generation == 1
+    assert log.summary() == before and len(log) == 4
+    with log.view() as trials:
+        assert [(round.number, round.answer) for round in trials] == [(3, 'b'), (4, 'b')] * 2
+    assert log.compact('2020-01-06 00:00:00') == 0 and log.summary() == before
+    assert sorted(os.listdir(str(tmp_path))) == ['color-square.trials', 'color-square.trials.answers.1',
+        'color-square.trials.archive', 'color-square.trials.lock', 'color-square.trials.summary']
+
+def test_stats_on_big_boards(tmp_path, monkeypatch):
+    import io
+    monkeypatch.chdir(tmp_path)
+    ct.ColorGame(size=10).log_trials(_history())
+    trainer = ct.ChessVisualizationTrainer(stdout=io.StringIO())
+    trainer.onecmd('getstats color-square')
+    assert 'No games of color-square played yet' in trainer.stdout.getvalue()
+    trainer.onecmd('getstats color-square --size 10')
+    trainer.onecmd('verifystats --size 10')
+    trainer.onecmd('compact color-square --days 0 --size 10')
+    output = trainer.stdout.getvalue()
+    assert 'Number Correct: 3 out of 4' in output
+    assert 'color-square: ok' in output
+    assert 'color-square: archived 4 rounds, 0 left in the log' in output
+
+    trainer.onecmd('getstats --size 4')
+    trainer.onecmd('colorgame 10 4')
+    trainer.onecmd('colorgame ten')
+    assert trainer.stdout.getvalue().count('Bad arguments') == 3
+
+def test_weak_spot_scheduler():
+    from collections import Counter
+    from random import Random
+    positions = ct.ColorGame().all_positions()
+    assert len(positions) == 64 and len(ct.KnightSquareGame(size=6).all_positions()) == 36
+    tallies = {position: [20, 20, 20.0] for position in positions}
+    tallies['e:4'] = [20, 0, 200.0]
+    scheduler = ct.WeakSpotScheduler(positions, tallies, explore=0.0, rng=Random(1))
+    assert Counter(scheduler.next_position() for _ in range(1000)).most_common(1)[0][0] == 'e:4'
+    for _ in range(200):
+        scheduler.update(ct.Round(1, 1, 0.5, 'e:4', 'w', '2020-01-01 00:00:00'))
+        scheduler.update(ct.Round(1, 0, 30.0, 'a:1', 'w', '2020-01-01 00:00:00'))
+    assert abs(scheduler.total - sum(scheduler.weights)) < 1e-6
+    assert Counter(scheduler.next_position() for _ in range(1000)).most_common(1)[0][0] == 'a:1'
+
+def test_adaptive_game(tmp_path, monkeypatch):
+    from random import Random
+    monkeypatch.chdir(tmp_path)
+    ct.KnightSquareGame().log_trials([ct.Round(1, 0, 60.0, 'c:1 f:8', 'a:1', '2020-01-01 00:00:00')] * 50)
+    game = ct.KnightSquareGame(scheduler=ct.WeakSpotScheduler)
+    game.preloop()
+    game._scheduler.explore = 0.0
+    game._scheduler.rng = Random(1)
+    positions = [game.next_position() for _ in range(100)]
+    assert positions.count('c:1 f:8') > 15
+
+    import io
+    trainer = ct.ChessVisualizationTrainer(stdout=io.StringIO())
+    trainer.onecmd('colorgame 5 1000 --adaptive')
+    assert 'Bad arguments: --adaptive is for boards of at most 65536 squares' in trainer.stdout.getvalue()
+
+def test_puzzle_bank(tmp_path):
+    bank = ct.PuzzleBank.build(workers=0)
+    assert len(bank.pairs) // 2 == 64 * 63 + 64 * 63 + 32 * 31 * 2 + 64 * 63 * 2
+    knight = bank.puzzles('knight', distance=5)
+    for _ in range(20):
+        start, end = knight.next_position().split()
+        assert ct.get_knight_distance(start, end) == 5
+    many = bank.puzzles('knight', min_routes=20)
+    for _ in range(20):
+        assert ct.count_shortest_paths_for_knight(*many.next_position().split()) >= 20
+    assert len(bank.puzzles('rook', distance=1)) == 64 * 14
+    path = str(tmp_path / 'puzzles.bank')
+    bank.save(path)
+    loaded = ct.PuzzleBank.load(path)
+    assert loaded.groups == bank.groups and loaded.pairs == bank.pairs
+
+    small = ct.PuzzleBank.build(5, ('knight', 'bishop'), workers=2)
+    assert small.groups == ct.PuzzleBank.build(5, ('knight', 'bishop'), workers=0).groups
+    game = ct.KnightSquareGame(size=5, scheduler=small.puzzles('knight', distance=3))
+    game.preloop()
+    start, end = game.cur_pos.split()
+    assert ct.get_knight_distance(start, end, 5) == 3
+
+def test_puzzle_bank_caps_routes(tmp_path, monkeypatch):
+    # As if route counts of 10 and up did not fit in the saved bank
+    monkeypatch.setattr(ct.PuzzleBank, 'max_routes', 10)
+    bank = ct.PuzzleBank.build(pieces=('knight',), workers=0)
+    assert max(routes for _, _, routes in bank.groups) == 10
+    assert len(bank.pairs) // 2 == 64 * 63 == sum(count for _, count in bank.groups.values())
+    path = str(tmp_path / 'puzzles.bank')
+    bank.save(path)
+    loaded = ct.PuzzleBank.load(path)
+    assert loaded.groups == bank.groups and loaded.pairs == bank.pairs
+    many = loaded.puzzles('knight', min_routes=10)
+    assert len(many) > 0
+    for _ in range(20):
+        assert ct.count_shortest_paths_for_knight(*many.next_position().split()) >= 10
+
+def test_knightgame_arguments(monkeypatch):
+    import io
+    def build(*args, **kwargs):
+        raise AssertionError('built a bank at the prompt')
+    monkeypatch.setattr(ct.PuzzleBank, 'build', build)
+    trainer = ct.ChessVisualizationTrainer(stdout=io.StringIO())
+    for line in ('knightgame 1 4', 'knightgame 0', 'knightgame 1 300 --distance 3'):
+        trainer.onecmd(line)
+    output = trainer.stdout.getvalue()
+    assert output.count('Bad arguments') == 3
+    assert 'Puzzles for a 300x300 board need a prebuilt bank' in output
+
+def test_answer_cache(tmp_path):
+    cache = ct.AnswerCache(max_entries=100)
+    game = ct.BrotherSquareGame()
+    assert cache.get(game, 'a:1') == ('h:8', 'b')
+    assert cache.get(game, 'a:1') == ('h:8', 'b')
+    knight = ct.KnightSquareGame(size=10)
+    assert cache.get(knight, 'a:1 j:10') == knight.get_correct_answer('a:1 j:10')
+    assert cache.stats() == {'brother-square': {'hits': 1, 'misses': 1, 'hit_rate': 0.5},
+                             'knight-10x10': {'hits': 0, 'misses': 1, 'hit_rate': 0.0}}
+    cache.warm(ct.ColorGame())
+    assert len(cache.entries) == 66
+    cache.warm(ct.DiagonalSquareGame())
+    assert len(cache.entries) == 100 and ('brother-square', 'a:1') not in cache.entries
+
+    path = str(tmp_path / 'answers.json')
+    cache.save(path)
+    loaded = ct.AnswerCache()
+    loaded.load(path)
+    assert loaded.entries == cache.entries
+    game = ct.DiagonalSquareGame()
+    assert game.grade('e:4', 'a:8 b:1 b:7 c:2 c:6 d:3 d:5 f:3 f:5 g:2 g:6 h:1 h:7 w')[2]
+    assert ct.ANSWER_CACHE.get(game, 'e:4') is ct.ANSWER_CACHE.get(game, 'e:4')
+
+    # Answers of big boards are not cached.
+    big_game = ct.DiagonalSquareGame(size=10)
+    entries = len(ct.ANSWER_CACHE.entries)
+    assert big_game.correct_answer(big_game.all_positions()[0])
+    ct.ANSWER_CACHE.warm(big_game)
+    assert len(ct.ANSWER_CACHE.entries) == entries
+
+def test_interned_squares():
+    import pickle
+    import pytest
+    e4 = ct.get_square('e:4')
+    assert len(ct.SQUARES) == 64 and ct.SQUARES[e4.index] is e4
+    assert (e4.coordinates, e4.color, e4.brother) == ((5, 4), 'w', ct.get_square('d:5'))
+    assert e4.brother.brother is e4
+    assert [square.name for square in ct.get_square('a:1').knight_moves] == ['c:2', 'b:3']
+    assert pickle.loads(pickle.dumps(e4)) is e4
+    with pytest.raises(AttributeError):
+        e4.x = 1
+    with pytest.raises(AttributeError):
+        e4.distance = 0
+
+def test_instrumentation(tmp_path, monkeypatch):
+    import io
+    import json
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ct, 'INSTRUMENTS', ct.Instrumentation())
+    game = ct.ColorGame(rounds=2)
+    game.stdout = io.StringIO()
+    game.preloop()
+    for _ in range(2):
+        line = game.precmd(game.get_correct_answer(game.cur_pos))
+        game.postcmd(game.onecmd(line), line)
+    game.postloop()
+    timings = ct.INSTRUMENTS.to_dict()['color-square']
+    assert {phase: timing['count'] for phase, timing in timings.items()} == {
+        'precmd': 2, 'get_answer': 2, 'get_correct_answer': 2, 'think': 2, 'postcmd': 2, 'log_trials': 1}
+    assert json.loads(json.dumps(timings))['think']['total_seconds'] >= 0
+    prometheus = ct.INSTRUMENTS.to_prometheus()
+    assert 'chesstrainer_phase_seconds_count{game="color-square",phase="think"} 2' in prometheus
+    assert 'chesstrainer_phase_seconds_bucket{game="color-square",phase="precmd",le="+Inf"} 2' in prometheus
+    assert 'chesstrainer_phase_seconds_bucket{game="color-square",phase="precmd",le="100"} 2' in prometheus
+
+    # Dumps taken while rounds are recorded stay consistent.
+    import threading
+    instruments = ct.Instrumentation()
+    done = threading.Event()
+    def record():
+        while not done.is_set():
+            instruments.record('knight', 'think', 1000)
+    thread = threading.Thread(target=record)
+    thread.start()
+    try:
+        for _ in range(200):
+            lines = instruments.to_prometheus().splitlines()
+            buckets = [int(line.split()[-1]) for line in lines if '_bucket' in line]
+            assert not buckets or buckets[-2] == buckets[-1] == int(lines[-1].split()[-1])
+    finally:
+        done.set()
+        thread.join()
+
+def test_game_registry():
+    import io
+    assert list(ct.GAME_REGISTRY) == ['color-square', 'brother-square', 'diag', 'knight', 'rook', 'queen']
+    assert ct.GAMES == tuple(entry.factory for entry in ct.GAME_REGISTRY.values())
+    assert ct.GAME_REGISTRY['knight'].log_file(12) == 'knight-12x12.trials'
+    trainer = ct.ChessVisualizationTrainer(stdout=io.StringIO())
+    for entry in ct.GAME_REGISTRY.values():
+        assert callable(getattr(trainer, 'do_' + entry.command))
+    trainer.onecmd('help rookgame')
+    assert 'rook attacks' in trainer.stdout.getvalue()
+
+def test_square_codec():
+    import pytest
+    codec = ct.get_codec()
+    assert len(codec.ids) == 256 and ct.get_codec() is codec
+    assert codec.parse_squares('e4 e:4 E4 E:4') == [ct.get_square_id('e:4')] * 4
+    assert codec.parse_names(['a1', 'H:8']) == ['a:1', 'h:8']
+    for token, error in (('|:1', 'Squares must look like'), ('a:19', 'There is no rank 19 on the 8x8 board'),
+                         ('i4', 'There is no i file'), ('e:0', 'There is no rank 0'), ('e4x', 'Squares must look like')):
+        with pytest.raises(ct.BadFormatError, match=error):
+            codec.parse_squares(['e4', token])
+    big = ct.SquareCodec(100)
+    assert not big.ids and big.parse_squares('aa100 AA:1') == [9999 - 73, 26] and len(big.ids) == 2
+    with pytest.raises(ct.BadFormatError, match='There is no cw file'):
+        big.parse_square('cw1')
+    assert ct.get_square_id('l:12', 12) == 143
+
+def test_strict_answers():
+    import pytest
+    assert ct.ColorGame().get_answer('W') == 'w'
+    with pytest.raises(ct.BadFormatError):
+        ct.ColorGame().get_answer('wb')
+    assert ct.BrotherSquareGame().get_answer('E4 b') == ('e:4', 'b')
+    assert ct.DiagonalSquareGame().grade('a:1', 'b2 c3 d4 e5 f6 g7 h8 B')[2]
+    assert ct.KnightSquareGame().grade('a:1 h:8', 'a1 b3 c5 d7 f6 g8 h6 g4 h2 f3 h4 g6 h8')[0][:2] == ['a:1', 'b:3']
+    with pytest.raises(ct.BadFormatError, match='There is no rank 19'):
+        ct.RookSquareGame().get_answer('a:2 a:19')
+    assert ct.KnightSquareGame(size=12).is_right_answer(['a:1', 'b:3', 'c:5'], ['a:1', 'b:3', 'c:5'])